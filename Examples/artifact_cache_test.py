@@ -0,0 +1,119 @@
+import io
+import os
+import shutil
+import filecmp
+import tarfile
+import tempfile
+import boto3
+from moto import mock_s3, mock_sts
+from sagemode.Helpers import ArtifactCache, S3Stream
+from sagemode.Helpers.FileCopy import copy_file_to_directory
+
+# uploads a staged model directory through cached_upload_to_s3 into a moto bucket: an unchanged directory is skipped, a code-only
+# change copies the data layer of the earlier archive inside S3 and uploads only the code layer, and every archive extracts to the
+# directory it was built from.
+os.environ.update({"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": "us-east-1",
+                   "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required", "SAGEMAKER_ROLE_ARN": "arn:aws:iam::123456789012:role/sagemaker",
+                   "LAMBDA_ROLE_ARN": "arn:aws:iam::123456789012:role/lambda"})
+from sagemode.Types.Arn import LambdaArn
+from sagemode.ResourceUser.PyTorchSageMakerResourceUser import PyTorchSageMakerResourceUser
+
+work_dir = tempfile.mkdtemp()
+ArtifactCache.index_path = os.path.join(work_dir, "artifact_index.json")
+# two copy parts for the 12 MB data layer, like a multi-GB layer against the real 5 GB limit
+S3Stream.max_copy_part_size = 8 * 1024 ** 2
+weights_path = os.path.join(work_dir, "weights.pth")
+with open(weights_path, "wb") as weights_file:
+    weights_file.write(os.urandom(12 * 1024 ** 2))
+model_dir = os.path.join(work_dir, "PyTorchSageMaker")
+
+def stage(inference_code:str) -> None:
+    shutil.rmtree(model_dir, ignore_errors=True)
+    copy_file_to_directory(weights_path, model_dir, "weights.pth")
+    with open(os.path.join(model_dir, "config.json"), "w") as config_file:
+        config_file.write('{"hidden_size": 8}')
+    os.makedirs(os.path.join(model_dir, "code"))
+    with open(os.path.join(model_dir, "code", "inference.py"), "w") as inference_file:
+        inference_file.write(inference_code)
+
+class CountingClient:
+    # passes everything through to the real client and counts the bytes that leave this machine
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.uploaded = 0
+        self.copied_parts = 0
+
+    def upload_part(self, **kwargs):
+        self.uploaded += len(kwargs["Body"])
+        return self.s3_client.upload_part(**kwargs)
+
+    def upload_part_copy(self, **kwargs):
+        self.copied_parts += 1
+        return self.s3_client.upload_part_copy(**kwargs)
+
+    def upload_file(self, filename, *args, **kwargs):
+        self.uploaded += os.path.getsize(filename)
+        return self.s3_client.upload_file(filename, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+def upload(user, stream:bool = False) -> CountingClient:
+    client = CountingClient(boto3.client("s3", region_name="us-east-1"))
+    user.boto3_session.client = lambda service: client
+    user.cached_upload_to_s3("model.tar.gz", level=0, stream=stream)
+    return client
+
+def check_archive(model_uri:str) -> None:
+    bucket, key = model_uri[len("s3://"):].split("/", 1)
+    body = boto3.client("s3", region_name="us-east-1").get_object(Bucket=bucket, Key=key)["Body"].read()
+    extract_dir = tempfile.mkdtemp(dir=work_dir)
+    with tarfile.open(fileobj=io.BytesIO(body), mode="r:gz") as tar:
+        assert sorted(tar.getnames()) == ["code", "code/inference.py", "config.json", "weights.pth"], tar.getnames()
+        tar.extractall(extract_dir)
+    for name in ["weights.pth", "config.json", os.path.join("code", "inference.py")]:
+        assert filecmp.cmp(os.path.join(model_dir, name), os.path.join(extract_dir, name), shallow=False), name
+
+original_cwd = os.getcwd()
+os.chdir(work_dir)
+with mock_s3(), mock_sts():
+    boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="sagemode-test")
+    user = PyTorchSageMakerResourceUser("ml.m5.xlarge", lambda_arn=LambdaArn("arn:aws:lambda:us-east-1:123456789012:function:f"))
+    user.model_dir = model_dir
+    user.bucket = "sagemode-test"
+
+    stage("def model_fn(model_dir):\n    return 1\n")
+    client = upload(user)
+    first_uri = user.model_uri
+    assert client.uploaded > 12 * 1024 ** 2 and client.copied_parts == 0
+    check_archive(first_uri)
+
+    # staged again without changes, copy2 keeps the weights' mtime so the index answers without reading them
+    stage("def model_fn(model_dir):\n    return 1\n")
+    assert os.stat(os.path.join(model_dir, "weights.pth")).st_mtime_ns == os.stat(weights_path).st_mtime_ns
+    client = upload(user)
+    assert user.model_uri == first_uri and client.uploaded == 0
+
+    # only the code changed: two copied parts and a code layer of a few KB
+    stage("def model_fn(model_dir):\n    return 2\n")
+    client = upload(user)
+    assert user.model_uri != first_uri and client.copied_parts == 2 and client.uploaded < 64 * 1024, (client.copied_parts, client.uploaded)
+    check_archive(user.model_uri)
+
+    # the archive the layer came from is gone, the next code change builds everything again and streams it
+    s3_client = boto3.client("s3", region_name="us-east-1")
+    for version in s3_client.list_objects_v2(Bucket="sagemode-test")["Contents"]:
+        s3_client.delete_object(Bucket="sagemode-test", Key=version["Key"])
+    stage("def model_fn(model_dir):\n    return 3\n")
+    client = upload(user, stream=True)
+    assert client.copied_parts == 0 and client.uploaded > 12 * 1024 ** 2
+    check_archive(user.model_uri)
+
+    # the streamed archive recorded its data layer too
+    stage("def model_fn(model_dir):\n    return 4\n")
+    client = upload(user)
+    assert client.copied_parts == 2 and client.uploaded < 64 * 1024
+    check_archive(user.model_uri)
+os.chdir(original_cwd)
+
+print("Cache hit, code layer rebuild with a copied data layer, fallback when the source is gone and archive contents all passed.")
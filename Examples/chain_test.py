@@ -9,8 +9,8 @@ users[0] = HFSageMakerResourceUser("ml.g5.xlarge", IOTypes.LanguageModeling, IOT
 users[1] = HFSageMakerResourceUser("ml.g5.xlarge", IOTypes.LanguageModeling, IOTypes.ImageModeling)
 
 deployment_args = [None, None]
-deployment_args[0] = {"model_id": "google/flan-t5-small", "function_name":"FlanT5SmallLambda", "skip_compression":True, "skip_upload":True}
-deployment_args[1] = {"model_id": "OFA-Sys/small-stable-diffusion-v0", "function_name": "SmallStableDiffusionV0Lambda", "timeout":240, "skip_compression":True, "skip_upload":True}
+deployment_args[0] = {"model_id": "google/flan-t5-small", "function_name":"FlanT5SmallLambda"}
+deployment_args[1] = {"model_id": "OFA-Sys/small-stable-diffusion-v0", "function_name": "SmallStableDiffusionV0Lambda", "timeout":240}
 
 deployment_state_machine = DeploymentStateMachine()
 deployment_state_machine.deploy("FirstStateMachine", None, users, deployment_args)
@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import tarfile
+import tempfile
+import filecmp
+import torch
+from sagemode.Helpers.ParallelGzip import compress_directory
+
+# builds a model directory with 64 MB of weights and a config file, then compares single threaded tarfile gzip
+# (which defaults to level 9) with the block parallel writer at a few levels. every archive is extracted again and compared with the source.
+# python compression_benchmark.py [size_mb]
+size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+work_dir = tempfile.mkdtemp()
+model_dir = os.path.join(work_dir, "model")
+os.makedirs(os.path.join(model_dir, "code"))
+# low-entropy values, like the many repeated or near-zero entries of real fp16 checkpoints, so that gzip has something to do
+weights = (torch.randn(size_mb * 1024 ** 2 // 2) * 4).round().to(torch.float16)
+torch.save({"weight": weights}, os.path.join(model_dir, "pytorch_model.bin"))
+with open(os.path.join(model_dir, "config.json"), "w") as config_file:
+    config_file.write('{"architectures": ["GPT2LMHeadModel"]}')
+with open(os.path.join(model_dir, "code", "inference.py"), "w") as inference_file:
+    inference_file.write("def model_fn(model_dir):\n    pass\n")
+
+def check_archive(archive_path:str) -> None:
+    extract_dir = tempfile.mkdtemp(dir=work_dir)
+    with tarfile.open(archive_path, "r:gz") as tar:
+        tar.extractall(extract_dir)
+    comparison = filecmp.dircmp(model_dir, extract_dir)
+    assert not comparison.left_only and not comparison.right_only and not comparison.diff_files, "the archive does not match the model directory"
+    assert filecmp.cmp(os.path.join(model_dir, "pytorch_model.bin"), os.path.join(extract_dir, "pytorch_model.bin"), shallow=False)
+
+t_start = time.time()
+baseline_path = os.path.join(work_dir, "baseline.tar.gz")
+with tarfile.open(baseline_path, "w:gz") as tar:
+    for item in os.listdir(model_dir):
+        tar.add(os.path.join(model_dir, item), arcname=item)
+baseline_time = time.time() - t_start
+print(f"tarfile w:gz: {size_mb / baseline_time:.1f} MB/s, {os.path.getsize(baseline_path) / 1024 ** 2:.1f} MB. Time taken: {baseline_time:.2f} seconds")
+check_archive(baseline_path)
+
+for level in [6, 1, 0]:
+    archive_path = os.path.join(work_dir, f"level{level}.tar.gz")
+    cwd = os.getcwd()
+    t_start = time.time()
+    compress_directory(model_dir, archive_path, level)
+    elapsed = time.time() - t_start
+    assert os.getcwd() == cwd
+    check_archive(archive_path)
+    print(f"  level {level} is {baseline_time / elapsed:.1f}x faster than tarfile w:gz")
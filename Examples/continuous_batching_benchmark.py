@@ -0,0 +1,85 @@
+import time
+import random
+import tempfile
+import threading
+import statistics
+from queue import Queue, Empty
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from tiny_model import save_tiny_causal_lm
+from sagemode.InferenceFiles.HFSageMaker.continuous_batching import ContinuousBatchingEngine
+
+# replays the same stream of requests with mixed output lengths against static batches of generate() and against
+# the continuous batching engine, using a tiny random model. run this from the Examples folder.
+max_batch_size = 8
+requests_count = 96
+arrival_rate = 200.0
+random.seed(0)
+torch.set_num_threads(1)
+
+model_dir = tempfile.mkdtemp()
+save_tiny_causal_lm(model_dir)
+model = AutoModelForCausalLM.from_pretrained(model_dir).eval()
+tokenizer = AutoTokenizer.from_pretrained(model_dir)
+tokenizer.padding_side = "left"
+# a random model stops at random, masking end of sequence makes every request run to its max_new_tokens on both paths
+eos_mask = torch.tensor([tokenizer.eos_token_id])
+model.lm_head.register_forward_hook(lambda module, inputs, logits: logits.index_fill_(-1, eos_mask, float("-inf")))
+
+prompts = ["It was a dark and stormy night", "The quick brown fox", "SageMode deploys machine learning models", "Caffè"]
+workload, arrival = [], 0.0
+for i in range(requests_count):
+    arrival += random.expovariate(arrival_rate)
+    workload.append((arrival, random.choice(prompts), random.choice([8, 16, 32, 128])))
+
+def feed(queue:Queue, t_start:float) -> None:
+    for request_id, (arrives_at, _, _) in enumerate(workload):
+        time.sleep(max(0.0, t_start + arrives_at - time.perf_counter()))
+        queue.put(request_id)
+
+def run_static() -> list[float]:
+    # a batch is whatever arrived while the previous one ran, and it is held until its longest sequence is done
+    queue, finished_at = Queue(), {}
+    t_start = time.perf_counter()
+    threading.Thread(target=feed, args=(queue, t_start), daemon=True).start()
+    while len(finished_at) < requests_count:
+        batch = [queue.get()]
+        while len(batch) < max_batch_size:
+            try:
+                batch.append(queue.get_nowait())
+            except Empty:
+                break
+        inputs = tokenizer([workload[request_id][1] for request_id in batch], return_tensors="pt", padding=True)
+        with torch.no_grad():
+            model.generate(**inputs, max_new_tokens=max(workload[request_id][2] for request_id in batch), do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        for request_id in batch:
+            finished_at[request_id] = time.perf_counter() - t_start
+    return [finished_at[request_id] - workload[request_id][0] for request_id in range(requests_count)]
+
+def run_continuous() -> list[float]:
+    engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=max_batch_size, block_size=16)
+    engine.start()
+    queue, sequences = Queue(), {}
+    t_start = time.perf_counter()
+    threading.Thread(target=feed, args=(queue, t_start), daemon=True).start()
+    for _ in range(requests_count):
+        request_id = queue.get()
+        sequences[request_id] = engine.submit(workload[request_id][1], {"max_new_tokens": workload[request_id][2]})
+    finished_at = {}
+    for request_id, sequence in sequences.items():
+        sequence.wait()
+        finished_at[request_id] = sequence.finished_at - t_start
+    engine.stop()
+    print(f"engine stats: {engine.stats()}")
+    return [finished_at[request_id] - workload[request_id][0] for request_id in range(requests_count)]
+
+def report(name:str, latencies:list[float]) -> None:
+    total_tokens = sum(max_new_tokens for _, _, max_new_tokens in workload)
+    makespan = max(arrives_at + latency for (arrives_at, _, _), latency in zip(workload, latencies))
+    latencies = sorted(latencies)
+    print(f"{name}: {total_tokens / makespan:.0f} tokens/s, mean latency {statistics.mean(latencies) * 1000:.0f} ms, "
+          f"p95 latency {latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
+
+run_static()
+report("static batching", run_static())
+report("continuous batching", run_continuous())
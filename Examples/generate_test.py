@@ -0,0 +1,26 @@
+import time
+import tempfile
+from tiny_model import save_tiny_causal_lm
+from sagemode.InferenceFiles.HFSageMaker.AutoModelForCausalLM import model_fn, predict_fn
+
+# checks that one batched call returns what one call per prompt returns, and compares their latency.
+# run this from the Examples folder so that tiny_model.py can be imported.
+model_dir = tempfile.mkdtemp()
+save_tiny_causal_lm(model_dir)
+model_and_tokenizer = model_fn(model_dir)
+
+prompts = ["It was a dark and stormy night", "The quick brown fox", "SageMode deploys", "Caffè"] * 4
+parameters = {"max_new_tokens": 32, "do_sample": False}
+predict_fn({"inputs": prompts[0], "parameters": {"max_new_tokens": 1}}, model_and_tokenizer)
+
+t_start = time.time()
+one_by_one = [predict_fn({"inputs": prompt, "parameters": parameters}, model_and_tokenizer)["text"] for prompt in prompts]
+sequential_time = time.time() - t_start
+
+t_start = time.time()
+batched = predict_fn({"inputs": prompts, "parameters": parameters}, model_and_tokenizer)["text"]
+batched_time = time.time() - t_start
+
+assert batched == one_by_one, "batched generation does not match generating each prompt on its own"
+print(f"{len(prompts)} prompts. One call per prompt: {sequential_time * 1000:.1f} ms, one batched call: {batched_time * 1000:.1f} ms")
+print("generate test passed.")
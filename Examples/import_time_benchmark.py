@@ -0,0 +1,44 @@
+import sys
+import subprocess
+
+# imports each resource user in a fresh interpreter with -X importtime and fails if a heavy framework is imported
+# at module level or if an import takes longer than its budget. python import_time_benchmark.py [budget_ms]
+modules = ["sagemode.ResourceUser.HFSageMakerResourceUser",
+           "sagemode.ResourceUser.PyTorchSageMakerResourceUser",
+           "sagemode.ResourceUser.PyTorchEC2ResourceUser",
+           "sagemode.DeploymentStateMachine.DeploymentStateMachine"]
+# only needed to build or deploy a model, never to call use() on an existing deployment
+heavy_modules = ["torch", "transformers", "diffusers", "sagemaker", "paramiko", "huggingface_hub", "safetensors"]
+budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 1000
+runs = 3
+
+def import_profile(module:str) -> dict[str, float]:
+    # -X importtime writes "import time: self [us] | cumulative | imported package" lines to stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.splitlines()[-1]}")
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(cumulative_us) / 1000
+    return cumulative
+
+failures = []
+for module in modules:
+    profiles = [import_profile(module) for _ in range(runs)]
+    # the fastest run is the least disturbed by the page cache and other processes
+    import_ms = min(profile[module] for profile in profiles)
+    loaded = [name for name in heavy_modules if name in profiles[0]]
+    slowest = sorted(((ms, name) for name, ms in profiles[0].items() if "." not in name and name != "sagemode"), reverse=True)[:3]
+    print(f"{module}: {import_ms:.0f} ms, slowest top-level imports: {', '.join(f'{name} {ms:.0f} ms' for ms, name in slowest)}")
+    if loaded:
+        failures.append(f"{module} imports {loaded} at module level")
+    if import_ms > budget_ms:
+        failures.append(f"{module} took {import_ms:.0f} ms to import, the budget is {budget_ms:.0f} ms")
+
+if failures:
+    print("\n".join(failures))
+    sys.exit(1)
+print(f"All {len(modules)} modules import without {', '.join(heavy_modules)} and within {budget_ms:.0f} ms.")
@@ -0,0 +1,52 @@
+import os
+import time
+import boto3
+from moto import mock_lambda, mock_iam
+import sagemode.Helpers.LambdaDeploy as LambdaDeploy
+from sagemode.Helpers.LambdaDeploy import build_dependencies, build_zip, deploy_function
+
+# deploys the EC2 lambda handler to moto twice with the same code, then with a new environment and then with new code.
+# the first run installs requests with pip (network access needed), later runs reuse the dependency bundle from the cache
+handler_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SageMode", "LambdaFunctions", "EC2", "EC2.py")
+
+t_start = time.time()
+dependency_dir = build_dependencies(["requests==2.31.0"], "3.9")
+first_build = time.time() - t_start
+t_start = time.time()
+assert build_dependencies(["requests==2.31.0"], "3.9") == dependency_dir
+print(f"dependency bundle: {first_build:.2f} s the first time, {time.time() - t_start:.3f} s from the cache")
+
+zip_bytes = build_zip({"lambda_function.py": handler_path}, dependency_dir)
+assert build_zip({"lambda_function.py": handler_path}, dependency_dir) == zip_bytes, "the zip is not reproducible"
+
+with mock_iam(), mock_lambda():
+    iam_client = boto3.client("iam", region_name="us-east-1")
+    role_arn = iam_client.create_role(RoleName="lambda-role", AssumeRolePolicyDocument="{}", Path="/")["Role"]["Arn"]
+    lambda_client = boto3.client("lambda", region_name="us-east-1")
+    configuration = {"Runtime": "python3.9", "Role": role_arn, "Handler": "lambda_function.lambda_handler", "Timeout": 3,
+                     "Environment": {"Variables": {"DNS_NAME": "ec2-1-2-3-4.compute.amazonaws.com", "PORT": "8000"}}}
+
+    function_arn = deploy_function(lambda_client, "EC2Lambda", zip_bytes, configuration)
+    calls = []
+    for operation in ["create_function", "update_function_code", "update_function_configuration"]:
+        original = getattr(lambda_client, operation)
+        def record(*args, operation=operation, original=original, **kwargs):
+            calls.append(operation)
+            return original(*args, **kwargs)
+        setattr(lambda_client, operation, record)
+
+    assert deploy_function(lambda_client, "EC2Lambda", zip_bytes, configuration) == function_arn
+    assert calls == [], calls
+
+    configuration["Environment"]["Variables"]["DNS_NAME"] = "ec2-5-6-7-8.compute.amazonaws.com"
+    deploy_function(lambda_client, "EC2Lambda", zip_bytes, configuration)
+    assert calls == ["update_function_configuration"], calls
+    variables = lambda_client.get_function_configuration(FunctionName="EC2Lambda")["Environment"]["Variables"]
+    assert variables["DNS_NAME"] == "ec2-5-6-7-8.compute.amazonaws.com"
+
+    new_zip_bytes = build_zip({"lambda_function.py": handler_path, "extra.py": handler_path}, dependency_dir)
+    deploy_function(lambda_client, "EC2Lambda", new_zip_bytes, configuration)
+    assert calls == ["update_function_configuration", "update_function_code"], calls
+    assert lambda_client.get_function(FunctionName="EC2Lambda")["Configuration"]["CodeSha256"] == LambdaDeploy.code_sha256(new_zip_bytes)
+
+print("Create, no-op redeploy, configuration update and code update all passed.")
@@ -0,0 +1,49 @@
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import torch
+from sagemode.Helpers.ConvertWeights import convert_to_safetensors
+
+# compares cold start time and peak RSS of the EC2 server's two loading paths on a ~400 MB model.
+# every path runs in a fresh interpreter so that page cache and allocator state do not leak between runs.
+model_source = '''import torch
+model = torch.nn.Sequential(*[torch.nn.Linear(4096, 4096) for _ in range(6)])
+'''
+
+loader_source = '''import sys, time
+t_start = time.time()
+from loading import load_model, peak_rss_mb
+model = load_model(sys.argv[1])
+print(f"{time.time() - t_start:.3f} {peak_rss_mb():.1f}")
+'''
+
+server_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SageMode", "InferenceFiles", "PyTorchEC2", "server")
+work_directory = tempfile.mkdtemp()
+shutil.copy(os.path.join(server_directory, "loading.py"), work_directory)
+shutil.copy(os.path.join(os.path.dirname(os.path.dirname(server_directory)), "onnx_model.py"), work_directory)
+with open(os.path.join(work_directory, "model.py"), "w") as model_file:
+    model_file.write(model_source)
+with open(os.path.join(work_directory, "benchmark_loader.py"), "w") as loader_file:
+    loader_file.write(loader_source)
+
+sys.path.insert(0, work_directory)
+from model import model
+torch.save(model.state_dict(), os.path.join(work_directory, "weights.pth"))
+convert_to_safetensors(os.path.join(work_directory, "weights.pth"), os.path.join(work_directory, "weights.safetensors"))
+model_size_mb = sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values()) / 1024 ** 2
+del model
+
+print(f"model size: {model_size_mb:.1f} MB")
+for weights in ["weights.pth", "weights.safetensors"]:
+    runs = []
+    for _ in range(3):
+        output = subprocess.run([sys.executable, "benchmark_loader.py", weights], cwd=work_directory, capture_output=True, text=True, check=True)
+        seconds, peak_rss_mb = output.stdout.strip().splitlines()[-1].split()
+        runs.append((float(seconds), float(peak_rss_mb)))
+    best_seconds = min(seconds for seconds, _ in runs)
+    peak_rss_mb = min(rss for _, rss in runs)
+    print(f"{weights:>20}: cold start {best_seconds:.2f} seconds, peak RSS {peak_rss_mb:.1f} MB")
+
+shutil.rmtree(work_directory)
@@ -0,0 +1,138 @@
+import io
+import os
+import json
+import boto3
+import importlib.util
+from botocore.config import Config
+from moto import mock_s3, mock_sts
+from sagemode.Helpers.PayloadOffload import PayloadOffloader, lifecycle_rule_id, reference_key, settings_key
+
+# round trip of the S3 claim check against moto: the client offloads a large field, a forwarding stage passes the reference
+# on without downloading it, the handler reads it lazily and offloads its large output, and the client resolves it again
+handler_module_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SageMode", "InferenceFiles", "payload_offload.py")
+spec = importlib.util.spec_from_file_location("payload_offload", handler_module_path)
+payload_offload = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(payload_offload)
+
+with mock_s3():
+    # moto does not decode aws-chunked bodies, so checksums are only sent when an operation requires them
+    s3_client = boto3.client("s3", region_name="us-east-1", config=Config(request_checksum_calculation="when_required"))
+    s3_client.create_bucket(Bucket="payloads")
+    existing_rule = {"ID": "logs", "Filter": {"Prefix": "logs/"}, "Status": "Enabled", "Expiration": {"Days": 30}}
+    s3_client.put_bucket_lifecycle_configuration(Bucket="payloads", LifecycleConfiguration={"Rules": [existing_rule]})
+
+    gets = []
+    original_get_object = s3_client.get_object
+    def counting_get_object(**kwargs):
+        gets.append(kwargs["Key"])
+        return original_get_object(**kwargs)
+    s3_client.get_object = counting_get_object
+    payload_offload.s3_client = s3_client
+
+    offloader = PayloadOffloader(s3_client, "payloads", threshold=1024)
+    # the rule exists before anything was offloaded, outputs of small requests expire too
+    rules = s3_client.get_bucket_lifecycle_configuration(Bucket="payloads")["Rules"]
+    assert sorted(rule["ID"] for rule in rules) == ["logs", lifecycle_rule_id], rules
+    image = "A" * 200_000
+    event = offloader.offload({"text": "a red bicycle", "image": image})
+    assert event["text"] == "a red bicycle" and "$sagemode_s3" in event["image"], event
+    print(f"event: {len(json.dumps({'text': 'a red bicycle', 'image': image}))} bytes inline, {len(json.dumps(event))} bytes offloaded")
+
+    rules = s3_client.get_bucket_lifecycle_configuration(Bucket="payloads")["Rules"]
+    assert sorted(rule["ID"] for rule in rules) == ["logs", lifecycle_rule_id], rules
+    offloader.offload({"image": image})
+    assert len(s3_client.get_bucket_lifecycle_configuration(Bucket="payloads")["Rules"]) == 2
+
+    # a stage that only forwards the payload serializes the references, nothing is downloaded
+    data = payload_offload.LazyPayload(json.loads(json.dumps(event)))
+    forwarded = json.loads(json.dumps(data))
+    assert forwarded["image"] == event["image"] and gets == [], gets
+
+    # the handler reads the field once, later reads use the downloaded value
+    assert data["image"] == image and data.get("image") == image and len(gets) == 1
+    assert data.pop("text") == "a red bicycle" and data.settings == offloader.settings()
+
+    output = payload_offload.offload({"base64": image[::-1], "parameters": None}, data.settings)
+    assert "$sagemode_s3" in output["base64"] and output["parameters"] is None
+    assert offloader.resolve(json.loads(json.dumps(output))) == {"base64": image[::-1], "parameters": None}
+
+    # references outside the configured bucket and prefix are refused on both sides, before anything is read
+    settings = offloader.settings()
+    s3_client.create_bucket(Bucket="secrets")
+    s3_client.put_object(Bucket="secrets", Key="sagemode-payloads/x/a.json", Body=b'"secret"')
+    s3_client.put_object(Bucket="payloads", Key="other/a.json", Body=b'"secret"')
+    for location, data_settings in [("s3://secrets/sagemode-payloads/x/a.json", settings), ("s3://payloads/other/a.json", settings),
+                                     ("s3://payloads/sagemode-payloads-other/a.json", settings), (event["image"][reference_key], None)]:
+        reference = {reference_key: location, "bytes": 8}
+        data = payload_offload.LazyPayload({"image": reference, **({settings_key: data_settings} if data_settings else {})})
+        gets.clear()
+        # the client reads back with its own settings, only the handler needs them in the request
+        for read in [lambda: data["image"]] + ([lambda: offloader.fetch(reference)] if data_settings else []):
+            try:
+                read()
+                raise AssertionError(f"{location} was read")
+            except ValueError:
+                pass
+        assert gets == [], gets
+    # PAYLOAD_BUCKET on the server pins the bucket a request may name in its settings
+    os.environ["PAYLOAD_BUCKET"] = "other-bucket"
+    try:
+        payload_offload.LazyPayload(json.loads(json.dumps(event)))["image"]
+        raise AssertionError("a bucket other than PAYLOAD_BUCKET was read")
+    except payload_offload.InvalidReference:
+        pass
+    del os.environ["PAYLOAD_BUCKET"]
+
+    # without settings the handlers answer inline as before
+    assert payload_offload.offload({"base64": image}, None) == {"base64": image}
+
+# the same round trip through the public API of a resource user, with the lambda invoke answered by the handler side
+os.environ.update({"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing", "AWS_DEFAULT_REGION": "us-east-1",
+                   "AWS_REQUEST_CHECKSUM_CALCULATION": "when_required",
+                   "SAGEMAKER_ROLE_ARN": "arn:aws:iam::123456789012:role/sagemaker", "LAMBDA_ROLE_ARN": "arn:aws:iam::123456789012:role/lambda"})
+from sagemode.Types.Arn import LambdaArn
+from sagemode.ResourceUser.HFSageMakerResourceUser import HFSageMakerResourceUser
+from sagemode.ResourceUser.PyTorchSageMakerResourceUser import PyTorchSageMakerResourceUser
+
+with mock_s3(), mock_sts():
+    payload_offload.s3_client = boto3.client("s3", region_name="us-east-1", config=Config(request_checksum_calculation="when_required"))
+    payload_offload.s3_client.create_bucket(Bucket="payloads")
+    invocations = []
+    def invoke(FunctionName, InvocationType, Payload):
+        invocations.append(len(Payload))
+        data = payload_offload.LazyPayload(json.loads(Payload))
+        output = payload_offload.offload({"text": data["inputs"].upper(), "parameters": None}, data.settings)
+        return {"Payload": io.BytesIO(json.dumps(output).encode())}
+
+    def check_user(user):
+        user.lambda_user.lambda_client.invoke = invoke
+        prompt = "a" * 100_000
+        assert user.use({"inputs": prompt}) == {"text": prompt.upper(), "parameters": None}
+        assert invocations[-1] < 1024, invocations
+
+    # enabled after the user was created
+    user = HFSageMakerResourceUser("ml.m5.xlarge", lambda_arn=LambdaArn("arn:aws:lambda:us-east-1:123456789012:function:f"))
+    assert user.lambda_user.payload_offloader is None
+    user.enable_payload_offload("payloads", threshold=1024)
+    check_user(user)
+
+    # enabled for every user by PAYLOAD_BUCKET, the lambda_user created in __init__ shares the offloader
+    os.environ["PAYLOAD_BUCKET"] = "payloads"
+    user = HFSageMakerResourceUser("ml.m5.xlarge", lambda_arn=LambdaArn("arn:aws:lambda:us-east-1:123456789012:function:f"))
+    del os.environ["PAYLOAD_BUCKET"]
+    assert user.lambda_user.payload_offloader is user.payload_offloader
+    check_user(user)
+
+    # the PyTorch SageMaker entry point hands the raw body to the user's input_fn, so its requests stay inline
+    os.environ["PAYLOAD_BUCKET"] = "payloads"
+    user = PyTorchSageMakerResourceUser("ml.m5.xlarge", lambda_arn=LambdaArn("arn:aws:lambda:us-east-1:123456789012:function:f"))
+    del os.environ["PAYLOAD_BUCKET"]
+    assert user.lambda_user.payload_offloader is None and user.payload_environment() == {}
+    user.enable_payload_offload("payloads", threshold=1024)
+    assert user.lambda_user.payload_offloader is None and user.payload_environment() == {}
+    payloads = []
+    user.lambda_user.lambda_client.invoke = lambda FunctionName, InvocationType, Payload: payloads.append(json.loads(Payload)) or {"Payload": io.BytesIO(b"{}")}
+    user.use({"base64": "a" * 100_000})
+    assert payloads == [{"base64": "a" * 100_000}], "the request was not sent inline"
+
+print("Offload, lifecycle merge, lazy resolution, output offload, reference checks and offload through a resource user and inline requests for the PyTorch SageMaker user all passed.")
@@ -0,0 +1,64 @@
+import time
+import tempfile
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from tiny_model import save_tiny_causal_lm
+from sagemode.InferenceFiles.HFSageMaker import AutoModelForCausalLM as inference
+from sagemode.InferenceFiles.HFSageMaker.prefix_cache import PrefixCache
+from sagemode.InferenceFiles.HFSageMaker.continuous_batching import ContinuousBatchingEngine
+
+# prompts that share a long preamble must produce the same text with and without the prefix cache, and only prefill their suffix.
+# run this from the Examples folder so that tiny_model.py can be imported.
+model_dir = tempfile.mkdtemp()
+save_tiny_causal_lm(model_dir)
+model = AutoModelForCausalLM.from_pretrained(model_dir).eval()
+tokenizer = AutoTokenizer.from_pretrained(model_dir)
+model_and_tokenizer = (model, tokenizer)
+
+system_prompt = "The quick brown fox jumps over the lazy dog. " * 12
+questions = ["It was a dark and stormy night", "SageMode deploys", "Caffè", "the rain fell"]
+prompts = [system_prompt + question for question in questions] * 2
+parameters = {"max_new_tokens": 12}
+
+def run_all(stream:bool) -> tuple[list[str], float]:
+    t_start = time.perf_counter()
+    texts = []
+    for prompt in prompts:
+        if stream:
+            texts.append("".join(inference.predict_fn({"inputs": prompt, "parameters": dict(parameters), "stream": True}, model_and_tokenizer)))
+        else:
+            texts.append(inference.predict_fn({"inputs": prompt, "parameters": dict(parameters)}, model_and_tokenizer)["text"])
+    return texts, time.perf_counter() - t_start
+
+for stream in [False, True]:
+    inference.prefix_cache = None
+    expected, uncached_time = run_all(stream)
+    inference.prefix_cache = PrefixCache(max_mb=64)
+    actual, cached_time = run_all(stream)
+    assert actual == expected, f"{'stream' if stream else 'generate'} output changed with the prefix cache"
+    print(f"{'stream' if stream else 'generate'}: {uncached_time * 1000:.0f} ms without the cache, {cached_time * 1000:.0f} ms with it. {inference.prefix_cache.stats()}")
+
+# token for token against greedy generate(): the first prompt fills the cache, the second one starts from the shared preamble
+inference.prefix_cache = PrefixCache(max_mb=64)
+for prompt in prompts[:2]:
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    with torch.no_grad():
+        generated = model.generate(input_ids, max_new_tokens=parameters["max_new_tokens"], do_sample=False, pad_token_id=tokenizer.eos_token_id)
+    expected_ids = [token for token in generated[0, input_ids.shape[1]:].tolist() if token != tokenizer.eos_token_id]
+    cached_ids = list(inference.generate_tokens(input_ids, parameters, model, tokenizer))
+    assert cached_ids == expected_ids, f"{cached_ids} != {expected_ids}"
+assert inference.prefix_cache.hits == 1, inference.prefix_cache.stats()
+inference.prefix_cache = None
+
+expected = ContinuousBatchingEngine(model, tokenizer, max_batch_size=4).generate(prompts, parameters)
+engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=4, prefix_cache=PrefixCache(max_mb=64))
+assert engine.generate(prompts, parameters) == expected, "engine output changed with the prefix cache"
+print(f"engine: {engine.stats()['prefix_cache']}")
+
+# a budget that fits the preamble but not every suffix evicts the cold suffixes and keeps the hot preamble
+tiny_cache = PrefixCache(max_mb=0.14)
+engine = ContinuousBatchingEngine(model, tokenizer, max_batch_size=4, prefix_cache=tiny_cache)
+assert engine.generate(prompts, parameters) == expected
+assert tiny_cache.bytes <= tiny_cache.max_bytes and tiny_cache.evictions > 0 and tiny_cache.hits > 0
+print(f"small budget: {tiny_cache.stats()}")
+print("prefix cache test passed.")
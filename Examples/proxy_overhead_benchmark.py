@@ -0,0 +1,79 @@
+import os
+import sys
+import gzip
+import json
+import time
+import types
+import threading
+import importlib.util
+import statistics
+import requests
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# measures what the EC2 lambda proxy adds on top of the HTTP call itself. a local stub server answers /predict immediately,
+# so the difference between calling it through lambda_handler and calling it directly with a pooled session is the
+# per-hop overhead. the previous handler (pretty-printed JSON round trip, a new connection per call) is measured as well.
+# python proxy_overhead_benchmark.py [iterations]
+iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without TCP_NODELAY keep-alive calls would stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        response = json.dumps({"text": "ok", "received_bytes": len(body), "parameters": None}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+os.environ["DNS_NAME"], os.environ["PORT"] = "127.0.0.1", str(server.server_address[1])
+server_url = f"http://127.0.0.1:{server.server_address[1]}/predict"
+
+handler_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SageMode", "LambdaFunctions", "EC2", "EC2.py")
+spec = importlib.util.spec_from_file_location("ec2_proxy", handler_path)
+proxy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(proxy)
+context = types.SimpleNamespace(get_remaining_time_in_millis=lambda: 30000)
+
+def previous_handler(event, context):
+    payload = json.dumps(event, indent=2).encode('utf-8')
+    payload = json.loads(payload)
+    response = requests.post(server_url, json=payload)
+    return response.json()
+
+direct_session = requests.Session()
+def direct(event, context):
+    return direct_session.post(server_url, data=json.dumps(event, separators=(",", ":")), headers={"Content-Type": "application/json"}).json()
+
+def latencies_ms(call, event) -> list[float]:
+    for _ in range(10):
+        call(event, context)
+    latencies = []
+    for _ in range(iterations):
+        t_start = time.perf_counter()
+        call(event, context)
+        latencies.append((time.perf_counter() - t_start) * 1000)
+    return sorted(latencies)
+
+events = {"small": {"text": "It was a dark and stormy night...", "parameters": {"max_new_tokens": 20}},
+          "large": {"text": " ".join(["It was a dark and stormy night..."] * 20000), "parameters": None, "logits": [0.123456789] * 20000}}
+for name, event in events.items():
+    size_kb = len(json.dumps(event)) / 1024
+    results = {label: latencies_ms(call, event) for label, call in [("direct", direct), ("previous proxy", previous_handler), ("proxy", proxy.lambda_handler)]}
+    print(f"{name} event ({size_kb:.0f} KB):")
+    for label, latencies in results.items():
+        overhead = statistics.mean(latencies) - statistics.mean(results["direct"])
+        print(f"  {label:>15}: mean {statistics.mean(latencies):.3f} ms, p50 {latencies[len(latencies) // 2]:.3f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)]:.3f} ms, overhead over direct {overhead:+.3f} ms")
+server.shutdown()
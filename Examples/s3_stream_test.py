@@ -0,0 +1,64 @@
+import io
+import os
+import filecmp
+import tarfile
+import tempfile
+import boto3
+from botocore.config import Config
+from moto import mock_s3
+from sagemode.Helpers.S3Stream import stream_directory_to_s3, min_part_size
+
+# streams a model directory into a moto S3 bucket in several parts, once cleanly, once with parts that fail and are retried,
+# and once with a part that never succeeds, which must abort the multipart upload.
+work_dir = tempfile.mkdtemp()
+model_dir = os.path.join(work_dir, "model")
+os.makedirs(os.path.join(model_dir, "code"))
+with open(os.path.join(model_dir, "model.safetensors"), "wb") as weights_file:
+    weights_file.write(os.urandom(3 * min_part_size + 12345))
+with open(os.path.join(model_dir, "code", "inference.py"), "w") as inference_file:
+    inference_file.write("def model_fn(model_dir):\n    pass\n")
+
+def check_object(s3_client, bucket:str, key:str) -> None:
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    extract_dir = tempfile.mkdtemp(dir=work_dir)
+    with tarfile.open(fileobj=io.BytesIO(body), mode="r:gz") as tar:
+        tar.extractall(extract_dir)
+    assert filecmp.cmp(os.path.join(model_dir, "model.safetensors"), os.path.join(extract_dir, "model.safetensors"), shallow=False)
+    assert filecmp.cmp(os.path.join(model_dir, "code", "inference.py"), os.path.join(extract_dir, "code", "inference.py"), shallow=False)
+
+class FlakyClient:
+    # passes everything through to the real client but fails the first attempts at the chosen parts
+    def __init__(self, s3_client, failures:dict[int, int]):
+        self.s3_client = s3_client
+        self.failures = failures
+
+    def upload_part(self, **kwargs):
+        if self.failures.get(kwargs["PartNumber"], 0) > 0:
+            self.failures[kwargs["PartNumber"]] -= 1
+            raise ConnectionError(f"simulated network error on part {kwargs['PartNumber']}")
+        return self.s3_client.upload_part(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3_client, name)
+
+with mock_s3():
+    # moto does not decode the aws-chunked bodies that newer botocore versions send for checksums
+    s3_client = boto3.client("s3", region_name="us-east-1", config=Config(request_checksum_calculation="when_required"))
+    s3_client.create_bucket(Bucket="sagemode-test")
+
+    uri, _ = stream_directory_to_s3(model_dir, s3_client, "sagemode-test", "model/model.tar.gz", level=0, part_size=min_part_size)
+    assert uri == "s3://sagemode-test/model/model.tar.gz"
+    check_object(s3_client, "sagemode-test", "model/model.tar.gz")
+
+    stream_directory_to_s3(model_dir, FlakyClient(s3_client, {1: 1, 3: 2}), "sagemode-test", "flaky/model.tar.gz", level=1, part_size=min_part_size)
+    check_object(s3_client, "sagemode-test", "flaky/model.tar.gz")
+
+    try:
+        stream_directory_to_s3(model_dir, FlakyClient(s3_client, {2: 100}), "sagemode-test", "broken/model.tar.gz", level=0, part_size=min_part_size)
+        raise AssertionError("the upload should have failed")
+    except ConnectionError:
+        pass
+    assert not s3_client.list_multipart_uploads(Bucket="sagemode-test").get("Uploads"), "the failed upload was not aborted"
+    assert "Contents" not in s3_client.list_objects_v2(Bucket="sagemode-test", Prefix="broken/")
+
+print("Streaming upload, per-part retries and abort on failure all passed.")
@@ -0,0 +1,31 @@
+import time
+import random
+import tempfile
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+from tiny_model import save_tiny_seq2seq_lm, corpus
+from sagemode.InferenceFiles.HFSageMaker.AutoModelForSeq2SeqLM import predict_fn
+
+# runs a mix of short and long documents through the seq2seq inference file one at a time and as one length bucketed list.
+# run this from the Examples folder so that tiny_model.py can be imported.
+random.seed(0)
+model_dir = tempfile.mkdtemp()
+save_tiny_seq2seq_lm(model_dir)
+model_and_tokenizer = (AutoModelForSeq2SeqLM.from_pretrained(model_dir).eval(), AutoTokenizer.from_pretrained(model_dir))
+
+documents = [" ".join(random.choice(corpus) for _ in range(random.choice([1, 1, 2, 4, 12]))) for _ in range(200)]
+parameters = {"max_new_tokens": 16, "do_sample": False}
+predict_fn({"text": documents[0], "parameters": dict(parameters)}, model_and_tokenizer)
+
+t_start = time.time()
+one_by_one = [predict_fn({"text": document, "parameters": dict(parameters)}, model_and_tokenizer)["text"] for document in documents]
+sequential_time = time.time() - t_start
+
+for max_batch_tokens in [2048, 8192]:
+    t_start = time.time()
+    batched = predict_fn({"text": documents, "parameters": dict(parameters), "max_batch_tokens": max_batch_tokens}, model_and_tokenizer)["text"]
+    batched_time = time.time() - t_start
+    matches = sum(expected == actual for expected, actual in zip(one_by_one, batched))
+    assert len(batched) == len(documents) and matches >= 0.99 * len(documents), f"only {matches} of {len(documents)} outputs match"
+    print(f"max_batch_tokens={max_batch_tokens}: {len(documents) / batched_time:.0f} documents/s batched vs "
+          f"{len(documents) / sequential_time:.0f} documents/s one at a time, {matches}/{len(documents)} identical")
+print("seq2seq batch test passed.")
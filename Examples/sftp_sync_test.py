@@ -0,0 +1,134 @@
+import os
+import socket
+import filecmp
+import tempfile
+import threading
+import subprocess
+import paramiko
+from sagemode.Helpers.UploadToRemote import sync_directory, partial_suffix
+
+# runs a small SSH server (password auth, exec and sftp, all rooted in a temporary directory) in this process and syncs a
+# model directory to it: a first upload, a no-op resync, a one-file change, a resumed partial upload and a corrupt partial upload
+remote_root = tempfile.mkdtemp()
+
+class Server(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        def run():
+            result = subprocess.run(command.decode(), shell=True, cwd=remote_root, capture_output=True)
+            channel.sendall(result.stdout)
+            channel.sendall_stderr(result.stderr)
+            channel.send_exit_status(result.returncode)
+            channel.close()
+        threading.Thread(target=run, daemon=True).start()
+        return True
+
+class LocalHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+
+    def local(self, path):
+        return os.path.join(remote_root, path.lstrip("/"))
+
+    def open(self, path, flags, attr):
+        if flags & os.O_TRUNC or flags & os.O_CREAT and not os.path.exists(self.local(path)):
+            mode = "w+b"
+        else:
+            mode = "r+b" if flags & (os.O_WRONLY | os.O_RDWR) else "rb"
+        handle = LocalHandle(flags)
+        handle.readfile = handle.writefile = open(self.local(path), mode)
+        return handle
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+
+    lstat = stat
+
+    def posix_rename(self, oldpath, newpath):
+        os.replace(self.local(oldpath), self.local(newpath))
+        return paramiko.SFTP_OK
+
+def serve(listener):
+    host_key = paramiko.RSAKey.generate(2048)
+    while True:
+        connection, _ = listener.accept()
+        transport = paramiko.Transport(connection)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSFTP)
+        transport.start_server(server=Server())
+
+listener = socket.socket()
+listener.bind(("127.0.0.1", 0))
+listener.listen()
+threading.Thread(target=serve, args=(listener,), daemon=True).start()
+
+ssh_client = paramiko.SSHClient()
+ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+ssh_client.connect("127.0.0.1", listener.getsockname()[1], username="ec2-user", password="test", allow_agent=False, look_for_keys=False)
+transport = ssh_client.get_transport()
+
+local_directory = os.path.join(tempfile.mkdtemp(), "EC2InferenceLocal")
+os.makedirs(os.path.join(local_directory, "hf_model", "tokenizer"))
+for relative_path, size in [("weights.pth", 64 * 1024 ** 2), ("hf_model/model.safetensors", 32 * 1024 ** 2),
+                            ("hf_model/tokenizer/vocab.json", 4096), ("main.py", 2048), ("server_config.json", 64)]:
+    with open(os.path.join(local_directory, relative_path), "wb") as local_file:
+        local_file.write(os.urandom(size))
+remote_directory = "EC2Inference"
+
+def check_remote():
+    comparison = filecmp.dircmp(local_directory, os.path.join(remote_root, remote_directory))
+    def identical(comparison):
+        return not comparison.left_only and not comparison.diff_files and all(identical(sub) for sub in comparison.subdirs.values())
+    assert identical(comparison), "the remote directory does not match the local one"
+    for root, dirs, files in os.walk(local_directory):
+        for file in files:
+            remote_path = os.path.join(remote_root, remote_directory, os.path.relpath(os.path.join(root, file), local_directory))
+            assert filecmp.cmp(os.path.join(root, file), remote_path, shallow=False)
+
+report = sync_directory(local_directory, remote_directory, transport)
+assert report["files_sent"] == 5
+check_remote()
+
+report = sync_directory(local_directory, remote_directory, transport)
+assert report["files_sent"] == 0 and report["files_skipped"] == 5
+
+with open(os.path.join(local_directory, "main.py"), "wb") as local_file:
+    local_file.write(os.urandom(2048))
+report = sync_directory(local_directory, remote_directory, transport)
+assert report["files_sent"] == 1
+check_remote()
+
+# an interrupted upload of new weights left its first 24 MB behind, only the rest is sent
+new_weights = os.urandom(64 * 1024 ** 2)
+with open(os.path.join(local_directory, "weights.pth"), "wb") as local_file:
+    local_file.write(new_weights)
+with open(os.path.join(remote_root, remote_directory, "weights.pth" + partial_suffix), "wb") as partial_file:
+    partial_file.write(new_weights[:24 * 1024 ** 2])
+report = sync_directory(local_directory, remote_directory, transport)
+assert report["files_sent"] == 1 and abs(report["mb_sent"] - 40) < 0.01, report
+check_remote()
+
+# a partial file that does not match the local file is sent again from the start
+with open(os.path.join(local_directory, "weights.pth"), "wb") as local_file:
+    local_file.write(os.urandom(64 * 1024 ** 2))
+with open(os.path.join(remote_root, remote_directory, "weights.pth" + partial_suffix), "wb") as partial_file:
+    partial_file.write(os.urandom(8 * 1024 ** 2))
+report = sync_directory(local_directory, remote_directory, transport)
+assert report["files_sent"] == 1 and abs(report["mb_sent"] - 64) < 0.01, report
+check_remote()
+assert not os.path.exists(os.path.join(remote_root, remote_directory, "weights.pth" + partial_suffix))
+
+ssh_client.close()
+print("Delta sync, directory structure, resume and throughput report all passed.")
@@ -0,0 +1,59 @@
+import time
+import random
+import tempfile
+import torch
+from tiny_model import save_tiny_causal_lm
+from sagemode.InferenceFiles.HFSageMaker.AutoModelForCausalLM import model_fn, predict_fn, output_fn
+from sagemode.Helpers.EventStream import iter_sse_tokens
+
+# runs the streaming path of the causal LM inference file locally against a tiny random model.
+# run this from the Examples folder so that tiny_model.py can be imported.
+model_dir = tempfile.mkdtemp()
+save_tiny_causal_lm(model_dir)
+model, tokenizer = model_and_tokenizer = model_fn(model_dir)
+
+prompt = "It was a dark and stormy night"
+parameters = {"max_new_tokens": 40}
+# the first forward pass pays for allocator and kernel setup, keep it out of the measurement
+list(predict_fn({"inputs": prompt, "parameters": {"max_new_tokens": 1}, "stream": True}, model_and_tokenizer))
+
+t_start = time.time()
+time_to_first_token = None
+streamed = []
+for token in predict_fn({"inputs": prompt, "parameters": parameters, "stream": True}, model_and_tokenizer):
+    if time_to_first_token is None:
+        time_to_first_token = time.time() - t_start
+    streamed.append(token)
+total_time = time.time() - t_start
+print(f"streamed {len(streamed)} pieces. Time to first token: {time_to_first_token * 1000:.1f} ms, total: {total_time * 1000:.1f} ms")
+
+# greedy streaming has to produce exactly what generate() produces
+input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+with torch.no_grad():
+    generated = model.generate(input_ids, max_new_tokens=parameters["max_new_tokens"], do_sample=False, pad_token_id=tokenizer.eos_token_id)
+expected = tokenizer.decode(generated[0, input_ids.shape[1]:], skip_special_tokens=True)
+assert "".join(streamed) == expected, f"streamed text {''.join(streamed)!r} does not match generate() output {expected!r}"
+
+# the server-sent events body has to survive being cut into arbitrary chunks on its way to the client
+body = output_fn(predict_fn({"inputs": prompt, "parameters": parameters, "stream": True}, model_and_tokenizer), "text/event-stream").encode()
+cuts = sorted(random.sample(range(1, len(body)), 10))
+chunks = [body[start:end] for start, end in zip([0] + cuts, cuts + [len(body)])]
+assert "".join(iter_sse_tokens(chunks)) == expected
+
+# sampled output often stops in the middle of a multi-byte character, what was held back has to come out at the end
+from sagemode.InferenceFiles.HFSageMaker.AutoModelForCausalLM import generate_tokens
+sampling = {"max_new_tokens": 7, "do_sample": True}
+input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+held_back = 0
+for seed in range(20):
+    torch.manual_seed(seed)
+    tokens = list(generate_tokens(input_ids, sampling, model, tokenizer))
+    torch.manual_seed(seed)
+    pieces = list(predict_fn({"inputs": prompt, "parameters": sampling, "stream": True}, model_and_tokenizer))
+    assert "".join(pieces) == tokenizer.decode(tokens, skip_special_tokens=True), (pieces, tokens)
+    held_back += tokenizer.decode(tokens, skip_special_tokens=True).endswith("\ufffd")
+print(f"{held_back} of 20 sampled outputs ended in an incomplete character")
+
+sampled = predict_fn({"inputs": prompt, "parameters": {"max_new_tokens": 20, "do_sample": True, "top_k": 50, "top_p": 0.9}, "stream": True}, model_and_tokenizer)
+print("sampled:", repr("".join(sampled)))
+print("streaming test passed.")
@@ -0,0 +1,43 @@
+import os
+import base64
+import importlib.util
+import numpy as np
+import torch
+from sagemode.Helpers.TensorTransport import encode_tensors, decode_tensors, from_lambda_payload
+
+# the client (Helpers/TensorTransport.py, numpy only) and the EC2 server (server/transport.py, torch) have to read each other's bodies
+server_transport_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SageMode", "InferenceFiles", "PyTorchEC2", "server", "transport.py")
+spec = importlib.util.spec_from_file_location("transport", server_transport_path)
+server_transport = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server_transport)
+
+# server -> client, bfloat16 comes back as float32 with the same values
+response = {"logits": torch.randn(3, 5, dtype=torch.bfloat16), "probabilities": torch.rand(2, 7), "ids": torch.arange(6).reshape(2, 3),
+            "empty": torch.empty(0, 4, dtype=torch.bfloat16), "label": "cat"}
+decoded = decode_tensors(server_transport.encode(response))
+assert decoded["logits"].dtype == np.float32 and decoded["logits"].shape == (3, 5)
+assert np.array_equal(decoded["logits"], response["logits"].float().numpy()), "bfloat16 values changed on the way to the client"
+assert np.array_equal(decoded["probabilities"], response["probabilities"].numpy())
+assert np.array_equal(decoded["ids"], response["ids"].numpy())
+assert decoded["empty"].shape == (0, 4) and decoded["label"] == "cat"
+
+# the same body survives the base64 lambda hop
+lambda_decoded = from_lambda_payload({"body_base64": base64.b64encode(server_transport.encode(response)).decode()})
+assert np.array_equal(lambda_decoded["logits"], decoded["logits"])
+
+# client -> server
+request = {"tensor": np.arange(12, dtype=np.float32).reshape(3, 4), "mask": np.array([True, False, True]), "none": np.zeros((2, 0)),
+           "text": "hello"}
+server_decoded = server_transport.decode(encode_tensors(request))
+assert torch.equal(server_decoded["tensor"], torch.from_numpy(request["tensor"])) and server_decoded["text"] == "hello"
+assert server_decoded["mask"].tolist() == [True, False, True] and server_decoded["none"].shape == (2, 0)
+
+# torch tensors from the client, bfloat16 is sent as its raw bits and arrives as bfloat16
+request = {"hidden": torch.randn(4, 3, dtype=torch.bfloat16, requires_grad=True), "empty": torch.empty(0, 2, dtype=torch.bfloat16),
+           "transposed": torch.arange(6, dtype=torch.float32).reshape(2, 3).t()}
+server_decoded = server_transport.decode(encode_tensors(request))
+assert server_decoded["hidden"].dtype == torch.bfloat16 and torch.equal(server_decoded["hidden"], request["hidden"].detach())
+assert server_decoded["empty"].dtype == torch.bfloat16 and server_decoded["empty"].shape == (0, 2)
+assert torch.equal(server_decoded["transposed"], request["transposed"])
+assert np.array_equal(decode_tensors(encode_tensors(request))["hidden"], request["hidden"].detach().float().numpy())
+print("Tensor transport round trips, including bfloat16, passed.")
@@ -0,0 +1,74 @@
+import os
+import sys
+import shutil
+import tempfile
+import torch
+from safetensors import safe_open
+from transformers import AutoModelForCausalLM
+from tiny_model import save_tiny_causal_lm
+from sagemode.Helpers.ConvertWeights import convert_to_safetensors
+
+# a model whose output layer is tied to its embedding is converted to safetensors and loaded again, through the EC2 server's
+# loading.py and through transformers: the tied tensor is stored once, the loaded model shares one Parameter and gives the same
+# outputs. run this from the Examples folder so that tiny_model.py can be imported.
+model_source = '''import torch
+
+class TiedModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(1000, 64)
+        self.hidden = torch.nn.Linear(64, 64)
+        self.head = torch.nn.Linear(64, 1000, bias=False)
+        self.head.weight = self.embedding.weight
+
+    def forward(self, input_ids):
+        return self.head(torch.relu(self.hidden(self.embedding(input_ids))))
+
+model = TiedModel()
+'''
+
+server_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SageMode", "InferenceFiles", "PyTorchEC2", "server")
+work_directory = tempfile.mkdtemp()
+shutil.copy(os.path.join(server_directory, "loading.py"), work_directory)
+shutil.copy(os.path.join(os.path.dirname(os.path.dirname(server_directory)), "onnx_model.py"), work_directory)
+with open(os.path.join(work_directory, "model.py"), "w") as model_file:
+    model_file.write(model_source)
+sys.path.insert(0, work_directory)
+from model import model as original
+from loading import load_model
+
+torch.save(original.state_dict(), os.path.join(work_directory, "weights.pth"))
+convert_to_safetensors(os.path.join(work_directory, "weights.pth"), os.path.join(work_directory, "weights.safetensors"))
+with safe_open(os.path.join(work_directory, "weights.safetensors"), framework="pt") as weights_file:
+    assert sorted(weights_file.keys()) == ["embedding.weight", "hidden.bias", "hidden.weight"], weights_file.keys()
+
+cwd = os.getcwd()
+os.chdir(work_directory)
+sys.modules.pop("model")
+loaded = load_model("weights.safetensors")
+os.chdir(cwd)
+assert loaded.head.weight is loaded.embedding.weight, "the output layer is no longer tied to the embedding"
+assert not loaded.head.weight.is_meta
+input_ids = torch.randint(0, 1000, (2, 7))
+with torch.no_grad():
+    assert torch.equal(loaded(input_ids), original(input_ids))
+
+# transformers reads the converted file, and ties lm_head to the embedding that was stored once
+model_dir = tempfile.mkdtemp()
+save_tiny_causal_lm(model_dir)
+hf_original = AutoModelForCausalLM.from_pretrained(model_dir).eval()
+assert hf_original.lm_head.weight is hf_original.get_input_embeddings().weight
+for name in os.listdir(model_dir):
+    if name.endswith(".safetensors") or name.endswith(".bin"):
+        os.remove(os.path.join(model_dir, name))
+torch.save(hf_original.state_dict(), os.path.join(model_dir, "pytorch_model.bin"))
+convert_to_safetensors(os.path.join(model_dir, "pytorch_model.bin"), os.path.join(model_dir, "model.safetensors"))
+os.remove(os.path.join(model_dir, "pytorch_model.bin"))
+hf_loaded = AutoModelForCausalLM.from_pretrained(model_dir).eval()
+assert hf_loaded.lm_head.weight is hf_loaded.get_input_embeddings().weight
+with torch.no_grad():
+    assert torch.equal(hf_loaded(input_ids % hf_loaded.config.vocab_size).logits, hf_original(input_ids % hf_original.config.vocab_size).logits)
+
+shutil.rmtree(work_directory)
+shutil.rmtree(model_dir)
+print("Tied weights are stored once and tied again by loading.py and by transformers.")
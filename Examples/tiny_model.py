@@ -0,0 +1,41 @@
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import GPT2Config, GPT2LMHeadModel, T5Config, T5ForConditionalGeneration, PreTrainedTokenizerFast
+
+corpus = [
+    "It was a dark and stormy night; the rain fell in torrents.",
+    "The quick brown fox jumps over the lazy dog.",
+    "SageMode deploys machine learning models to AWS with a few lines of code.",
+    "Caffè, naïve and résumé keep multi-byte characters in the vocabulary.",
+]
+
+def train_tokenizer(special_tokens:list[str]) -> Tokenizer:
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=400, special_tokens=special_tokens, initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus * 10, trainer)
+    return tokenizer
+
+def save_tiny_causal_lm(model_dir:str, seed:int=0) -> None:
+    # a randomly initialized GPT-2 with a byte level tokenizer trained on a few sentences, small enough to run anywhere offline
+    tokenizer = train_tokenizer(["<|endoftext|>"])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|endoftext|>", eos_token="<|endoftext|>", pad_token="<|endoftext|>")
+    tokenizer.save_pretrained(model_dir)
+
+    import torch
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=256, n_embd=64, n_layer=2, n_head=4,
+                        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    GPT2LMHeadModel(config).save_pretrained(model_dir)
+
+def save_tiny_seq2seq_lm(model_dir:str, seed:int=0) -> None:
+    # a randomly initialized T5 with the same kind of tokenizer, padding and end of sequence are separate tokens like in real T5 checkpoints
+    tokenizer = train_tokenizer(["<pad>", "</s>"])
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="</s>", pad_token="<pad>", model_max_length=512)
+    tokenizer.save_pretrained(model_dir)
+
+    import torch
+    torch.manual_seed(seed)
+    config = T5Config(vocab_size=len(tokenizer), d_model=64, d_kv=16, d_ff=128, num_layers=2, num_heads=4,
+                      pad_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id, decoder_start_token_id=tokenizer.pad_token_id)
+    T5ForConditionalGeneration(config).save_pretrained(model_dir)
@@ -0,0 +1,44 @@
+import sys
+import time
+import json
+import statistics
+from sagemode.Types.Arn import LambdaArn
+
+# compares use() latency through the lambda function and directly against the endpoint for an existing deployment.
+# python transport_latency_benchmark.py <hf|pytorch-sagemaker|ec2> <lambda function arn> [iterations] ['{"text": "..."}']
+# the direct SageMaker transport needs sagemaker:InvokeEndpoint, the direct EC2 transport needs the server port open to this machine
+kind, function_arn = sys.argv[1], LambdaArn(sys.argv[2])
+iterations = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+data = json.loads(sys.argv[4]) if len(sys.argv) > 4 else {"text": "It was a dark and stormy night...", "parameters": None}
+
+if kind == "hf":
+    from sagemode.ResourceUser.HFSageMakerResourceUser import HFSageMakerResourceUser
+    user = HFSageMakerResourceUser("ml.m5.xlarge", lambda_arn=function_arn)
+elif kind == "pytorch-sagemaker":
+    from sagemode.ResourceUser.PyTorchSageMakerResourceUser import PyTorchSageMakerResourceUser
+    user = PyTorchSageMakerResourceUser("ml.m5.xlarge", lambda_arn=function_arn)
+elif kind == "ec2":
+    from sagemode.ResourceUser.PyTorchEC2ResourceUser import PyTorchEC2ResourceUser
+    user = PyTorchEC2ResourceUser("t2.micro", lambda_function_arn=function_arn)
+else:
+    raise ValueError("The first argument must be 'hf', 'pytorch-sagemaker' or 'ec2'.")
+
+results = {}
+for transport in ["lambda", "direct"]:
+    user.set_transport(transport)
+    t_start = time.perf_counter()
+    user.use(data)
+    first_call = (time.perf_counter() - t_start) * 1000
+    latencies = []
+    for _ in range(iterations):
+        t_start = time.perf_counter()
+        user.use(data)
+        latencies.append((time.perf_counter() - t_start) * 1000)
+    results[transport] = (first_call, sorted(latencies))
+
+print(f"{iterations} calls per transport after one first call:")
+for transport, (first_call, latencies) in results.items():
+    print(f"  {transport:>6}: first {first_call:.1f} ms, mean {statistics.mean(latencies):.1f} ms, p50 {latencies[len(latencies) // 2]:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)]:.1f} ms")
+saved = statistics.mean(results["lambda"][1]) - statistics.mean(results["direct"][1])
+print(f"The direct transport saves {saved:.1f} ms per call on average.")
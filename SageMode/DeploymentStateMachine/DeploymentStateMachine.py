@@ -38,6 +38,10 @@ class DeploymentStateMachine(ResourceUser):
         if self.step_function_arn:
             raise ValueError("This object cannot call deploy() if it aiready has a step function arn. Set 'self.step_function_arn = None' and try again.")
 
+        if self.payload_offloader and not all(resource_user.resolves_payloads for resource_user in resource_users):
+            print("A stage of this state machine cannot read payloads offloaded to S3, requests are sent inline.")
+            self.payload_offloader = None
+
         if comment:
             self.state_machine_definition["comment"] = comment
         
@@ -76,6 +80,9 @@ class DeploymentStateMachine(ResourceUser):
             raise ValueError("You did not deploy your state machine.")
         
         self.check_input(data)
+        if self.payload_offloader:
+            # every stage reads the fields it needs from S3 and hands its large outputs to the next stage the same way
+            data = self.payload_offloader.offload(data)
         response = self.step_function_client.start_execution(
             stateMachineArn=self.state_machine_arn,
             input=json.dumps(data)
@@ -91,6 +98,8 @@ class DeploymentStateMachine(ResourceUser):
                 includeExecutionData=True
             )['events'][0]['executionSucceededEventDetails']['output']            
             output = json.loads(output)
+            if self.payload_offloader:
+                output = self.payload_offloader.resolve(output)
             self.check_output(output)
             return output
         else:
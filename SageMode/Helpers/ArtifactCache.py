@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import hashlib
+from sagemode.Helpers.ParallelGzip import split_layers
+from sagemode.Helpers.S3Stream import min_part_size
+
+# model archives are uploaded under a key that contains the digest of the staged model directory, so an archive that is
+# already in the bucket is found with one head_object call. the index keeps every file's sha256 together with its size and
+# mtime, so unchanged multi-GB weights are not read again on the next deploy. archives start with a data layer (weights, configs)
+# and end with a code layer, the index remembers where the data layer of each archive ends, so a deploy that only changed
+# code copies that layer inside S3 instead of compressing and uploading the weights again
+index_path = os.path.join(os.path.expanduser("~"), ".sagemode", "artifact_index.json")
+digest_metadata_key = "sagemode-digest"
+
+def load_index() -> dict:
+    if not os.path.exists(index_path):
+        return {"files": {}, "layers": {}}
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+    # indexes written before archives had layers
+    index.setdefault("layers", {})
+    return index
+
+def save_index(index:dict) -> None:
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    index["files"] = {path: entry for path, entry in index["files"].items() if os.path.exists(path)}
+    # written to a temporary file first, so an interrupted deploy never leaves a truncated index behind
+    temporary_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(temporary_path, index_path)
+
+def file_digest(path:str, index:dict) -> str:
+    stat = os.stat(path)
+    absolute_path = os.path.abspath(path)
+    cached = index["files"].get(absolute_path)
+    if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(8 * 1024 ** 2), b""):
+            sha256.update(chunk)
+    index["files"][absolute_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+    return sha256.hexdigest()
+
+def directory_digest(model_dir:str, index:dict, items:list[str] = None) -> str:
+    # the manifest lists every file's relative path, size and sha256, renaming or moving a file changes the digest too.
+    # items limits it to those top level entries of model_dir
+    manifest = []
+    for root, dirs, files in os.walk(model_dir):
+        dirs.sort()
+        if root == model_dir and items is not None:
+            dirs[:] = [directory for directory in dirs if directory in items]
+            files = [file for file in files if file in items]
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            relative_path = os.path.relpath(path, model_dir).replace(os.sep, "/")
+            manifest.append(f"{relative_path}\t{os.path.getsize(path)}\t{file_digest(path, index)}")
+    return hashlib.sha256("\n".join(manifest).encode()).hexdigest()
+
+def find_artifact(s3_client, bucket:str, key:str, digest:str) -> bool:
+    from botocore.exceptions import ClientError
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in ["404", "NoSuchKey", "NotFound"]:
+            return False
+        raise
+    # objects under the key that were not uploaded by the cache (or were cut short) are not trusted
+    return response.get("Metadata", {}).get(digest_metadata_key) == digest
+
+def cached_artifact_key(model_dir:str, output_file:str = "model.tar.gz") -> tuple[str, str, str]:
+    # returns the digest of model_dir, the digest of its data layer and the S3 key its archive is stored under
+    t_start = time.time()
+    index = load_index()
+    digest = directory_digest(model_dir, index)
+    data_digest = directory_digest(model_dir, index, split_layers(model_dir)[0])
+    save_index(index)
+    print(f"Hashed {os.path.basename(os.path.normpath(model_dir))}, digest {digest[:12]}. Time taken: {time.time() - t_start:.2f} seconds")
+    return digest, data_digest, f"{os.path.basename(os.path.normpath(model_dir))}/{digest}/{output_file}"
+
+def find_data_layer(s3_client, data_digest:str) -> dict:
+    # an earlier archive whose data layer can be copied, or None. layers under 5 MB cannot be a multipart copy and are cheap to rebuild
+    layer = load_index()["layers"].get(data_digest)
+    if layer is None or layer["bytes"] < min_part_size:
+        return None
+    bucket, key = layer["uri"][len("s3://"):].split("/", 1)
+    # the archive may have been deleted or replaced since, its digest is checked like any cached archive
+    if not find_artifact(s3_client, bucket, key, layer["digest"]):
+        return None
+    return {"bucket": bucket, "key": key, "bytes": layer["bytes"]}
+
+def record_artifact(digest:str, model_uri:str, data_digest:str, data_bytes:int) -> None:
+    # the newest archive with this data is the one least likely to have been cleaned up
+    if data_bytes == 0:
+        return
+    index = load_index()
+    index.pop("artifacts", None)
+    index["layers"][data_digest] = {"uri": model_uri, "digest": digest, "bytes": data_bytes}
+    save_index(index)
@@ -0,0 +1,59 @@
+import os
+import time
+import importlib.util
+import torch
+
+engine_files = {"torchscript": "model.ts", "onnx": "model.onnx"}
+
+def load_local_model(model_path:str, weight_path:str) -> torch.nn.Module:
+    # model.py defines a module level 'model', the same convention the inference servers use with 'from model import model'
+    spec = importlib.util.spec_from_file_location("sagemode_local_model", model_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    model = module.model
+    model.load_state_dict(torch.load(weight_path, map_location="cpu"))
+    model.eval()
+    return model
+
+def flatten_outputs(output) -> list[torch.Tensor]:
+    if isinstance(output, torch.Tensor):
+        return [output]
+    if isinstance(output, (tuple, list)):
+        return [tensor for item in output for tensor in flatten_outputs(item)]
+    if isinstance(output, dict):
+        return [tensor for item in output.values() for tensor in flatten_outputs(item)]
+    raise TypeError(f"Cannot compare a model output of type {type(output).__name__}.")
+
+def check_outputs(expected, actual, atol:float, rtol:float) -> None:
+    expected, actual = flatten_outputs(expected), [torch.as_tensor(tensor) for tensor in flatten_outputs(actual)]
+    if len(expected) != len(actual):
+        raise ValueError(f"The exported model returns {len(actual)} tensors but the original model returns {len(expected)}.")
+    for expected_tensor, actual_tensor in zip(expected, actual):
+        if expected_tensor.shape != actual_tensor.shape or not torch.allclose(expected_tensor, actual_tensor.to(expected_tensor.dtype), atol=atol, rtol=rtol):
+            max_difference = (expected_tensor - actual_tensor.to(expected_tensor.dtype)).abs().max().item() if expected_tensor.shape == actual_tensor.shape else float("nan")
+            raise ValueError(f"The exported model's outputs do not match the original model (max abs difference {max_difference:.3g}, atol {atol}, rtol {rtol}).")
+
+def export_model(model:torch.nn.Module, sample_input:torch.Tensor, engine:str, output_directory:str, atol:float=1e-4, rtol:float=1e-3) -> str:
+    if engine not in engine_files:
+        raise ValueError(f"'engine' must be one of {['eager'] + list(engine_files)}.")
+    t_start = time.time()
+    output_path = os.path.join(output_directory, engine_files[engine])
+    with torch.no_grad():
+        expected = model(sample_input)
+
+        if engine == "torchscript":
+            traced = torch.jit.freeze(torch.jit.trace(model, sample_input))
+            torch.jit.save(traced, output_path)
+            actual = torch.jit.load(output_path)(sample_input)
+        else:
+            import onnxruntime
+            torch.onnx.export(model, sample_input, output_path,
+                              input_names=["input"],
+                              dynamic_axes={"input": {0: "batch"}},
+                              opset_version=17)
+            session = onnxruntime.InferenceSession(output_path, providers=["CPUExecutionProvider"])
+            actual = session.run(None, {"input": sample_input.numpy()})
+
+    check_outputs(expected, actual, atol, rtol)
+    print(f"Exported the model with engine '{engine}' to '{output_path}' and verified its outputs. Time taken: {time.time() - t_start:.2f} seconds")
+    return output_path
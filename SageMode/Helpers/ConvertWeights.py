@@ -0,0 +1,40 @@
+import os
+import json
+import time
+import torch
+from safetensors.torch import save_file
+
+# the loading side (loading.py on the EC2 server) reads the aliases under the same key
+alias_metadata_key = "sagemode_aliases"
+
+def convert_to_safetensors(weight_path:str, output_path:str) -> None:
+    t_start = time.time()
+    state_dict = torch.load(weight_path, map_location="cpu")
+    if not isinstance(state_dict, dict) or not all(isinstance(value, torch.Tensor) for value in state_dict.values()):
+        raise ValueError(f"'{weight_path}' does not contain a state dict. Save your weights with torch.save(model.state_dict(), path) and try again.")
+
+    # safetensors refuses tensors that share memory. a tensor that is exactly another one (tied weights) is stored once under the
+    # first name and listed in the metadata, so the loader can tie it again. a view of part of another tensor gets its own copy
+    seen_tensors = {}
+    seen_storages = set()
+    aliases = {}
+    tensors = {}
+    for name, tensor in state_dict.items():
+        view = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tuple(tensor.stride()))
+        if tensor.numel() > 0 and view in seen_tensors:
+            aliases[name] = seen_tensors[view]
+            continue
+        storage = tensor.untyped_storage().data_ptr()
+        if storage in seen_storages:
+            tensor = tensor.clone()
+        seen_storages.add(storage)
+        seen_tensors[view] = name
+        tensors[name] = tensor.contiguous()
+
+    # transformers only reads safetensors files whose metadata names the framework
+    metadata = {"format": "pt"}
+    if aliases:
+        metadata[alias_metadata_key] = json.dumps(aliases)
+    save_file(tensors, output_path, metadata=metadata)
+    size_mb = os.path.getsize(output_path) / 1024 ** 2
+    print(f"Converted '{weight_path}' to safetensors ({size_mb:.1f} MB, {len(aliases)} tied tensors stored once). Time taken: {time.time() - t_start:.2f} seconds")
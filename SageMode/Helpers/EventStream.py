@@ -0,0 +1,47 @@
+import json
+
+def iter_sse_tokens(chunks):
+    # events can be split across chunks in any position, so bytes are buffered until a full event has arrived
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        while b"\n\n" in buffer:
+            event, buffer = buffer.split(b"\n\n", 1)
+            for line in event.decode("utf-8").splitlines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    return
+                event_data = json.loads(payload)
+                if "error" in event_data:
+                    raise RuntimeError(f"The model failed while streaming its response: {event_data['error']}")
+                yield event_data["token"]
+
+def stream_from_endpoint(runtime_client, endpoint_name:str, data:dict):
+    response = runtime_client.invoke_endpoint_with_response_stream(
+        EndpointName=endpoint_name,
+        ContentType="application/json",
+        Accept="text/event-stream",
+        Body=json.dumps({**data, "stream": True})
+    )
+
+    def payload_parts():
+        for event in response["Body"]:
+            if "PayloadPart" in event:
+                yield event["PayloadPart"]["Bytes"]
+            elif "ModelStreamError" in event or "InternalStreamFailure" in event:
+                raise RuntimeError(f"The endpoint {endpoint_name} failed while streaming its response: {event}")
+
+    yield from iter_sse_tokens(payload_parts())
+
+def stream_from_server(server_url:str, data:dict, timeout:float = 60):
+    # the EC2 LLM server sends each event as soon as it is generated
+    import requests
+    response = requests.post(server_url, json={**data, "stream": True}, headers={"Accept": "text/event-stream"}, stream=True, timeout=timeout)
+    response.raise_for_status()
+    if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+        response.close()
+        raise ValueError("The server did not stream its response, only servers deployed with deploy_llm can stream.")
+    with response:
+        yield from iter_sse_tokens(response.iter_content(chunk_size=None))
@@ -14,7 +14,7 @@ def copy_file_to_directory(file_name, destination_directory, new_name):
     # Create the new file path in the destination directory with the specified name
     new_file_path = os.path.join(destination_directory, new_name)
 
-    # Copy the contents of the file to the new location
-    shutil.copy(file_name, new_file_path)
+    # Copy the contents of the file to the new location, with its mtime, so the artifact cache does not hash an unchanged file again
+    shutil.copy2(file_name, new_file_path)
 
     print(f"File '{file_name}' copied to '{new_file_path}' successfully.")
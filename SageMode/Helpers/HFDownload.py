@@ -0,0 +1,70 @@
+import os
+import time
+import shutil
+from fnmatch import fnmatch
+from sagemode.Types.HFModels import resolve_model_type
+
+# files that no inference file loads: other frameworks' weights, exported or quantized copies and single-file checkpoints
+ignored_patterns = ["*.msgpack", "*.h5", "*.ot", "*.tflite", "*.onnx", "*.onnx_data", "*.gguf", "*.ckpt", "*.mlmodel", "*.md",
+                    "flax_model*", "tf_model*", "onnx/*", "coreml/*", "openvino/*", ".gitattributes"]
+# diffusers loads the default variant of every component from its subfolder
+ignored_diffusers_patterns = ["*.fp16.*", "*.non_ema.*", "*.ema.*"]
+weight_extensions = [".safetensors", ".bin"]
+index_suffix = ".index.json"
+
+def select_files(filenames:list[str], model_type:str) -> list[str]:
+    patterns = ignored_patterns + (ignored_diffusers_patterns if model_type == "StableDiffusionPipeline" else [])
+    selected = [name for name in filenames if not any(fnmatch(name, pattern) for pattern in patterns)]
+    if model_type == "StableDiffusionPipeline":
+        # weights in the repo root are single-file checkpoints, the pipeline reads its components from the subfolders
+        selected = [name for name in selected if "/" in name or not any(name.endswith(extension) for extension in weight_extensions)]
+
+    # transformers and diffusers prefer safetensors, so a folder that has them does not need its .bin copy
+    folders_with_safetensors = {os.path.dirname(name) for name in selected if name.endswith(".safetensors")}
+    def is_duplicate(name:str) -> bool:
+        if os.path.dirname(name) not in folders_with_safetensors:
+            return name.endswith(".safetensors" + index_suffix)
+        return name.endswith(".bin") or name.endswith(".bin" + index_suffix)
+    return [name for name in selected if not is_duplicate(name)]
+
+def link_or_copy(source:str, destination:str) -> None:
+    # the cache keeps each file once as a blob, a hardlink gives the model directory the same bytes without copying them.
+    # nothing edits files of the model directory in place, so the cached blobs stay intact
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    source = os.path.realpath(source)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # the cache is on another filesystem
+        shutil.copy2(source, destination)
+
+def download_model(model_id:str, local_dir:str, model_type:str = None) -> tuple[str, list[str]]:
+    # returns the model type and the files that were placed in local_dir
+    from huggingface_hub import HfApi, snapshot_download, try_to_load_from_cache
+    from huggingface_hub.utils import RepositoryNotFoundError, RevisionNotFoundError
+    t_start = time.time()
+    try:
+        info = HfApi().model_info(model_id, files_metadata=True)
+    except (RepositoryNotFoundError, RevisionNotFoundError):
+        raise ValueError("the model_id you have specified does not exist.")
+    sizes = {sibling.rfilename: sibling.size or 0 for sibling in info.siblings}
+
+    if model_type is None:
+        config_files = [name for name in ["config.json", "model_index.json"] if name in sizes]
+        config_dir = snapshot_download(model_id, revision=info.sha, allow_patterns=config_files)
+        model_type = resolve_model_type(config_dir)
+
+    selected = select_files(list(sizes), model_type)
+    cached = [name for name in selected if isinstance(try_to_load_from_cache(model_id, name, revision=info.sha), str)]
+    snapshot_dir = snapshot_download(model_id, revision=info.sha, allow_patterns=selected)
+    for name in selected:
+        link_or_copy(os.path.join(snapshot_dir, name), os.path.join(local_dir, name))
+
+    elapsed = time.time() - t_start
+    downloaded_mb = sum(sizes[name] for name in selected if name not in cached) / 1024 ** 2
+    selected_mb = sum(sizes[name] for name in selected) / 1024 ** 2
+    skipped_mb = sum(sizes.values()) / 1024 ** 2 - selected_mb
+    print(f"Huggingface model copied successfully. {len(selected)} of {len(sizes)} files ({selected_mb:.1f} MB) selected, "
+          f"{skipped_mb:.1f} MB of unused files skipped, {len(cached)} files reused from the cache, {downloaded_mb:.1f} MB downloaded "
+          f"at {downloaded_mb / max(elapsed, 1e-9):.1f} MB/s. Time taken: {elapsed:.2f} seconds")
+    return model_type, selected
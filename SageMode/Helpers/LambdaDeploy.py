@@ -0,0 +1,93 @@
+import io
+import os
+import time
+import base64
+import shutil
+import hashlib
+import zipfile
+import tempfile
+import subprocess
+
+# pip installs for the Lambda runtime are kept here, one folder per set of requirements and Python version
+dependency_cache_dir = os.path.join(os.path.expanduser("~"), ".sagemode", "lambda_dependencies")
+lambda_platform = "manylinux2014_x86_64"
+# a fixed timestamp makes the zip, and so its CodeSha256, depend only on the file contents
+zip_date_time = (1980, 1, 1, 0, 0, 0)
+
+def build_dependencies(requirements:list[str], python_version:str, python_pip_prefix:list[str] = ["pip"]) -> str:
+    if not requirements:
+        return None
+    key = hashlib.sha256("\n".join(sorted(requirements) + [python_version, lambda_platform]).encode()).hexdigest()[:16]
+    target_dir = os.path.join(dependency_cache_dir, f"python{python_version}-{key}")
+    if os.path.exists(target_dir):
+        print(f"Reusing the Lambda dependencies {requirements} for python{python_version} from {target_dir}.")
+        return target_dir
+
+    t_start = time.time()
+    os.makedirs(dependency_cache_dir, exist_ok=True)
+    # wheels for the Lambda runtime rather than for the local interpreter, so the cache key holds everything that decides the result
+    install_dir = tempfile.mkdtemp(dir=dependency_cache_dir)
+    subprocess.run(python_pip_prefix + ["install", *requirements, "-t", install_dir, "--platform", lambda_platform, "--only-binary=:all:",
+                                        "--python-version", python_version, "--implementation", "cp", "--quiet"], check=True)
+    try:
+        os.rename(install_dir, target_dir)
+    except OSError:
+        # another deploy built the same bundle in the meantime
+        shutil.rmtree(install_dir)
+    print(f"Installed the Lambda dependencies {requirements} for python{python_version}. Time taken: {time.time() - t_start:.2f} seconds")
+    return target_dir
+
+def build_zip(files:dict[str, str], dependency_dir:str = None) -> bytes:
+    # files maps the name inside the zip to a local path
+    entries = dict(files)
+    if dependency_dir is not None:
+        for root, dirs, dependency_files in os.walk(dependency_dir):
+            for file in dependency_files:
+                if file.endswith(".pyc"):
+                    continue
+                path = os.path.join(root, file)
+                entries.setdefault(os.path.relpath(path, dependency_dir).replace(os.sep, "/"), path)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zipped:
+        for arcname in sorted(entries):
+            info = zipfile.ZipInfo(arcname, zip_date_time)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(entries[arcname], "rb") as entry_file:
+                zipped.writestr(info, entry_file.read())
+    return buffer.getvalue()
+
+def code_sha256(zip_bytes:bytes) -> str:
+    # the form Lambda reports in CodeSha256
+    return base64.b64encode(hashlib.sha256(zip_bytes).digest()).decode()
+
+def deploy_function(lambda_client, function_name:str, zip_bytes:bytes, configuration:dict) -> str:
+    # configuration holds Runtime, Role, Handler, Timeout and Environment. an existing function is updated in place
+    # and only the parts that changed are sent, so redeploying the same code returns in about a second
+    from botocore.exceptions import ClientError
+    t_start = time.time()
+    try:
+        current = lambda_client.get_function(FunctionName=function_name)["Configuration"]
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "ResourceNotFoundException":
+            raise
+        current = None
+
+    if current is None:
+        response = lambda_client.create_function(FunctionName=function_name, Code={"ZipFile": zip_bytes}, **configuration)
+        lambda_client.get_waiter("function_active_v2").wait(FunctionName=function_name)
+        print(f"Created the Lambda function {function_name}. Time taken: {time.time() - t_start:.2f} seconds")
+        return response["FunctionArn"]
+
+    if current["CodeSha256"] != code_sha256(zip_bytes):
+        lambda_client.update_function_code(FunctionName=function_name, ZipFile=zip_bytes)
+        lambda_client.get_waiter("function_updated_v2").wait(FunctionName=function_name)
+        print(f"Updated the code of the Lambda function {function_name}.")
+    if any(current.get(name) != value for name, value in configuration.items() if name != "Environment") or \
+       current.get("Environment", {}).get("Variables", {}) != configuration.get("Environment", {}).get("Variables", {}):
+        lambda_client.update_function_configuration(FunctionName=function_name, **configuration)
+        lambda_client.get_waiter("function_updated_v2").wait(FunctionName=function_name)
+        print(f"Updated the configuration of the Lambda function {function_name}.")
+    print(f"The Lambda function {function_name} is up to date. Time taken: {time.time() - t_start:.2f} seconds")
+    return current["FunctionArn"]
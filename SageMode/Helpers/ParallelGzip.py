@@ -0,0 +1,125 @@
+import os
+import time
+import zlib
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# gzip files may hold several members back to back, and every gzip reader (tarfile, GNU tar, the SageMaker containers)
+# reads them as one stream. Each block is compressed as its own member, so blocks compress in parallel
+# (zlib releases the GIL) and the output is still an ordinary model.tar.gz
+default_block_size = 16 * 1024 ** 2
+
+def compress_block(block:bytes, level:int) -> bytes:
+    # wbits=31 writes a gzip header and trailer around the deflate stream, the header's mtime is 0 so equal input gives equal output
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+class ParallelGzipWriter:
+    # a write-only file object, level 0 stores the data without compressing it (for safetensors and other dense weights)
+
+    def __init__(self, fileobj, level:int = 6, workers:int = None, block_size:int = default_block_size):
+        if not 0 <= level <= 9:
+            raise ValueError("'level' must be between 0 (store only) and 9.")
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        # sched_getaffinity respects CPU pinning but only exists on Linux, deploys from macOS and Windows count every core
+        self.workers = workers or (len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block:bytes) -> None:
+        self.bytes_in += len(block)
+        self.pending.append(self.pool.submit(compress_block, block, self.level))
+        # members are written in order, and at most two blocks per thread are held in memory
+        while len(self.pending) > 2 * self.workers:
+            self.write_member()
+
+    def write_member(self) -> None:
+        member = self.pending.popleft().result()
+        self.fileobj.write(member)
+        self.bytes_out += len(member)
+
+    def tell(self) -> int:
+        # tarfile asks where the archive starts, the uncompressed position is all it needs
+        return self.bytes_in + len(self.buffer)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        if self.buffer or self.bytes_in == 0:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.write_member()
+        self.pool.shutdown()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # an incomplete archive is not worth finishing, the destination is left to its owner to discard
+            self.pool.shutdown(cancel_futures=True)
+            self.closed = True
+
+def is_code(item:str) -> bool:
+    # code/ and loose python files change on most deploys, weights and configs rarely do
+    return item == "code" or item.endswith(".py") or item == "requirements.txt"
+
+def split_layers(source_dir:str) -> tuple[list[str], list[str]]:
+    # the top level entries of source_dir, as the data layer and the code layer
+    items = sorted(os.listdir(source_dir))
+    return [item for item in items if not is_code(item)], [item for item in items if is_code(item)]
+
+def write_layer(source_dir:str, items:list[str], fileobj, level:int, workers:int, last:bool) -> tuple[int, int]:
+    with ParallelGzipWriter(fileobj, level, workers) as writer:
+        # mode "w" writes every entry straight through, so a layer that is not the last one can stop without the end of archive blocks.
+        # dereference stores the content of links, hardlinks from the HF cache would otherwise become link entries
+        tar = tarfile.open(fileobj=writer, mode="w", dereference=True)
+        for item in items:
+            tar.add(os.path.join(source_dir, item), arcname=item)
+        if last:
+            tar.close()
+    return writer.bytes_in, writer.bytes_out
+
+def write_tar_gz(source_dir:str, fileobj, level:int = 6, workers:int = None, skip_data:bool = False) -> tuple[int, int, int]:
+    # the entries of source_dir become the top level of the archive, as SageMaker expects, without changing the working directory.
+    # the data layer and the code layer are separate runs of gzip members, so a later archive can reuse the bytes of the data layer
+    # as they are and only compress its code. returns the bytes read, the bytes written and the size of the data layer in the archive.
+    # skip_data only writes the code layer, for a fileobj that already holds an earlier data layer
+    data_items, code_items = split_layers(source_dir)
+    bytes_in, bytes_out, data_bytes = 0, 0, 0
+    if data_items and not skip_data:
+        bytes_in, data_bytes = write_layer(source_dir, data_items, fileobj, level, workers, last=False)
+        bytes_out = data_bytes
+    code_bytes_in, code_bytes_out = write_layer(source_dir, code_items, fileobj, level, workers, last=True)
+    return bytes_in + code_bytes_in, bytes_out + code_bytes_out, data_bytes
+
+def compress_directory(source_dir:str, output_file:str, level:int = 6, workers:int = None) -> int:
+    # returns the size of the data layer in the archive
+    t_start = time.time()
+    with open(output_file, "wb") as output:
+        bytes_in, bytes_out, data_bytes = write_tar_gz(source_dir, output, level, workers)
+    elapsed = time.time() - t_start
+    print(f"compression finished successfully. {bytes_in / 1024 ** 2:.1f} MB -> {bytes_out / 1024 ** 2:.1f} MB at level {level}, "
+          f"{bytes_in / 1024 ** 2 / max(elapsed, 1e-9):.1f} MB/s. Time taken: {elapsed:.2f} seconds")
+    return data_bytes
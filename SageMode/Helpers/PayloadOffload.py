@@ -0,0 +1,77 @@
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+# client side of the S3 claim check read by InferenceFiles/payload_offload.py. lambda payloads are capped at 6 MB and
+# Step Functions inputs and state transitions at 256 KB, so fields above the threshold go to S3 and only a reference is sent
+reference_key = "$sagemode_s3"
+settings_key = "_sagemode_offload"
+default_threshold = 64 * 1024
+default_prefix = "sagemode-payloads"
+lifecycle_rule_id = "sagemode-payload-expiry"
+
+def is_reference(value) -> bool:
+    return isinstance(value, dict) and reference_key in value
+
+def ensure_expiry_rule(s3_client, bucket:str, prefix:str = default_prefix, days:int = 1) -> None:
+    # the bucket's other lifecycle rules are kept, put_bucket_lifecycle_configuration replaces the whole configuration
+    try:
+        rules = s3_client.get_bucket_lifecycle_configuration(Bucket=bucket)["Rules"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            raise
+        rules = []
+    rule = {"ID": lifecycle_rule_id, "Filter": {"Prefix": f"{prefix}/"}, "Status": "Enabled", "Expiration": {"Days": days}}
+    if rule in rules:
+        return
+    rules = [existing_rule for existing_rule in rules if existing_rule.get("ID") != lifecycle_rule_id] + [rule]
+    s3_client.put_bucket_lifecycle_configuration(Bucket=bucket, LifecycleConfiguration={"Rules": rules})
+    print(f"Objects under s3://{bucket}/{prefix}/ now expire after {days} day(s).")
+
+class PayloadOffloader:
+
+    def __init__(self, s3_client, bucket:str, threshold:int = default_threshold, prefix:str = default_prefix, expiry_days:int = 1):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.threshold = threshold
+        self.prefix = prefix
+        self.expiry_days = expiry_days
+        # created up front, the handlers write large outputs under the same prefix even when no input was offloaded
+        ensure_expiry_rule(s3_client, bucket, prefix, expiry_days)
+
+    def settings(self) -> dict:
+        return {"bucket": self.bucket, "prefix": self.prefix, "threshold": self.threshold}
+
+    def offload(self, data:dict) -> dict:
+        # the settings are always sent, so the handlers can offload large outputs even when every input field is small
+        offloaded = {}
+        for name, value in data.items():
+            if not is_reference(value):
+                body = json.dumps(value, separators=(",", ":")).encode()
+                if len(body) >= self.threshold:
+                    key = f"{self.prefix}/{uuid.uuid4().hex}/{name}.json"
+                    self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body, ContentType="application/json")
+                    value = {reference_key: f"s3://{self.bucket}/{key}", "bytes": len(body)}
+            offloaded[name] = value
+        offloaded[settings_key] = self.settings()
+        return offloaded
+
+    def fetch(self, reference:dict):
+        # outputs are only read back from where this offloader and the handlers write them
+        bucket, key = reference[reference_key][len("s3://"):].split("/", 1)
+        if bucket != self.bucket or not key.startswith(f"{self.prefix}/"):
+            raise ValueError(f"The reference {reference[reference_key]} is outside s3://{self.bucket}/{self.prefix}/.")
+        return json.loads(self.s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+
+    def resolve(self, output):
+        if not isinstance(output, dict):
+            return output
+        output = {name: value for name, value in output.items() if name != settings_key}
+        references = [name for name, value in output.items() if is_reference(value)]
+        if references:
+            # several referenced fields are downloaded in parallel
+            with ThreadPoolExecutor(max_workers=min(len(references), 8)) as executor:
+                for name, value in zip(references, executor.map(self.fetch, [output[name] for name in references])):
+                    output[name] = value
+        return output
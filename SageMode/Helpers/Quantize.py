@@ -0,0 +1,116 @@
+import io
+import os
+import json
+import time
+from typing import Callable
+import torch
+
+quantization_methods = ["dynamic", "static"]
+# dynamic quantization stores these layers' weights as int8 and quantizes activations on the fly
+dynamic_modules = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}
+hf_quantization_file = "sagemode_quantization.json"
+
+def serialized_size_mb(model) -> float:
+    buffer = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 ** 2
+
+def quantize_model(model:torch.nn.Module, method:str, sample_input:torch.Tensor, calibrate:Callable[[torch.nn.Module], None] = None) -> torch.nn.Module:
+    if method not in quantization_methods:
+        raise ValueError(f"'quantize' must be one of {quantization_methods}.")
+    from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+    model = model.eval()
+    if method == "dynamic":
+        return quantize_dynamic(model, dynamic_modules, dtype=torch.qint8)
+
+    if calibrate is None:
+        raise ValueError("Static quantization needs a 'calibrate' callable that runs the prepared model on representative inputs.")
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    # activation ranges are observed while calibrate runs, then baked into the int8 kernels
+    prepared = prepare_fx(model, get_default_qconfig_mapping(torch.backends.quantized.engine), (sample_input,))
+    with torch.no_grad():
+        calibrate(prepared)
+    return convert_fx(prepared)
+
+def mean_latency_ms(model, samples:list) -> float:
+    t_start = time.perf_counter()
+    with torch.no_grad():
+        for sample in samples:
+            model(sample)
+    return (time.perf_counter() - t_start) * 1000 / len(samples)
+
+def compare_models(original:torch.nn.Module, quantized:torch.nn.Module, samples:list[torch.Tensor]) -> dict:
+    from sagemode.Helpers.CompileModel import flatten_outputs
+    max_difference, total_difference, values, agreements, rows = 0.0, 0.0, 0, 0, 0
+    with torch.no_grad():
+        for sample in samples:
+            for expected, actual in zip(flatten_outputs(original(sample)), flatten_outputs(quantized(sample))):
+                difference = (expected.float() - actual.float()).abs()
+                max_difference = max(max_difference, difference.max().item())
+                total_difference += difference.sum().item()
+                values += difference.numel()
+                # for classifier style outputs the share of rows whose top prediction is unchanged is the number that matters
+                if expected.dim() >= 2 and expected.is_floating_point():
+                    agreements += (expected.argmax(dim=-1) == actual.argmax(dim=-1)).sum().item()
+                    rows += expected.argmax(dim=-1).numel()
+
+    report = {"fp32_size_mb": serialized_size_mb(original),
+              "int8_size_mb": serialized_size_mb(quantized),
+              "fp32_latency_ms": mean_latency_ms(original, samples),
+              "int8_latency_ms": mean_latency_ms(quantized, samples),
+              "max_abs_difference": max_difference,
+              "mean_abs_difference": total_difference / max(values, 1),
+              "top1_agreement": agreements / rows if rows else None}
+    print(f"Quantization report over {len(samples)} samples:")
+    print(f"  size: {report['fp32_size_mb']:.2f} MB -> {report['int8_size_mb']:.2f} MB")
+    print(f"  latency: {report['fp32_latency_ms']:.2f} ms -> {report['int8_latency_ms']:.2f} ms per sample")
+    print(f"  max abs difference: {report['max_abs_difference']:.4g}, mean abs difference: {report['mean_abs_difference']:.4g}")
+    if report["top1_agreement"] is not None:
+        print(f"  top-1 agreement: {report['top1_agreement']:.2%}")
+    return report
+
+def quantize_hf_model(model_dir:str, model_type:str, samples:list[str], max_new_tokens:int = 20) -> dict:
+    # HF checkpoints are quantized again by model_fn when the endpoint loads them, so the check here only has to
+    # measure the effect on the user's prompts and record the method next to the weights
+    import transformers
+    from transformers import AutoTokenizer
+    model = getattr(transformers, model_type).from_pretrained(model_dir, torch_dtype=torch.float32).eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    quantized = quantize_model(model, "dynamic", None)
+
+    def generate(generating_model, prompt:str) -> list[int]:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        with torch.no_grad():
+            output = generating_model.generate(input_ids, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+        return output[0].tolist()
+
+    exact_matches, matching_tokens, total_tokens = 0, 0, 0
+    t_original, t_quantized = 0.0, 0.0
+    for prompt in samples:
+        t_start = time.perf_counter()
+        expected = generate(model, prompt)
+        t_original += time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        actual = generate(quantized, prompt)
+        t_quantized += time.perf_counter() - t_start
+        exact_matches += expected == actual
+        matching_tokens += sum(expected_token == actual_token for expected_token, actual_token in zip(expected, actual))
+        total_tokens += max(len(expected), len(actual))
+
+    report = {"fp32_size_mb": serialized_size_mb(model),
+              "int8_size_mb": serialized_size_mb(quantized),
+              "fp32_latency_ms": t_original * 1000 / len(samples),
+              "int8_latency_ms": t_quantized * 1000 / len(samples),
+              "exact_match_rate": exact_matches / len(samples),
+              "token_agreement": matching_tokens / max(total_tokens, 1)}
+    print(f"Quantization report over {len(samples)} prompts:")
+    print(f"  size: {report['fp32_size_mb']:.2f} MB -> {report['int8_size_mb']:.2f} MB")
+    print(f"  latency: {report['fp32_latency_ms']:.2f} ms -> {report['int8_latency_ms']:.2f} ms per greedy generation")
+    print(f"  identical generations: {report['exact_match_rate']:.2%}, token agreement: {report['token_agreement']:.2%}")
+
+    with open(os.path.join(model_dir, hf_quantization_file), "w") as quantization_file:
+        json.dump({"method": "dynamic"}, quantization_file)
+    return report
@@ -0,0 +1,17 @@
+import re
+
+def add_requirement(requirements_path:str, requirement:str) -> None:
+    package = re.split(r"[=<>!~\[ ]", requirement, maxsplit=1)[0].lower()
+    try:
+        with open(requirements_path) as requirements_file:
+            lines = requirements_file.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+
+    for line in lines:
+        if re.split(r"[=<>!~\[ ]", line.strip(), maxsplit=1)[0].lower() == package:
+            return
+
+    lines.append(requirement)
+    with open(requirements_path, "w") as requirements_file:
+        requirements_file.write("\n".join(lines) + "\n")
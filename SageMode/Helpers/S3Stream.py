@@ -0,0 +1,149 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sagemode.Helpers.ParallelGzip import write_tar_gz
+
+# S3 rejects multipart parts under 5 MB, except for the last one
+min_part_size = 5 * 1024 ** 2
+# and copies at most 5 GB into one part
+max_copy_part_size = 5 * 1024 ** 3
+default_part_size = 64 * 1024 ** 2
+
+class S3MultipartWriter:
+    # a write-only file object that uploads what is written to it as an S3 multipart upload, several parts at a time
+
+    def __init__(self, s3_client, bucket:str, key:str, part_size:int = default_part_size, max_in_flight:int = 4, max_retries:int = 5,
+                 metadata:dict = None):
+        if part_size < min_part_size:
+            raise ValueError(f"'part_size' must be at least {min_part_size} bytes.")
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, Metadata=metadata or {})["UploadId"]
+        self.pool = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.pending = deque()
+        self.parts = []
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def submit(self, body:bytes) -> None:
+        part_number = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.pool.submit(self.upload_part, part_number, body))
+        self.bytes_written += len(body)
+        # the producer waits once max_in_flight parts are uploading, which also caps the memory held in parts
+        while len(self.pending) >= self.max_in_flight:
+            self.parts.append(self.pending.popleft().result())
+
+    def upload_part(self, part_number:int, body:bytes) -> dict:
+        # a failed part is sent again on its own, the parts that already arrived are kept
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+                return {"PartNumber": part_number, "ETag": response["ETag"]}
+            except Exception as error:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Uploading part {part_number} failed ({error}), retrying...")
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+
+    def copy_part(self, source_bucket:str, source_key:str, start:int, end:int) -> None:
+        # S3 copies bytes [start, end) of an existing object into the next part without them passing through this machine
+        if self.buffer:
+            raise ValueError("Parts can only be copied before anything is written.")
+        part_number = len(self.parts) + len(self.pending) + 1
+        self.pending.append(self.pool.submit(self.upload_part_copy, part_number, source_bucket, source_key, start, end))
+        self.bytes_written += end - start
+        while len(self.pending) >= self.max_in_flight:
+            self.parts.append(self.pending.popleft().result())
+
+    def upload_part_copy(self, part_number:int, source_bucket:str, source_key:str, start:int, end:int) -> dict:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.s3_client.upload_part_copy(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number,
+                                                           CopySource={"Bucket": source_bucket, "Key": source_key},
+                                                           CopySourceRange=f"bytes={start}-{end - 1}")
+                return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+            except Exception as error:
+                if attempt == self.max_retries:
+                    raise
+                print(f"Copying part {part_number} failed ({error}), retrying...")
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer or not self.parts and not self.pending:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.parts.append(self.pending.popleft().result())
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts})
+        except:
+            self.abort()
+            raise
+        finally:
+            self.pool.shutdown()
+
+    def abort(self) -> None:
+        # S3 keeps (and bills) the parts of an unfinished upload until it is aborted
+        self.closed = True
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown()
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def copy_layer(writer:S3MultipartWriter, layer:dict) -> None:
+    # the layer is split into as few parts as the 5 GB copy limit allows, every one of them stays above the 5 MB minimum
+    parts = -(-layer["bytes"] // max_copy_part_size)
+    bounds = [layer["bytes"] * part // parts for part in range(parts + 1)]
+    for start, end in zip(bounds, bounds[1:]):
+        writer.copy_part(layer["bucket"], layer["key"], start, end)
+
+def stream_directory_to_s3(source_dir:str, s3_client, bucket:str, key:str, level:int = 6, workers:int = None,
+                           part_size:int = default_part_size, max_in_flight:int = 4, metadata:dict = None,
+                           data_layer:dict = None) -> tuple[str, int]:
+    # tar, gzip and upload run at the same time and the archive is never written to disk.
+    # data_layer ({"bucket", "key", "bytes"}, at least min_part_size bytes) is the data layer of an earlier archive with the same data,
+    # S3 copies it and only the code layer is compressed and uploaded. returns the uri and the size of the data layer
+    t_start = time.time()
+    with S3MultipartWriter(s3_client, bucket, key, part_size, max_in_flight, metadata=metadata) as writer:
+        if data_layer is not None:
+            if data_layer["bytes"] < min_part_size:
+                raise ValueError(f"Only data layers of at least {min_part_size} bytes can be copied.")
+            copy_layer(writer, data_layer)
+        bytes_in, bytes_out, data_bytes = write_tar_gz(source_dir, writer, level, workers, skip_data=data_layer is not None)
+    elapsed = time.time() - t_start
+    if data_layer is not None:
+        data_bytes = data_layer["bytes"]
+        print(f"copied the {data_bytes / 1024 ** 2:.1f} MB data layer of s3://{data_layer['bucket']}/{data_layer['key']} and streamed the code layer "
+              f"to s3, {bytes_in / 1024 ** 2:.1f} MB -> {bytes_out / 1024 ** 2:.1f} MB. Time taken: {elapsed:.2f} seconds")
+    else:
+        print(f"streamed {os.path.basename(os.path.normpath(source_dir))} to s3 in {len(writer.parts)} parts. {bytes_in / 1024 ** 2:.1f} MB -> "
+              f"{bytes_out / 1024 ** 2:.1f} MB, {bytes_in / 1024 ** 2 / max(elapsed, 1e-9):.1f} MB/s. Time taken: {elapsed:.2f} seconds")
+    return f"s3://{bucket}/{key}", data_bytes
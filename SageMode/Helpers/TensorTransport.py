@@ -0,0 +1,72 @@
+import json
+import base64
+import struct
+import numpy as np
+
+# client side of the binary format implemented in InferenceFiles/PyTorchEC2/server/transport.py
+CONTENT_TYPE = "application/x-sagemode-tensors"
+ALIGNMENT = 64
+
+def data_start(header_length:int) -> int:
+    start = 8 + header_length
+    return start + (-start % ALIGNMENT)
+
+def as_array(value) -> tuple[str, np.ndarray]:
+    # returns the dtype named in the header and a C contiguous array holding the value's bytes
+    if type(value).__module__ == "torch":
+        # torch is already imported by whoever made the tensor
+        import torch
+        value = value.detach().cpu().contiguous()
+        if value.dtype == torch.bfloat16:
+            # numpy has no bfloat16, the raw bits are sent and the server reads them back as bfloat16
+            return "bfloat16", value.view(torch.int16).numpy()
+    array = np.ascontiguousarray(value)
+    return str(array.dtype), array
+
+def encode_tensors(data:dict) -> bytes:
+    fields, tensors, buffers = {}, {}, []
+    offset = 0
+    for name, value in data.items():
+        if hasattr(value, "__array__") and not isinstance(value, (list, tuple)):
+            dtype, array = as_array(value)
+            offset += -offset % ALIGNMENT
+            tensors[name] = {"dtype": dtype, "shape": list(array.shape), "offset": offset, "nbytes": array.nbytes}
+            # a flat byte view, memoryview.cast refuses arrays with a zero in their shape
+            buffers.append(memoryview(array.reshape(-1).view(np.uint8)))
+            offset += array.nbytes
+        else:
+            fields[name] = value
+    header = json.dumps({"fields": fields, "tensors": tensors}).encode()
+
+    parts = [struct.pack("<Q", len(header)), header, b"\0" * (data_start(len(header)) - 8 - len(header))]
+    position = 0
+    for spec, buffer in zip(tensors.values(), buffers):
+        parts.append(b"\0" * (spec["offset"] - position))
+        parts.append(buffer)
+        position = spec["offset"] + spec["nbytes"]
+    return b"".join(parts)
+
+def decode_tensors(body:bytes) -> dict:
+    (header_length,) = struct.unpack_from("<Q", body, 0)
+    header = json.loads(body[8:8 + header_length])
+    start = data_start(header_length)
+    data = header["fields"]
+    for name, spec in header["tensors"].items():
+        if spec["dtype"] == "bfloat16":
+            # numpy has no bfloat16, its bits are the upper half of a float32 so they are widened into one
+            bits = np.frombuffer(body, dtype=np.uint16, count=spec["nbytes"] // 2, offset=start + spec["offset"])
+            data[name] = (bits.astype(np.uint32) << 16).view(np.float32).reshape(spec["shape"])
+            continue
+        dtype = np.dtype(spec["dtype"])
+        # np.frombuffer returns a read-only view of the response body, no bytes are copied
+        data[name] = np.frombuffer(body, dtype=dtype, count=spec["nbytes"] // dtype.itemsize, offset=start + spec["offset"]).reshape(spec["shape"])
+    return data
+
+def to_lambda_payload(data:dict) -> dict:
+    # lambda payloads have to be JSON, so the binary body crosses the lambda hop as a single base64 string
+    return {"body_base64": base64.b64encode(encode_tensors(data)).decode(), "content_type": CONTENT_TYPE}
+
+def from_lambda_payload(payload:dict) -> dict:
+    if "body_base64" not in payload:
+        return payload
+    return decode_tensors(base64.b64decode(payload["body_base64"]))
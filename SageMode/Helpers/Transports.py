@@ -0,0 +1,51 @@
+import json
+
+# how a resource user's use() reaches the model. the lambda transport is the default and only needs lambda:InvokeFunction,
+# the direct transports skip the lambda invoke (and its cold starts) for trusted callers that can reach the endpoint themselves:
+# sagemaker:InvokeEndpoint for SageMaker, and a security group that lets the caller reach the server's port for EC2
+
+class LambdaTransport:
+
+    def __init__(self, lambda_user):
+        self.lambda_user = lambda_user
+
+    def send(self, data:dict, **kwargs) -> dict:
+        return self.lambda_user.use(data, **kwargs)
+
+class SageMakerRuntimeTransport:
+
+    def __init__(self, boto3_session, endpoint_name:str, timeout:float = 60):
+        from botocore.config import Config
+        self.runtime_client = boto3_session.client("sagemaker-runtime", config=Config(read_timeout=timeout, tcp_keepalive=True,
+                                                                                      retries={"max_attempts": 2, "mode": "standard"}))
+        self.endpoint_name = endpoint_name
+
+    def send(self, data:dict) -> dict:
+        response = self.runtime_client.invoke_endpoint(EndpointName=self.endpoint_name, ContentType="application/json", Accept="application/json",
+                                                       Body=json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        return json.loads(response["Body"].read())
+
+class HTTPTransport:
+
+    def __init__(self, server_url:str, timeout:float = 60):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.server_url = server_url
+        self.timeout = timeout
+        # one session per transport, so repeated calls reuse the keep-alive connection to the server
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=8, max_retries=2))
+
+    def send(self, data:dict, binary:bool = False) -> dict:
+        if binary:
+            from sagemode.Helpers.TensorTransport import CONTENT_TYPE, encode_tensors, decode_tensors
+            response = self.session.post(self.server_url, data=encode_tensors(data), headers={"Content-Type": CONTENT_TYPE, "Accept": CONTENT_TYPE},
+                                         timeout=self.timeout)
+            response.raise_for_status()
+            if response.headers.get("Content-Type", "").startswith(CONTENT_TYPE):
+                return decode_tensors(response.content)
+            return response.json()
+        response = self.session.post(self.server_url, data=json.dumps(data, separators=(",", ":")), headers={"Content-Type": "application/json"},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
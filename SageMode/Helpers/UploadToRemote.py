@@ -1,14 +1,131 @@
 import os
+import time
+import shlex
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sagemode.Helpers.ArtifactCache import load_index, save_index, file_digest
 
-def upload_directory(local_directory, remote_directory, sftp):
-    try:
-        sftp.mkdir(remote_directory)
-    except:
-        print("Couldn't make remote directory.")
-    
+# unfinished uploads are written next to their destination under this suffix and renamed once complete,
+# so an interrupted deploy never leaves a truncated file in place and the next sync continues where it stopped
+partial_suffix = ".part"
+transfer_block_size = 1024 ** 2
+
+def run_remote(transport, command:str) -> str:
+    channel = transport.open_session()
+    channel.exec_command(command)
+    stdout = channel.makefile("rb").read().decode()
+    stderr = channel.makefile_stderr("rb").read().decode()
+    if channel.recv_exit_status() != 0:
+        raise RuntimeError(f"'{command}' failed on the remote host: {stderr.strip()}")
+    channel.close()
+    return stdout
+
+def remote_sha256(transport, remote_directory:str, paths:list[str], batch_size:int = 200) -> dict[str, str]:
+    digests = {}
+    for start in range(0, len(paths), batch_size):
+        quoted_paths = " ".join(shlex.quote(path) for path in paths[start:start + batch_size])
+        for line in run_remote(transport, f"cd {shlex.quote(remote_directory)} && sha256sum -- {quoted_paths}").splitlines():
+            digest, path = line.split(maxsplit=1)
+            digests[path.lstrip("*")] = digest
+    return digests
+
+def remote_files(transport, remote_directory:str) -> dict[str, int]:
+    # relative path -> size of every file under remote_directory, including unfinished uploads
+    listing = run_remote(transport, f"mkdir -p {shlex.quote(remote_directory)} && cd {shlex.quote(remote_directory)} && find . -type f -printf '%s\\t%P\\n'")
+    files = {}
+    for line in listing.splitlines():
+        size, path = line.split("\t", 1)
+        files[path] = int(size)
+    return files
+
+def prefix_sha256(path:str, length:int) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        while length > 0:
+            chunk = input_file.read(min(transfer_block_size, length))
+            if not chunk:
+                break
+            sha256.update(chunk)
+            length -= len(chunk)
+    return sha256.hexdigest()
+
+def resume_offset(transport, remote_directory:str, local_path:str, relative_path:str, partial_size:int) -> int:
+    # a partial upload is only continued if its bytes match the start of the local file
+    if partial_size == 0 or partial_size > os.path.getsize(local_path):
+        return 0
+    remote_partial = shlex.quote(relative_path + partial_suffix)
+    remote_digest = run_remote(transport, f"cd {shlex.quote(remote_directory)} && sha256sum -- {remote_partial}").split()[0]
+    return partial_size if remote_digest == prefix_sha256(local_path, partial_size) else 0
+
+def sync_directory(local_directory:str, remote_directory:str, transport, channels:int = 4) -> dict:
+    # only files whose size or sha256 differ from the remote copy are sent, several at once over separate SFTP channels
+    import paramiko
+    t_start = time.time()
+    index = load_index()
+    local_files = {}
     for root, dirs, files in os.walk(local_directory):
         for file in files:
-            print(f"uploading file: {file}")
-            local_file_path = os.path.join(root, file)
-            remote_file_path = os.path.join(f"{remote_directory}/{file}")
-            sftp.put(local_file_path, remote_file_path)
+            local_path = os.path.join(root, file)
+            local_files[os.path.relpath(local_path, local_directory).replace(os.sep, "/")] = local_path
+
+    existing = remote_files(transport, remote_directory)
+    same_size = [path for path, local_path in local_files.items() if existing.get(path) == os.path.getsize(local_path)]
+    remote_digests = remote_sha256(transport, remote_directory, same_size) if same_size else {}
+    changed = [path for path in local_files if path not in remote_digests or remote_digests[path] != file_digest(local_files[path], index)]
+    save_index(index)
+
+    remote_subdirectories = {os.path.dirname(path) for path in changed} - {""}
+    if remote_subdirectories:
+        quoted_directories = " ".join(shlex.quote(directory) for directory in sorted(remote_subdirectories))
+        run_remote(transport, f"cd {shlex.quote(remote_directory)} && mkdir -p {quoted_directories}")
+
+    sftp_clients = threading.local()
+    open_clients = []
+    lock = threading.Lock()
+    bytes_sent = [0]
+
+    def send(path:str) -> None:
+        if not hasattr(sftp_clients, "sftp"):
+            sftp_clients.sftp = paramiko.SFTPClient.from_transport(transport)
+            with lock:
+                open_clients.append(sftp_clients.sftp)
+        sftp = sftp_clients.sftp
+        local_path = local_files[path]
+        remote_path = f"{remote_directory}/{path}"
+        offset = resume_offset(transport, remote_directory, local_path, path, existing.get(path + partial_suffix, 0))
+        if offset:
+            print(f"resuming {path} at {offset / 1024 ** 2:.1f} MB")
+        with open(local_path, "rb") as local_file, sftp.open(remote_path + partial_suffix, "r+b" if offset else "wb") as remote_file:
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            # pipelined writes do not wait for an acknowledgement per block, which is what makes a single channel slow
+            remote_file.set_pipelined(True)
+            for block in iter(lambda: local_file.read(transfer_block_size), b""):
+                remote_file.write(block)
+                with lock:
+                    bytes_sent[0] += len(block)
+        sftp.posix_rename(remote_path + partial_suffix, remote_path)
+        print(f"uploaded file: {path}")
+
+    try:
+        with ThreadPoolExecutor(max_workers=channels) as pool:
+            # the largest files start first so that one big weights file does not finish alone at the end
+            list(pool.map(send, sorted(changed, key=lambda path: -os.path.getsize(local_files[path]))))
+    finally:
+        for sftp in open_clients:
+            sftp.close()
+
+    elapsed = time.time() - t_start
+    report = {"files_sent": len(changed),
+              "files_skipped": len(local_files) - len(changed),
+              "mb_sent": bytes_sent[0] / 1024 ** 2,
+              "mb_per_second": bytes_sent[0] / 1024 ** 2 / max(elapsed, 1e-9),
+              "seconds": elapsed}
+    print(f"Synced {local_directory} to {remote_directory}: sent {report['files_sent']} files ({report['mb_sent']:.1f} MB), "
+          f"{report['files_skipped']} unchanged files skipped, {report['mb_per_second']:.1f} MB/s. Time taken: {elapsed:.2f} seconds")
+    return report
+
+def upload_directory(local_directory, remote_directory, sftp, channels:int = 4):
+    # kept for callers that hold an SFTP client, the sync opens its own channels on the same connection
+    return sync_directory(local_directory, remote_directory, sftp.get_channel().get_transport(), channels)
@@ -1,21 +1,151 @@
+import os
+import json
+import types
+import importlib.util
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
+try:
+    from payload_offload import LazyPayload, offload
+    from decoding import select_next_token, supported_parameters, IncrementalDecoder
+except ImportError:
+    # both modules are copied next to this file when it is deployed, imported from the sagemode package they are package modules
+    from ..payload_offload import LazyPayload, offload
+    from .decoding import select_next_token, supported_parameters, IncrementalDecoder
+
+def quantize_if_requested(model, model_dir):
+    # written at packaging time when the model was deployed with quantize="dynamic"
+    quantization_path = os.path.join(model_dir, "sagemode_quantization.json")
+    if not os.path.exists(quantization_path):
+        return model
+    if model.device.type != "cpu":
+        print("int8 dynamic quantization only runs on CPU, serving the unquantized model.")
+        return model
+    return torch.ao.quantization.quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8)
+
+# set by model_fn when the model was deployed with continuous batching or a prefix cache
+engine = None
+prefix_cache = None
+
+def start_prefix_cache_if_requested(model_dir):
+    global prefix_cache
+    prefix_cache_config_path = os.path.join(model_dir, "sagemode_prefix_cache.json")
+    if not os.path.exists(prefix_cache_config_path):
+        return
+    from prefix_cache import PrefixCache
+    with open(prefix_cache_config_path) as prefix_cache_config_file:
+        prefix_cache = PrefixCache(**json.load(prefix_cache_config_file))
+
+def start_engine_if_requested(model, tokenizer, model_dir):
+    global engine
+    engine_config_path = os.path.join(model_dir, "sagemode_continuous_batching.json")
+    if not os.path.exists(engine_config_path):
+        return
+    from continuous_batching import ContinuousBatchingEngine
+    with open(engine_config_path) as engine_config_file:
+        engine = ContinuousBatchingEngine(model, tokenizer, **json.load(engine_config_file), prefix_cache=prefix_cache)
+    engine.start()
+
+def report_prefix_cache():
+    if prefix_cache is not None and prefix_cache.lookups % 100 == 0:
+        print(f"prefix cache: {prefix_cache.stats()}")
 
 def model_fn(model_dir):
-    model = AutoModelForCausalLM.from_pretrained(model_dir)
+    # low_cpu_mem_usage skips the random initialization and loads each weight straight into place, torch_dtype="auto" keeps the checkpoint's dtype.
+    # transformers only allows it with accelerate installed, without it the model loads the usual way
+    low_cpu_mem_usage = importlib.util.find_spec("accelerate") is not None
+    model = AutoModelForCausalLM.from_pretrained(model_dir, low_cpu_mem_usage=low_cpu_mem_usage, torch_dtype="auto")
+    model = quantize_if_requested(model, model_dir)
     tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    start_prefix_cache_if_requested(model_dir)
+    start_engine_if_requested(model, tokenizer, model_dir)
     return model, tokenizer
 
-def predict_fn(data, model_and_tokenizer):
+def generate_tokens(input_ids, parameters, model, tokenizer):
+    # one forward pass per token on top of the KV cache. with a prefix cache only the prompt tokens after the cached prefix
+    # are run, lookup() always leaves at least one of them so the first step has logits to pick from
+    next_input, past_key_values = input_ids, None
+    if prefix_cache is not None:
+        cached_length, past_key_values = prefix_cache.lookup(input_ids[0].tolist())
+        next_input = input_ids[:, cached_length:]
+        report_prefix_cache()
+    with torch.no_grad():
+        for step in range(parameters.get("max_new_tokens", 50)):
+            outputs = model(input_ids=next_input, past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+            if step == 0 and prefix_cache is not None:
+                prefix_cache.insert(input_ids[0].tolist(), past_key_values)
+            next_token = select_next_token(outputs.logits[:, -1, :], parameters)
+            if next_token.item() == tokenizer.eos_token_id:
+                return
+            yield next_token.item()
+            next_input = next_token.view(1, 1)
+
+def stream_fn(data, model_and_tokenizer):
+    # yields text as soon as the generated tokens form complete characters
     model, tokenizer = model_and_tokenizer
+    prompt = data.get("inputs", data.get("text"))
+    parameters = data.get("parameters") or {}
 
-    inputs = data.pop("inputs", data)
-    parameters = data.pop("parameters", None)
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(model.device)
+    decoder = IncrementalDecoder(tokenizer)
+    for token in generate_tokens(input_ids, parameters, model, tokenizer):
+        text = decoder.add(token)
+        if text:
+            yield text
+    text = decoder.flush()
+    if text:
+        yield text
 
-    input_tokens = tokenizer(inputs, return_tensors="pt")
+def sse_stream(tokens):
+    for token in tokens:
+        yield f"data: {json.dumps({'token': token})}\n\n"
+    yield "data: [DONE]\n\n"
+
+def generate_fn(data, model_and_tokenizer):
+    # a list of prompts is left padded into one batch so every sequence ends at the same position and shares each decode step
+    model, tokenizer = model_and_tokenizer
+    prompts = data.get("inputs", data.get("text"))
+    parameters = dict(data.get("parameters") or {})
+    single_prompt = isinstance(prompts, str)
+    if single_prompt:
+        prompts = [prompts]
+
+    if engine is not None and set(parameters) <= supported_parameters:
+        # prompts of a list join the running batch as others finish instead of waiting for the longest one
+        texts = engine.generate(prompts, parameters)
+        report_prefix_cache()
+        return texts[0] if single_prompt else texts
+    if prefix_cache is not None and single_prompt and set(parameters) <= supported_parameters:
+        return generate_with_prefix_cache(prompts[0], parameters, model, tokenizer)
+
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    parameters.setdefault("max_new_tokens", 50)
+    parameters.setdefault("pad_token_id", tokenizer.pad_token_id)
 
     with torch.no_grad():
-        outputs = model(**input_tokens)
-    logits = outputs.logits
-    prediction = tokenizer.decode(logits[0], skip_special_tokens=True)
-    return {"text":prediction, "parameters":None}
+        outputs = model.generate(input_ids=inputs.input_ids, attention_mask=inputs.attention_mask, **parameters)
+    texts = tokenizer.batch_decode(outputs[:, inputs.input_ids.shape[1]:], skip_special_tokens=True)
+    return texts[0] if single_prompt else texts
+
+def generate_with_prefix_cache(prompt, parameters, model, tokenizer):
+    # decoded by hand, generate() cannot start from a cached prefix on every transformers version the toolkit ships.
+    # a left padded batch cannot share one cached prefix so lists skip this
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(model.device)
+    return tokenizer.decode(list(generate_tokens(input_ids, parameters, model, tokenizer)), skip_special_tokens=True)
+
+def predict_fn(data, model_and_tokenizer):
+    # prompts that the client offloaded to S3 are downloaded when they are read, long outputs go back the same way
+    data = LazyPayload(data)
+    if data.get("stream", False):
+        return stream_fn(data, model_and_tokenizer)
+    return offload({"text": generate_fn(data, model_and_tokenizer), "parameters": None}, data.settings)
+
+def output_fn(prediction, accept):
+    if isinstance(prediction, types.GeneratorType):
+        # the SageMaker inference toolkit sends the body in one piece, so the events are joined here.
+        # servers that support chunked responses send sse_stream() as it is produced instead.
+        return "".join(sse_stream(prediction))
+    return json.dumps(prediction)
@@ -1,31 +1,70 @@
+import os
 from typing import Dict, List, Any
+import torch
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+try:
+    from payload_offload import LazyPayload, offload
+except ImportError:
+    # payload_offload.py is copied next to this file when it is deployed, imported from the sagemode package it is one level up
+    from ..payload_offload import LazyPayload, offload
+
+def quantize_if_requested(model, model_dir):
+    # written at packaging time when the model was deployed with quantize="dynamic"
+    quantization_path = os.path.join(model_dir, "sagemode_quantization.json")
+    if not os.path.exists(quantization_path):
+        return model
+    if model.device.type != "cpu":
+        print("int8 dynamic quantization only runs on CPU, serving the unquantized model.")
+        return model
+    return torch.ao.quantization.quantize_dynamic(model.float(), {torch.nn.Linear}, dtype=torch.qint8)
 
 def model_fn(model_dir):
     # load model and processor from model_dir
-    model =  AutoModelForSeq2SeqLM.from_pretrained(model_dir, device_map="auto")
+    model =  AutoModelForSeq2SeqLM.from_pretrained(model_dir, device_map="auto", torch_dtype="auto")
+    model = quantize_if_requested(model, model_dir)
     tokenizer = AutoTokenizer.from_pretrained(model_dir)
 
     return model, tokenizer
 
+def token_budget_batches(lengths, max_batch_tokens, max_new_tokens):
+    # sorting by length keeps similar lengths together so little of each batch is padding, and a batch grows while
+    # its padded encoder tokens plus the tokens it will decode stay within the budget
+    order = sorted(range(len(lengths)), key=lambda index: lengths[index])
+    batches, batch = [], []
+    for index in order:
+        if batch and (len(batch) + 1) * (lengths[index] + max_new_tokens) > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        batches.append(batch)
+    return batches
+
 def predict_fn(data, model_and_tokenizer):
     # unpack model and tokenizer
     model, tokenizer = model_and_tokenizer
+    # inputs that the client offloaded to S3 are downloaded when they are read, long outputs go back the same way
+    data = LazyPayload(data)
 
-    # process input
+    # process input, "text" may be one string or a list of them
     inputs = data.pop("text", data)
-    parameters = data.pop("parameters", None)
-
-    # preprocess
-    input_ids = tokenizer(inputs, return_tensors="pt").input_ids
+    parameters = data.pop("parameters", None) or {}
+    max_batch_tokens = data.pop("max_batch_tokens", 8192)
+    single_input = isinstance(inputs, str)
+    if single_input:
+        inputs = [inputs]
 
-    # pass inputs with all kwargs in data
-    if parameters is not None:
-        outputs = model.generate(input_ids, **parameters)
-    else:
-        outputs = model.generate(input_ids)
+    # preprocess without padding, each batch is padded to its own longest input
+    input_ids = tokenizer(inputs, truncation=True).input_ids
+    max_new_tokens = parameters.get("max_new_tokens", model.generation_config.max_length)
 
-    # postprocess the prediction
-    prediction = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    predictions = [None] * len(inputs)
+    for batch in token_budget_batches([len(ids) for ids in input_ids], max_batch_tokens, max_new_tokens):
+        batch_inputs = tokenizer.pad({"input_ids": [input_ids[index] for index in batch]}, return_tensors="pt").to(model.device)
+        with torch.no_grad():
+            outputs = model.generate(**batch_inputs, **parameters)
+        # postprocess the predictions back into the order they were sent in
+        for index, prediction in zip(batch, tokenizer.batch_decode(outputs, skip_special_tokens=True)):
+            predictions[index] = prediction
 
-    return {"text": prediction, "parameters":None}
\ No newline at end of file
+    return offload({"text": predictions[0] if single_input else predictions, "parameters":None}, data.settings)
\ No newline at end of file
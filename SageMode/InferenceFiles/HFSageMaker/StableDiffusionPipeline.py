@@ -1,40 +1,99 @@
 import base64
 import torch
 from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from diffusers import StableDiffusionPipeline
+try:
+    from payload_offload import LazyPayload, offload
+except ImportError:
+    # payload_offload.py is copied next to this file when it is deployed, imported from the sagemode package it is one level up
+    from ..payload_offload import LazyPayload, offload
+
+# text encoder outputs for recently seen (prompt, negative prompt) pairs, the text encoder then runs once per distinct prompt
+embedding_cache = OrderedDict()
+embedding_cache_size = 256
+# PIL releases the GIL while it compresses, so images are encoded in parallel
+encoding_pool = ThreadPoolExecutor(max_workers=4)
 
 
 def model_fn(model_dir):
-    # Load stable diffusion and move it to the GPU
-    pipe = StableDiffusionPipeline.from_pretrained(model_dir)
-    pipe.to("cuda")
+    if torch.cuda.is_available():
+        # Load stable diffusion and move it to the GPU
+        pipe = StableDiffusionPipeline.from_pretrained(model_dir)
+        pipe.to("cuda")
+    else:
+        # float16 is slow or unsupported on CPU. attention slicing and VAE tiling trade a little speed
+        # for a much lower peak memory, which is what decides whether the model fits on a CPU instance
+        pipe = StableDiffusionPipeline.from_pretrained(model_dir, torch_dtype=torch.float32)
+        pipe.enable_attention_slicing()
+        pipe.enable_vae_tiling()
 
     return pipe
 
 
+def encode_prompts(pipe, prompts, negative_prompts, guidance_scale):
+    do_classifier_free_guidance = guidance_scale > 1.0
+    prompt_embeds, negative_prompt_embeds = [], []
+    for prompt, negative_prompt in zip(prompts, negative_prompts):
+        key = (prompt, negative_prompt, do_classifier_free_guidance)
+        if key in embedding_cache:
+            embedding_cache.move_to_end(key)
+        else:
+            embedding_cache[key] = pipe.encode_prompt(prompt, pipe.device, 1, do_classifier_free_guidance, negative_prompt)
+            if len(embedding_cache) > embedding_cache_size:
+                embedding_cache.popitem(last=False)
+        prompt_embed, negative_prompt_embed = embedding_cache[key]
+        prompt_embeds.append(prompt_embed)
+        negative_prompt_embeds.append(negative_prompt_embed)
+    negative_prompt_embeds = torch.cat(negative_prompt_embeds) if do_classifier_free_guidance else None
+    return torch.cat(prompt_embeds), negative_prompt_embeds
+
+
+def encode_image(image, image_format):
+    buffered = BytesIO()
+    image.save(buffered, format=image_format)
+    return base64.b64encode(buffered.getvalue()).decode()
+
+
 def predict_fn(data, pipe):
+    # encoded images are usually far above the Lambda and Step Functions limits, when the client sent offload settings
+    # they are written to S3 and only references go back. offloaded input fields are downloaded when they are read
+    data = LazyPayload(data)
 
-    # get prompt & parameters
-    prompt = data["text"]
+    # get prompt & parameters, "text" may be one prompt or a list of prompts that are generated in one pipeline call
+    prompts = data["text"]
+    single_prompt = isinstance(prompts, str)
+    if single_prompt:
+        prompts = [prompts]
+    negative_prompts = data.pop("negative_prompt", None)
+    if negative_prompts is None or isinstance(negative_prompts, str):
+        negative_prompts = [negative_prompts] * len(prompts)
     # set valid HP for stable diffusion
     num_inference_steps = data.pop("num_inference_steps", 10)
     guidance_scale = data.pop("guidance_scale", 7.5)
     num_images_per_prompt = data.pop("num_images_per_prompt", 1)
+    # "none" skips encoding and returns no images, for callers that only need the generation to run
+    image_format = data.pop("image_format", "JPEG").upper().replace("JPG", "JPEG")
+
+    prompt_embeds, negative_prompt_embeds = encode_prompts(pipe, prompts, negative_prompts, guidance_scale)
 
     # run generation with parameters
     generated_images = pipe(
-        prompt,
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
         num_inference_steps=num_inference_steps,
         guidance_scale=guidance_scale,
         num_images_per_prompt=num_images_per_prompt,
     )["images"]
 
     # create response
-    encoded_images = []
-    for image in generated_images:
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG")
-        encoded_images.append(base64.b64encode(buffered.getvalue()).decode())
+    if image_format == "NONE":
+        encoded_images = []
+    else:
+        encoded_images = list(encoding_pool.map(lambda image: encode_image(image, image_format), generated_images))
 
-    # create response
-    return {"base64": encoded_images[0], "parameters": None}
\ No newline at end of file
+    # a single prompt asking for a single image keeps the original response shape
+    if single_prompt and num_images_per_prompt == 1 and encoded_images:
+        return offload({"base64": encoded_images[0], "parameters": None}, data.settings)
+    return offload({"base64": encoded_images, "parameters": None}, data.settings)
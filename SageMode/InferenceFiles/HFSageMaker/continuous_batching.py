@@ -0,0 +1,305 @@
+import time
+import threading
+from collections import deque
+from typing import Callable, Optional
+import torch
+try:
+    from decoding import select_next_token, supported_parameters
+except ImportError:
+    # decoding.py is copied next to this file when it is deployed, imported from the sagemode package it is a sibling module
+    from .decoding import select_next_token, supported_parameters
+
+def legacy_cache(past_key_values) -> tuple:
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+class BlockAllocator:
+    # KV cache memory is handed out in fixed-size blocks, so sequences of any length share one preallocated pool
+    # and a finished sequence gives its memory back without fragmenting it
+
+    def __init__(self, num_blocks:int):
+        self.num_blocks = num_blocks
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+
+    @property
+    def free(self) -> int:
+        return len(self.free_blocks)
+
+    def allocate(self) -> int:
+        return self.free_blocks.pop()
+
+    def release(self, blocks:list[int]) -> None:
+        self.free_blocks.extend(reversed(blocks))
+
+class Sequence:
+
+    def __init__(self, prompt_ids:list[int], parameters:dict, on_token:Optional[Callable] = None, on_finish:Optional[Callable] = None):
+        self.prompt_ids = prompt_ids
+        self.parameters = parameters
+        self.max_new_tokens = parameters.get("max_new_tokens", 50)
+        self.generated = []
+        # slots holding this sequence's keys and values, one per token whose KV is cached
+        self.blocks = []
+        self.slots = []
+        self.on_token = on_token
+        self.on_finish = on_finish
+        self.finished = threading.Event()
+        self.cancelled = False
+        self.text = None
+        self.error = None
+        self.submitted_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+
+    @property
+    def token_ids(self) -> list[int]:
+        return self.prompt_ids + self.generated
+
+    def wait(self) -> str:
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+class ContinuousBatchingEngine:
+    # iteration level scheduling: waiting sequences join the running batch at every decode step and finished ones leave right away
+
+    def __init__(self, model, tokenizer, max_batch_size:int = 16, block_size:int = 16, max_cache_tokens:int = None, prefix_cache = None):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        # an optional PrefixCache, prompts then only prefill the tokens after their longest cached prefix
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.block_size = block_size
+        max_cache_tokens = max_cache_tokens or max_batch_size * 512
+        self.allocator = BlockAllocator(-(-max_cache_tokens // block_size))
+        self.max_positions = getattr(model.config, "max_position_embeddings", None) or getattr(model.config, "n_positions", None)
+        self.key_pool = None
+        self.value_pool = None
+        self.waiting = deque()
+        self.running = []
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+        self.steps = 0
+        self.preemptions = 0
+        self.generated_tokens = 0
+
+    def create_sequence(self, prompt:str, parameters:dict = None, on_token:Optional[Callable] = None, on_finish:Optional[Callable] = None) -> Sequence:
+        # validates the prompt without queueing it, so a batch with one bad prompt can be refused before any of it runs
+        parameters = parameters or {}
+        unsupported = set(parameters) - supported_parameters
+        if unsupported:
+            raise ValueError(f"The continuous batching engine does not support the parameters {sorted(unsupported)}.")
+        sequence = Sequence(self.tokenizer(prompt).input_ids, parameters, on_token, on_finish)
+        if not sequence.prompt_ids:
+            raise ValueError("The prompt must contain at least one token.")
+        if len(sequence.prompt_ids) + 1 > self.allocator.num_blocks * self.block_size:
+            raise ValueError(f"A prompt of {len(sequence.prompt_ids)} tokens does not fit in the KV cache.")
+        return sequence
+
+    def enqueue(self, sequences:list[Sequence]) -> None:
+        with self.condition:
+            self.waiting.extend(sequences)
+            self.condition.notify()
+
+    def submit(self, prompt:str, parameters:dict = None, on_token:Optional[Callable] = None, on_finish:Optional[Callable] = None) -> Sequence:
+        sequence = self.create_sequence(prompt, parameters, on_token, on_finish)
+        self.enqueue([sequence])
+        return sequence
+
+    def cancel(self, sequence:Sequence) -> None:
+        # for callers that stopped listening, e.g. a client that closed its stream. the engine thread finishes the sequence
+        # at its next step, which gives its blocks back
+        sequence.cancelled = True
+
+    def generate(self, prompts:list[str], parameters:dict = None) -> list[str]:
+        sequences = [self.create_sequence(prompt, parameters) for prompt in prompts]
+        self.enqueue(sequences)
+        if self.thread is None:
+            while not all(sequence.finished.is_set() for sequence in sequences):
+                self.step()
+        return [sequence.wait() for sequence in sequences]
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
+        self.thread = None
+
+    def loop(self) -> None:
+        while True:
+            with self.condition:
+                while not self.waiting and not self.running and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+            try:
+                self.step()
+            except Exception as e:
+                # a failing step fails the sequences in it instead of killing the engine thread
+                for sequence in self.running + list(self.waiting):
+                    self.finish(sequence, error=e)
+                self.running = []
+                self.waiting.clear()
+
+    def step(self) -> None:
+        with torch.no_grad():
+            self.admit()
+            if self.running:
+                self.decode()
+        self.steps += 1
+
+    def blocks_needed(self, sequence:Sequence, tokens:int) -> int:
+        return max(0, -(-tokens // self.block_size) - len(sequence.blocks))
+
+    def reserve(self, sequence:Sequence, tokens:int) -> None:
+        for _ in range(self.blocks_needed(sequence, tokens)):
+            sequence.blocks.append(self.allocator.allocate())
+        while len(sequence.slots) < tokens:
+            position = len(sequence.slots)
+            sequence.slots.append(sequence.blocks[position // self.block_size] * self.block_size + position % self.block_size)
+
+    def admit(self) -> None:
+        while len(self.running) < self.max_batch_size:
+            with self.condition:
+                if not self.waiting:
+                    return
+                sequence = self.waiting[0]
+                if sequence.cancelled:
+                    self.waiting.popleft()
+                    self.finish(sequence)
+                    continue
+                # leave one free block per running sequence so the batch can keep decoding after this one joins
+                if self.blocks_needed(sequence, len(sequence.token_ids) + 1) + len(self.running) > self.allocator.free:
+                    return
+                self.waiting.popleft()
+            self.prefill(sequence)
+
+    def prefill(self, sequence:Sequence) -> None:
+        token_ids = sequence.token_ids
+        self.reserve(sequence, len(token_ids))
+        cached_length, cached_past = 0, None
+        if self.prefix_cache is not None:
+            cached_length, cached_past = self.prefix_cache.lookup(token_ids)
+        input_ids = torch.tensor([token_ids[cached_length:]], device=self.model.device)
+        outputs = self.model(input_ids=input_ids, past_key_values=cached_past, use_cache=True)
+        past_key_values = legacy_cache(outputs.past_key_values)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(token_ids, past_key_values)
+        if self.key_pool is None:
+            self.allocate_pools(past_key_values)
+        slots = torch.tensor(sequence.slots, device=self.model.device)
+        for layer, (keys, values) in enumerate(past_key_values):
+            self.key_pool[layer][slots] = keys[0].transpose(0, 1)
+            self.value_pool[layer][slots] = values[0].transpose(0, 1)
+        next_token = select_next_token(outputs.logits[:, -1, :], sequence.parameters)
+        self.running.append(sequence)
+        self.append_token(sequence, next_token.item())
+
+    def allocate_pools(self, past_key_values:tuple) -> None:
+        keys = past_key_values[0][0]
+        num_slots = self.allocator.num_blocks * self.block_size
+        shape = (len(past_key_values), num_slots, keys.shape[1], keys.shape[3])
+        self.key_pool = torch.zeros(shape, dtype=keys.dtype, device=keys.device)
+        self.value_pool = torch.zeros(shape, dtype=keys.dtype, device=keys.device)
+
+    def decode(self) -> None:
+        # make room for the token each sequence is about to cache, preempting the newest sequences when the pool is full
+        while True:
+            needed = sum(self.blocks_needed(sequence, len(sequence.slots) + 1) for sequence in self.running)
+            if needed <= self.allocator.free:
+                break
+            if len(self.running) == 1:
+                # a lone sequence that outgrew the whole pool stops here rather than waiting for memory that never frees up
+                self.finish(self.running[0])
+            else:
+                self.preempt(self.running[-1])
+        if not self.running:
+            return
+        for sequence in self.running:
+            self.reserve(sequence, len(sequence.slots) + 1)
+
+        # gather each sequence's cached tokens into one left padded dense cache
+        past_length = max(len(sequence.slots) for sequence in self.running) - 1
+        device = self.model.device
+        gather_slots = torch.zeros((len(self.running), past_length), dtype=torch.long, device=device)
+        attention_mask = torch.zeros((len(self.running), past_length + 1), dtype=torch.long, device=device)
+        for row, sequence in enumerate(self.running):
+            cached = len(sequence.slots) - 1
+            if cached > 0:
+                gather_slots[row, past_length - cached:] = torch.tensor(sequence.slots[:-1], device=device)
+            attention_mask[row, past_length - cached:] = 1
+        past_key_values = tuple((self.key_pool[layer][gather_slots].transpose(1, 2), self.value_pool[layer][gather_slots].transpose(1, 2))
+                                for layer in range(self.key_pool.shape[0]))
+        input_ids = torch.tensor([[sequence.token_ids[-1]] for sequence in self.running], device=device)
+        position_ids = torch.tensor([[len(sequence.slots) - 1] for sequence in self.running], device=device)
+
+        outputs = self.model(input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        new_slots = torch.tensor([sequence.slots[-1] for sequence in self.running], device=device)
+        for layer, (keys, values) in enumerate(legacy_cache(outputs.past_key_values)):
+            self.key_pool[layer][new_slots] = keys[:, :, -1, :]
+            self.value_pool[layer][new_slots] = values[:, :, -1, :]
+
+        logits = outputs.logits[:, -1, :]
+        if all(not sequence.parameters.get("do_sample", False) for sequence in self.running):
+            next_tokens = torch.argmax(logits, dim=-1).tolist()
+        else:
+            next_tokens = [select_next_token(logits[row], sequence.parameters).item() for row, sequence in enumerate(self.running)]
+        for sequence, next_token in list(zip(self.running, next_tokens)):
+            self.append_token(sequence, next_token)
+
+    def append_token(self, sequence:Sequence, token:int) -> None:
+        if token == self.tokenizer.eos_token_id or sequence.cancelled:
+            self.finish(sequence)
+            return
+        if sequence.first_token_at is None:
+            sequence.first_token_at = time.perf_counter()
+        sequence.generated.append(token)
+        self.generated_tokens += 1
+        if sequence.on_token is not None:
+            sequence.on_token(token)
+        out_of_positions = self.max_positions is not None and len(sequence.token_ids) >= self.max_positions
+        if len(sequence.generated) >= sequence.max_new_tokens or out_of_positions:
+            self.finish(sequence)
+
+    def preempt(self, sequence:Sequence) -> None:
+        # the sequence gives back its blocks and is prefilled again from its prompt and generated tokens once there is room
+        self.running.remove(sequence)
+        self.allocator.release(sequence.blocks)
+        sequence.blocks, sequence.slots = [], []
+        self.preemptions += 1
+        with self.condition:
+            self.waiting.appendleft(sequence)
+
+    def finish(self, sequence:Sequence, error:Exception = None) -> None:
+        if sequence in self.running:
+            self.running.remove(sequence)
+        self.allocator.release(sequence.blocks)
+        sequence.blocks, sequence.slots = [], []
+        if error is None:
+            sequence.text = self.tokenizer.decode(sequence.generated, skip_special_tokens=True)
+        sequence.error = error
+        sequence.finished_at = time.perf_counter()
+        sequence.finished.set()
+        if sequence.on_finish is not None:
+            sequence.on_finish(sequence)
+
+    def stats(self) -> dict:
+        stats = {"running": len(self.running),
+                "waiting": len(self.waiting),
+                "free_blocks": self.allocator.free,
+                "total_blocks": self.allocator.num_blocks,
+                "block_size": self.block_size,
+                "steps": self.steps,
+                "preemptions": self.preemptions,
+                "generated_tokens": self.generated_tokens}
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        return stats
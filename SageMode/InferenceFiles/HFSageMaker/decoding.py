@@ -0,0 +1,49 @@
+import torch
+
+# token selection shared by the causal LM inference file and the continuous batching engine, copied next to them when they are deployed
+supported_parameters = {"max_new_tokens", "do_sample", "temperature", "top_k", "top_p"}
+
+def select_next_token(logits, parameters):
+    if not parameters.get("do_sample", False):
+        return torch.argmax(logits, dim=-1)
+    logits = logits / max(parameters.get("temperature", 1.0), 1e-5)
+    top_k = parameters.get("top_k", 0)
+    if top_k > 0:
+        kth_largest = torch.topk(logits, min(top_k, logits.shape[-1])).values[..., -1, None]
+        logits = logits.masked_fill(logits < kth_largest, float("-inf"))
+    top_p = parameters.get("top_p", 1.0)
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative = torch.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        sorted_logits = sorted_logits.masked_fill(cumulative - torch.softmax(sorted_logits, dim=-1) > top_p, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(-1, sorted_indices, sorted_logits)
+    return torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1).squeeze(-1)
+
+class IncrementalDecoder:
+    # turns generated token ids into text pieces as soon as they form complete characters. only a small window is decoded,
+    # so every token costs the same, and an incomplete multi-byte character is held back until its last byte arrives
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def pending_text(self) -> tuple[str, str]:
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:], skip_special_tokens=True)
+        return prefix_text, new_text
+
+    def add(self, token:int) -> str:
+        self.tokens.append(token)
+        prefix_text, new_text = self.pending_text()
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset, self.read_offset = self.read_offset, len(self.tokens)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        # what was still held back when generation stopped, decoded the way the whole output would be
+        prefix_text, new_text = self.pending_text()
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.tokens)
+        return new_text[len(prefix_text):]
@@ -0,0 +1,134 @@
+import threading
+import torch
+
+def stacked_cache(past_key_values, length:int) -> tuple[torch.Tensor, torch.Tensor]:
+    # [layers, heads, tokens, head_dim] keys and values of the first sequence in the batch
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    keys = torch.stack([layer_keys[0, :, :length] for layer_keys, _ in past_key_values])
+    values = torch.stack([layer_values[0, :, :length] for _, layer_values in past_key_values])
+    return keys, values
+
+class Node:
+
+    def __init__(self, tokens:tuple, keys:torch.Tensor, values:torch.Tensor, parent):
+        # the edge into this node holds these tokens and the keys and values computed for them
+        self.tokens = tokens
+        self.keys = keys
+        self.values = values
+        self.parent = parent
+        self.children = {}
+        self.last_used = 0
+
+    @property
+    def nbytes(self) -> int:
+        if self.keys is None:
+            return 0
+        return self.keys.numel() * self.keys.element_size() + self.values.numel() * self.values.element_size()
+
+class PrefixCache:
+    # a radix tree over token ids, so prompts that share a system prompt or few-shot preamble only prefill what comes after it
+
+    def __init__(self, max_mb:float = 512):
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self.root = Node((), None, None, None)
+        self.bytes = 0
+        self.clock = 0
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.tokens_saved = 0
+        self.evictions = 0
+
+    def touch(self, node:Node) -> None:
+        self.clock += 1
+        while node is not None:
+            node.last_used = self.clock
+            node = node.parent
+
+    def lookup(self, token_ids:list[int]) -> tuple[int, tuple]:
+        # returns how many leading tokens are cached and their past_key_values, leaving at least one token to compute logits from
+        with self.lock:
+            limit = len(token_ids) - 1
+            node, matched, segments = self.root, 0, []
+            while matched < limit:
+                child = node.children.get(token_ids[matched])
+                if child is None:
+                    break
+                common = 0
+                while common < len(child.tokens) and matched + common < limit and child.tokens[common] == token_ids[matched + common]:
+                    common += 1
+                segments.append((child.keys[:, :, :common], child.values[:, :, :common]))
+                matched += common
+                node = child
+                if common < len(child.tokens):
+                    break
+            self.lookups += 1
+            self.prompt_tokens += len(token_ids)
+            if matched == 0:
+                return 0, None
+            self.touch(node)
+            self.hits += 1
+            self.tokens_saved += matched
+            keys = torch.cat([segment_keys for segment_keys, _ in segments], dim=2)
+            values = torch.cat([segment_values for _, segment_values in segments], dim=2)
+        return matched, tuple((keys[layer][None], values[layer][None]) for layer in range(keys.shape[0]))
+
+    def insert(self, token_ids:list[int], past_key_values) -> None:
+        # past_key_values must cover at least len(token_ids) positions
+        keys, values = stacked_cache(past_key_values, len(token_ids))
+        with self.lock:
+            node, position = self.root, 0
+            while position < len(token_ids):
+                child = node.children.get(token_ids[position])
+                if child is None:
+                    # copy the new part so the cache does not keep the whole request's cache alive
+                    child = Node(tuple(token_ids[position:]), keys[:, :, position:].clone(), values[:, :, position:].clone(), node)
+                    node.children[token_ids[position]] = child
+                    self.bytes += child.nbytes
+                    node = child
+                    break
+                common = 0
+                while common < len(child.tokens) and position + common < len(token_ids) and child.tokens[common] == token_ids[position + common]:
+                    common += 1
+                if common < len(child.tokens):
+                    child = self.split(child, common)
+                node, position = child, position + common
+            self.touch(node)
+            self.evict()
+
+    def split(self, node:Node, length:int) -> Node:
+        # both halves get their own copy, otherwise evicting one of them would not free any memory
+        upper = Node(node.tokens[:length], node.keys[:, :, :length].clone(), node.values[:, :, :length].clone(), node.parent)
+        node.parent.children[node.tokens[0]] = upper
+        node.tokens, node.keys, node.values, node.parent = node.tokens[length:], node.keys[:, :, length:].clone(), node.values[:, :, length:].clone(), upper
+        upper.children[node.tokens[0]] = node
+        upper.last_used = node.last_used
+        return upper
+
+    def evict(self) -> None:
+        # least recently used leaves go first, a parent becomes evictable once its last child is gone
+        while self.bytes > self.max_bytes:
+            leaves, stack = [], [self.root]
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif node is not self.root:
+                    leaves.append(node)
+            if not leaves:
+                return
+            leaf = min(leaves, key=lambda node: node.last_used)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.bytes -= leaf.nbytes
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {"lookups": self.lookups,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "prefill_tokens_saved": self.tokens_saved,
+                "prefill_tokens_saved_rate": self.tokens_saved / self.prompt_tokens if self.prompt_tokens else 0.0,
+                "size_mb": self.bytes / 1024 ** 2,
+                "max_mb": self.max_bytes / 1024 ** 2,
+                "evictions": self.evictions}
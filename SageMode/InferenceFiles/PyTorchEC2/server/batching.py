@@ -0,0 +1,101 @@
+import asyncio
+from typing import Callable, Optional
+import torch
+
+def split_output(output, sizes:list[int]) -> list:
+    if isinstance(output, torch.Tensor):
+        return list(torch.split(output, sizes))
+    if isinstance(output, (tuple, list)):
+        return [type(output)(parts) for parts in zip(*[split_output(item, sizes) for item in output])]
+    if isinstance(output, dict):
+        split_values = {key: split_output(value, sizes) for key, value in output.items()}
+        return [{key: split_values[key][i] for key in output} for i in range(len(sizes))]
+    raise TypeError(f"Cannot split a model output of type {type(output).__name__} back into requests.")
+
+class MicroBatcher:
+
+    def __init__(self, forward:Callable, max_batch_size:int, max_wait_ms:float, on_batch:Optional[Callable] = None):
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # called with the rows in each batch and how long each of its requests waited in the queue
+        self.on_batch = on_batch
+        self.queue = None
+        self.worker = None
+        self.carry = None
+
+    async def submit(self, model_input:torch.Tensor):
+        # the queue and worker task are created lazily so they belong to the event loop serving requests
+        loop = asyncio.get_running_loop()
+        if self.worker is None:
+            self.queue = asyncio.Queue()
+            self.worker = loop.create_task(self.run())
+        future = loop.create_future()
+        await self.queue.put((model_input, future, loop.time()))
+        return await future
+
+    async def collect(self) -> list[tuple]:
+        loop = asyncio.get_running_loop()
+        if self.carry is not None:
+            batch, self.carry = [self.carry], None
+        else:
+            batch = [await self.queue.get()]
+        rows = self.rows(batch[0][0])
+        deadline = loop.time() + self.max_wait
+        while rows < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if rows + self.rows(item[0]) > self.max_batch_size:
+                self.carry = item
+                break
+            batch.append(item)
+            rows += self.rows(item[0])
+        return batch
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            inputs = [model_input for model_input, _, _ in batch]
+            if self.on_batch is not None:
+                now = loop.time()
+                self.on_batch(sum(self.rows(model_input) for model_input in inputs), [now - enqueued_at for _, _, enqueued_at in batch])
+            try:
+                outputs = await loop.run_in_executor(None, self.run_batch, inputs)
+            except Exception as e:
+                outputs = [e] * len(batch)
+            for (_, future, _), output in zip(batch, outputs):
+                if future.done():
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+    def run_batch(self, inputs:list) -> list:
+        if len(inputs) == 1 or not self.can_concatenate(inputs):
+            return [self.forward(model_input) for model_input in inputs]
+        sizes = [model_input.shape[0] for model_input in inputs]
+        output = self.forward(torch.cat(inputs))
+        return split_output(output, sizes)
+
+    @staticmethod
+    def rows(model_input) -> int:
+        if isinstance(model_input, torch.Tensor) and model_input.dim() > 0:
+            return model_input.shape[0]
+        return 1
+
+    @staticmethod
+    def can_concatenate(inputs:list) -> bool:
+        first = inputs[0]
+        if not isinstance(first, torch.Tensor) or first.dim() == 0:
+            return False
+        return all(isinstance(model_input, torch.Tensor) and
+                   model_input.shape[1:] == first.shape[1:] and
+                   model_input.dtype == first.dtype
+                   for model_input in inputs)
@@ -0,0 +1,97 @@
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import transport
+
+class ResultCache:
+
+    def __init__(self, max_entries:int, ttl_seconds:float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(body:bytes, content_type:str, binary_response:bool):
+        # returns None for a body that is not valid JSON, the request then skips the cache and the handler rejects it
+        digest = hashlib.sha256()
+        if transport.is_binary(content_type):
+            digest.update(b"binary:")
+            digest.update(body)
+        else:
+            # the same JSON object with a different key order or whitespace must map to the same entry
+            try:
+                canonical = json.dumps(json.loads(body), sort_keys=True, separators=(",", ":"))
+            except ValueError:
+                return None
+            digest.update(b"json:")
+            digest.update(canonical.encode())
+        digest.update(b":binary" if binary_response else b":json")
+        return digest.hexdigest()
+
+    def lookup(self, key:str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if self.ttl_seconds > 0 and expires_at < time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def store(self, key:str, value:bytes) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, key:str, compute:Callable[[], Awaitable[bytes]]) -> bytes:
+        value = self.lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        # identical requests that arrive while the first one is still running wait for its result instead of running the model again
+        if key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved in case nobody else was waiting on it
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+        self.store(key, value)
+        future.set_result(value)
+        return value
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations}
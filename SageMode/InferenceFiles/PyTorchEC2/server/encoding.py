@@ -0,0 +1,39 @@
+import gzip
+
+class GzipRequestMiddleware:
+    # decodes request bodies sent with "Content-Encoding: gzip" (the Lambda proxy does this for large JSON bodies),
+    # so the endpoints always see the plain body. responses are left alone
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        if headers.get(b"content-encoding", b"").lower() != b"gzip":
+            return await self.app(scope, receive, send)
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        try:
+            body = gzip.decompress(b"".join(chunks))
+        except (OSError, EOFError):
+            await send({"type": "http.response.start", "status": 400, "headers": [(b"content-type", b"application/json")]})
+            return await send({"type": "http.response.body", "body": b'{"detail":"The request body is not valid gzip."}'})
+
+        headers.pop(b"content-encoding")
+        headers[b"content-length"] = str(len(body)).encode()
+        scope = {**scope, "headers": list(headers.items())}
+        sent = False
+        async def receive_decoded():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await self.app(scope, receive_decoded, send)
@@ -0,0 +1,108 @@
+import os
+import json
+import asyncio
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from continuous_batching import ContinuousBatchingEngine
+from prefix_cache import PrefixCache
+from decoding import IncrementalDecoder
+from encoding import GzipRequestMiddleware
+from payload_offload import LazyPayload, InvalidReference, offload
+
+config_path = "server_config.json"
+
+config = {"model_dir": "hf_model", 
+          "max_batch_size": 16, 
+          "block_size": 16, 
+          "max_cache_tokens": None,
+          "prefix_cache_mb": 0}
+if os.path.exists(config_path):
+    with open(config_path) as config_file:
+        config.update(json.load(config_file))
+
+model = AutoModelForCausalLM.from_pretrained(config["model_dir"], torch_dtype="auto")
+tokenizer = AutoTokenizer.from_pretrained(config["model_dir"])
+prefix_cache = PrefixCache(config["prefix_cache_mb"]) if config["prefix_cache_mb"] > 0 else None
+engine = ContinuousBatchingEngine(model, tokenizer, config["max_batch_size"], config["block_size"], config["max_cache_tokens"], prefix_cache)
+app = FastAPI()
+app.add_middleware(GzipRequestMiddleware)
+
+@app.on_event("startup")
+def startup() -> None:
+    # the engine thread is started in every worker after it has been forked
+    engine.start()
+
+@app.exception_handler(InvalidReference)
+def invalid_reference(request:Request, error:InvalidReference) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"detail": str(error)})
+
+@app.get("/health")
+def health() -> dict:
+    return {"status": "ok"}
+
+def sse_event(payload:dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+def stream(prompt:str, parameters:dict) -> StreamingResponse:
+    # tokens go from the engine thread to the response as they are generated, as the same events the SageMaker inference file sends
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    try:
+        sequence = engine.create_sequence(prompt, parameters,
+                                          on_token=lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token),
+                                          on_finish=lambda sequence: loop.call_soon_threadsafe(tokens.put_nowait, None))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    engine.enqueue([sequence])
+
+    async def events():
+        decoder = IncrementalDecoder(tokenizer)
+        try:
+            while (token := await tokens.get()) is not None:
+                text = decoder.add(token)
+                if text:
+                    yield sse_event({"token": text})
+            text = decoder.flush()
+            if text:
+                yield sse_event({"token": text})
+            if sequence.error is not None:
+                yield sse_event({"error": str(sequence.error)})
+            yield "data: [DONE]\n\n"
+        finally:
+            # a client that went away stops its sequence instead of leaving it to run to max_new_tokens
+            if not sequence.finished.is_set():
+                engine.cancel(sequence)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/predict")
+async def predict(request:Request) -> dict:
+    data = LazyPayload(await request.json())
+    prompts = data.get("inputs", data.get("text"))
+    parameters = data.get("parameters") or {}
+    single_prompt = isinstance(prompts, str)
+    if data.get("stream", False):
+        if not single_prompt:
+            raise HTTPException(status_code=400, detail="Only a single prompt can be streamed.")
+        return stream(prompts, parameters)
+    if single_prompt:
+        prompts = [prompts]
+
+    loop = asyncio.get_running_loop()
+    futures = [loop.create_future() for _ in prompts]
+    def on_finish(future):
+        # called on the engine thread
+        return lambda sequence: loop.call_soon_threadsafe(future.set_result, sequence)
+    # every prompt is checked before any is queued, a bad prompt late in the list must not leave the earlier ones running
+    try:
+        sequences = [engine.create_sequence(prompt, parameters, on_finish=on_finish(future)) for prompt, future in zip(prompts, futures)]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    engine.enqueue(sequences)
+    texts = [sequence.wait() for sequence in await asyncio.gather(*futures)]
+    return offload({"text": texts[0] if single_prompt else texts, "parameters": None}, data.settings)
+
+@app.get("/engine")
+def engine_stats() -> dict:
+    return engine.stats()
@@ -0,0 +1,95 @@
+import sys
+import json
+import time
+import resource
+import importlib
+import torch
+from onnx_model import OnnxModel
+
+def peak_rss_mb() -> float:
+    # VmHWM belongs to this process image only, ru_maxrss also counts whatever the parent had reached before forking us
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def has_meta_tensors(model:torch.nn.Module) -> bool:
+    return any(tensor.is_meta for tensor in list(model.parameters()) + list(model.buffers()))
+
+def tied_parameters(model:torch.nn.Module) -> list[list[str]]:
+    # names that refer to the same Parameter object, e.g. an output layer tied to the embedding
+    groups = {}
+    for name, parameter in model.named_parameters(remove_duplicate=False):
+        groups.setdefault(id(parameter), []).append(name)
+    return [names for names in groups.values() if len(names) > 1]
+
+def tie_parameters(model:torch.nn.Module, groups:list[list[str]]) -> None:
+    # load_state_dict(assign=True) gives every name its own Parameter, which would leave tied weights as two separate tensors
+    for names in groups:
+        parameter = model.get_parameter(names[0])
+        for name in names[1:]:
+            module_name, _, attribute = name.rpartition(".")
+            setattr(model.get_submodule(module_name), attribute, parameter)
+    if hasattr(model, "tie_weights"):
+        # huggingface models tie their embeddings themselves
+        model.tie_weights()
+
+def assign_state_dict(model:torch.nn.Module, state_dict:dict) -> None:
+    groups = tied_parameters(model)
+    model.load_state_dict(state_dict, assign=True)
+    tie_parameters(model, groups)
+
+def load_safetensors(path:str) -> torch.nn.Module:
+    from safetensors import safe_open
+    from safetensors.torch import load_file
+    # safetensors memory-maps the file, so the tensors are backed by the page cache instead of a second copy in RAM
+    state_dict = load_file(path)
+    # tied tensors are stored once by the conversion, every other name of the tensor is listed in the metadata
+    with safe_open(path, framework="pt") as weights_file:
+        metadata = weights_file.metadata() or {}
+    for alias, name in json.loads(metadata.get("sagemode_aliases", "{}")).items():
+        state_dict[alias] = state_dict[name]
+    try:
+        # building the module on the meta device skips allocating and initializing weights that are replaced right away
+        with torch.device("meta"):
+            model = importlib.import_module("model").model
+        assign_state_dict(model, state_dict)
+        if not has_meta_tensors(model):
+            return model
+        print("model has tensors that are not in the checkpoint, falling back to a regular initialization", flush=True)
+    except Exception as e:
+        print(f"could not build the model on the meta device ({e}), falling back to a regular initialization", flush=True)
+    sys.modules.pop("model", None)
+    model = importlib.import_module("model").model
+    assign_state_dict(model, state_dict)
+    return model
+
+def load_model(path:str, engine:str = "eager"):
+    t_start = time.time()
+    if engine == "torchscript":
+        model = torch.jit.load(path, map_location="cpu")
+    elif engine == "onnx":
+        model = OnnxModel(path)
+    elif path.endswith(".safetensors"):
+        model = load_safetensors(path)
+    else:
+        model = importlib.import_module("model").model
+        model.load_state_dict(torch.load(path))
+    if isinstance(model, torch.nn.Module):
+        model.eval()
+    print(f"model loaded from {path} in {time.time() - t_start:.2f} seconds, peak RSS {peak_rss_mb():.1f} MB", flush=True)
+    return model
+
+def warm_up(forward, sample_input:torch.Tensor, iterations:int, batch_sizes:list[int]) -> None:
+    # the first passes pay for JIT profiling, kernel selection and allocator growth, so run them before taking traffic
+    t_start = time.time()
+    for batch_size in sorted(set(batch_sizes)):
+        repeats = max(1, batch_size // sample_input.shape[0])
+        batch = sample_input.repeat(repeats, *[1] * (sample_input.dim() - 1))
+        for _ in range(iterations):
+            forward(batch)
+    print(f"warmed up with {iterations} passes per batch size {sorted(set(batch_sizes))} in {time.time() - t_start:.2f} seconds", flush=True)
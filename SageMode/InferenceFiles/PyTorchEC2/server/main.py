@@ -1,18 +1,162 @@
-from fastapi import FastAPI
+import os
+import json
+import asyncio
+from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 import torch
-from model import model
 from pre_process import pre_process
 from post_process import post_process
+from batching import MicroBatcher
+from cache import ResultCache
+from loading import load_model, warm_up
+from metrics import Metrics, Profiler
+import transport
+from encoding import GzipRequestMiddleware
+from payload_offload import LazyPayload, InvalidReference, offload
 
-path = "weights.pth"
+config_path = "server_config.json"
 
-model.load_state_dict(torch.load(path))
-model.eval()
+config = {"weights": "weights.pth", 
+          "engine": "eager", 
+          "sample_input": None, 
+          "warmup_iterations": 3, 
+          "max_batch_size": 1, 
+          "max_wait_ms": 5, 
+          "cache_size": 0, 
+          "cache_ttl": 0}
+if os.path.exists(config_path):
+    with open(config_path) as config_file:
+        config.update(json.load(config_file))
+
+model = load_model(config["weights"], config["engine"])
 app = FastAPI()
+app.add_middleware(GzipRequestMiddleware)
+
+# created before serve.py forks so every worker writes into the same shared block, a worker never uses more than one core
+metrics = Metrics(len(os.sched_getaffinity(0)) + 1)
+profiler = Profiler()
+
+def forward(model_input):
+    with torch.inference_mode():
+        return model(model_input)
+
+def timed_forward(model_input):
+    with metrics.time("forward"):
+        return forward(model_input)
+
+def decode_request(body:bytes, content_type:str) -> dict:
+    if transport.is_binary(content_type):
+        return transport.decode(body)
+    try:
+        request_data = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="The request body is not valid JSON.")
+    # fields that the client offloaded to S3 are downloaded when pre_process reads them
+    return LazyPayload(request_data)
+
+def encode_response(result:dict, binary:bool, offload_settings:dict) -> bytes:
+    if binary:
+        return transport.encode(result)
+    result = offload(result, offload_settings, default=transport.to_json)
+    return json.dumps(result, default=transport.to_json).encode()
+
+def prepare(body:bytes, content_type:str):
+    with metrics.time("decode"):
+        request_data = decode_request(body, content_type)
+    with metrics.time("pre_process"):
+        return pre_process(request_data), getattr(request_data, "settings", None)
+
+def finish(raw_output, binary:bool, offload_settings:dict) -> bytes:
+    with metrics.time("post_process"):
+        post_process_result = post_process(raw_output)
+    with metrics.time("encode"):
+        return encode_response(post_process_result, binary, offload_settings)
+
+def run_pipeline(body:bytes, content_type:str, binary:bool) -> bytes:
+    pre_process_result, offload_settings = prepare(body, content_type)
+    metrics.observe("batch_size", MicroBatcher.rows(pre_process_result))
+    raw_output = timed_forward(pre_process_result)
+    return finish(raw_output, binary, offload_settings)
+
+def record_batch(rows:int, waits:list[float]) -> None:
+    metrics.observe("batch_size", rows)
+    metrics.add("queue_depth", -len(waits))
+    for wait in waits:
+        metrics.observe("queue_wait", wait)
+
+if config["max_batch_size"] > 1:
+    batcher = MicroBatcher(lambda model_input: profiler.run(timed_forward, model_input), config["max_batch_size"], config["max_wait_ms"], record_batch)
+
+    async def run_model(body:bytes, content_type:str, binary:bool) -> bytes:
+        pre_process_result, offload_settings = await run_in_threadpool(profiler.run, prepare, body, content_type)
+        metrics.add("queue_depth", 1)
+        raw_output = await batcher.submit(pre_process_result)
+        return await run_in_threadpool(profiler.run, finish, raw_output, binary, offload_settings)
+else:
+    async def run_model(body:bytes, content_type:str, binary:bool) -> bytes:
+        return await run_in_threadpool(profiler.run, run_pipeline, body, content_type, binary)
+
+@app.on_event("startup")
+def startup() -> None:
+    # startup runs in every worker before it accepts connections
+    if config["sample_input"] is not None and config["warmup_iterations"] > 0:
+        sample_input = torch.load(config["sample_input"])
+        warm_up(forward, sample_input, config["warmup_iterations"], [sample_input.shape[0], config["max_batch_size"]])
+
+@app.exception_handler(InvalidReference)
+def invalid_reference(request:Request, error:InvalidReference) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"detail": str(error)})
+
+@app.get("/health")
+def health() -> dict:
+    return {"status": "ok"}
+
+cache = ResultCache(config["cache_size"], config["cache_ttl"]) if config["cache_size"] > 0 else None
 
 @app.post("/predict")
-def predict(data:dict) -> dict:
-    pre_process_result = pre_process(data)
-    raw_output = model(pre_process_result)
-    post_process_result = post_process(raw_output)
-    return post_process_result
\ No newline at end of file
+async def predict(request:Request) -> Response:
+    body = await request.body()
+    content_type = request.headers.get("content-type")
+    binary = transport.is_binary(request.headers.get("accept"))
+    metrics.add("in_flight", 1)
+    try:
+        with metrics.time("request"):
+            key = None if cache is None else await run_in_threadpool(ResultCache.key, body, content_type, binary)
+            if key is None:
+                result = await run_model(body, content_type, binary)
+            else:
+                result = await cache.get_or_compute(key, lambda: run_model(body, content_type, binary))
+    except Exception:
+        metrics.add("errors")
+        raise
+    finally:
+        metrics.add("in_flight", -1)
+        metrics.add("requests")
+        profiler.request_finished()
+    return Response(content=result, media_type=transport.CONTENT_TYPE if binary else "application/json")
+
+@app.get("/cache")
+def cache_stats() -> dict:
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def debug_profile(n:int = 10, timeout:float = 60, sort:str = "cumulative", limit:int = 50) -> Response:
+    # profiles the next n requests handled by the worker that receives this call and returns the cProfile report
+    if n < 1:
+        raise HTTPException(status_code=400, detail="'n' must be at least 1.")
+    if profiler.active:
+        raise HTTPException(status_code=409, detail="A profile is already being captured.")
+    try:
+        await asyncio.wait_for(asyncio.shield(profiler.capture(n)), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        profiler.stop()
+    return Response(content=profiler.report(sort, limit), media_type="text/plain")
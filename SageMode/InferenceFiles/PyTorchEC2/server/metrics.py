@@ -0,0 +1,210 @@
+import io
+import os
+import time
+import bisect
+import pstats
+import asyncio
+import cProfile
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+latency_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+batch_size_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+stages = ["decode", "pre_process", "queue_wait", "forward", "post_process", "encode", "request"]
+histograms = {**{stage: latency_buckets for stage in stages}, "batch_size": batch_size_buckets}
+gauges = {"in_flight": "Requests currently being handled.",
+          "queue_depth": "Requests waiting for a batch."}
+counters = {"requests": "Requests handled.",
+            "errors": "Requests that raised an error."}
+
+def pid_alive(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def process_stats(pid:int) -> tuple[float, float]:
+    # resident memory in bytes and cpu seconds used, read straight from procfs so a scrape costs two small reads per worker
+    with open(f"/proc/{pid}/statm") as statm_file:
+        rss = int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    with open(f"/proc/{pid}/stat") as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return rss, cpu_seconds
+
+def format_value(value:float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+class Metrics:
+
+    def __init__(self, slots:int):
+        # one row of counters per worker process in shared memory allocated before the workers are forked,
+        # so a scrape that lands on any worker reports the totals of all of them
+        self.layout = {}
+        width = 0
+        for name, buckets in histograms.items():
+            self.layout[name] = width
+            width += len(buckets) + 3
+        for name in list(gauges) + list(counters):
+            self.layout[name] = width
+            width += 1
+        self.pid_offset = width
+        self.width = width + 1
+        self.slots = slots
+        self.values = multiprocessing.RawArray("d", slots * self.width)
+        self.claim_lock = multiprocessing.Lock()
+        self.lock = threading.Lock()
+        self.slot = None
+        self.slot_pid = None
+
+    def base(self) -> int:
+        if self.slot_pid != os.getpid():
+            self.claim()
+        return self.slot * self.width
+
+    def claim(self) -> None:
+        # a restarted worker takes over the row of the worker it replaces, which keeps the counters monotonic
+        pid = os.getpid()
+        with self.claim_lock:
+            for slot in range(self.slots):
+                slot_pid = int(self.values[slot * self.width + self.pid_offset])
+                if slot_pid == pid or slot_pid == 0 or not pid_alive(slot_pid):
+                    break
+            else:
+                raise RuntimeError(f"All {self.slots} metrics slots are taken.")
+            base = slot * self.width
+            for name in gauges:
+                self.values[base + self.layout[name]] = 0
+            self.values[base + self.pid_offset] = pid
+        self.slot, self.slot_pid = slot, pid
+
+    def observe(self, name:str, value:float) -> None:
+        buckets = histograms[name]
+        offset = self.base() + self.layout[name]
+        index = bisect.bisect_left(buckets, value)
+        with self.lock:
+            self.values[offset + index] += 1
+            self.values[offset + len(buckets) + 1] += value
+            self.values[offset + len(buckets) + 2] += 1
+
+    def add(self, name:str, amount:float = 1) -> None:
+        offset = self.base() + self.layout[name]
+        with self.lock:
+            self.values[offset] += amount
+
+    @contextmanager
+    def time(self, stage:str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def render(self) -> str:
+        rows = [slot * self.width for slot in range(self.slots) if self.values[slot * self.width + self.pid_offset] != 0]
+        total = lambda offset: sum(self.values[row + offset] for row in rows)
+        lines = []
+
+        lines.append("# HELP sagemode_stage_seconds Time spent in each stage of a request.")
+        lines.append("# TYPE sagemode_stage_seconds histogram")
+        for stage in stages:
+            lines += self.render_histogram("sagemode_stage_seconds", f'stage="{stage}",', stage, total)
+        lines.append("# HELP sagemode_batch_size Rows in each forward pass.")
+        lines.append("# TYPE sagemode_batch_size histogram")
+        lines += self.render_histogram("sagemode_batch_size", "", "batch_size", total)
+
+        for name, description in gauges.items():
+            lines.append(f"# HELP sagemode_{name} {description}")
+            lines.append(f"# TYPE sagemode_{name} gauge")
+            lines.append(f"sagemode_{name} {format_value(total(self.layout[name]))}")
+        for name, description in counters.items():
+            lines.append(f"# HELP sagemode_{name}_total {description}")
+            lines.append(f"# TYPE sagemode_{name}_total counter")
+            lines.append(f"sagemode_{name}_total {format_value(total(self.layout[name]))}")
+
+        memory_lines, cpu_lines = [], []
+        for row in rows:
+            pid = int(self.values[row + self.pid_offset])
+            try:
+                rss, cpu_seconds = process_stats(pid)
+            except (OSError, ValueError, IndexError):
+                continue
+            memory_lines.append(f'process_resident_memory_bytes{{worker="{pid}"}} {rss}')
+            cpu_lines.append(f'process_cpu_seconds_total{{worker="{pid}"}} {cpu_seconds}')
+        lines += ["# HELP process_resident_memory_bytes Resident memory of each worker.", "# TYPE process_resident_memory_bytes gauge"] + memory_lines
+        lines += ["# HELP process_cpu_seconds_total CPU time used by each worker.", "# TYPE process_cpu_seconds_total counter"] + cpu_lines
+        return "\n".join(lines) + "\n"
+
+    def render_histogram(self, metric:str, labels:str, name:str, total) -> list[str]:
+        buckets = histograms[name]
+        offset = self.layout[name]
+        lines, cumulative = [], 0
+        for index, bound in enumerate(buckets + ["+Inf"]):
+            cumulative += total(offset + index)
+            lines.append(f'{metric}_bucket{{{labels}le="{bound}"}} {format_value(cumulative)}')
+        braces = f"{{{labels.rstrip(',')}}}" if labels else ""
+        lines.append(f"{metric}_sum{braces} {format_value(total(offset + len(buckets) + 1))}")
+        lines.append(f"{metric}_count{braces} {format_value(total(offset + len(buckets) + 2))}")
+        return lines
+
+class Profiler:
+
+    def __init__(self):
+        self.remaining = 0
+        self.stats = None
+        self.done = None
+        self.lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        return self.remaining > 0
+
+    def capture(self, requests:int) -> asyncio.Future:
+        self.remaining = requests
+        self.stats = None
+        self.done = asyncio.get_running_loop().create_future()
+        return self.done
+
+    def run(self, function, *args):
+        # only the calls made while a capture is armed pay for profiling
+        if not self.active:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is already running in this interpreter
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def request_finished(self) -> None:
+        if not self.active:
+            return
+        self.remaining -= 1
+        if self.remaining == 0 and not self.done.done():
+            self.done.set_result(None)
+
+    def stop(self) -> None:
+        self.remaining = 0
+
+    def report(self, sort:str, limit:int) -> str:
+        with self.lock:
+            if self.stats is None:
+                return "No requests were profiled.\n"
+            buffer = io.StringIO()
+            self.stats.stream = buffer
+            self.stats.sort_stats(sort).print_stats(limit)
+            return buffer.getvalue()
@@ -0,0 +1,115 @@
+import os
+import gc
+import sys
+import json
+import signal
+import socket
+import argparse
+import importlib
+import torch
+import uvicorn
+
+config_path = "server_config.json"
+
+def read_config() -> dict:
+    config = {"app": "main", "workers": 1, "threads_per_worker": 0}
+    if os.path.exists(config_path):
+        with open(config_path) as config_file:
+            config.update(json.load(config_file))
+    return config
+
+def sibling_order(cores:list[int]) -> list[int]:
+    # keep hyperthreads of the same physical core next to each other so that a worker never shares a core with another worker
+    def physical_core(cpu:int) -> tuple:
+        topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        try:
+            with open(f"{topology}/physical_package_id") as package_file, open(f"{topology}/core_id") as core_file:
+                return (int(package_file.read()), int(core_file.read()), cpu)
+        except (OSError, ValueError):
+            return (0, cpu, cpu)
+    return sorted(cores, key=physical_core)
+
+def plan_workers(cores:list[int], workers:int = 0, threads_per_worker:int = 0) -> list[list[int]]:
+    if workers <= 0:
+        if threads_per_worker <= 0:
+            threads_per_worker = 4 if len(cores) >= 16 else 2 if len(cores) >= 4 else 1
+        workers = max(1, len(cores) // threads_per_worker)
+    elif threads_per_worker <= 0:
+        threads_per_worker = max(1, len(cores) // workers)
+    if workers * threads_per_worker > len(cores):
+        raise ValueError(f"{workers} workers with {threads_per_worker} threads each need more than the {len(cores)} cores available.")
+    ordered_cores = sibling_order(cores)
+    return [ordered_cores[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(workers)]
+
+def run_worker(app, sock:socket.socket, cores:list[int]) -> None:
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    print(f"worker {os.getpid()} pinned to cores {cores}", flush=True)
+    server = uvicorn.Server(uvicorn.Config(app, log_level="info"))
+    server.run(sockets=[sock])
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    config = read_config()
+    layout = plan_workers(sorted(os.sched_getaffinity(0)), config["workers"], config["threads_per_worker"])
+
+    # a single intra-op thread in the parent keeps the OpenMP pool uninitialised, which is required for forking safely
+    torch.set_num_threads(1)
+    # 'main' serves model.py with pre_process/post_process, 'llm' serves a huggingface causal LM with continuous batching
+    app = importlib.import_module(config["app"]).app
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    if len(layout) == 1:
+        run_worker(app, sock, layout[0])
+        return
+
+    # move everything allocated so far (including the model) out of the collector's reach so that
+    # workers do not dirty the shared copy-on-write pages when they run a collection
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+
+    def spawn(cores:list[int]) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                run_worker(app, sock, cores)
+            finally:
+                os._exit(0)
+        children[pid] = cores
+
+    def shutdown(signum, frame) -> None:
+        for pid in list(children):
+            os.kill(pid, signal.SIGTERM)
+        for pid in list(children):
+            os.waitpid(pid, 0)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for cores in layout:
+        spawn(cores)
+    print(f"started {len(layout)} workers with {len(layout[0])} threads each", flush=True)
+
+    while True:
+        pid, status = os.wait()
+        cores = children.pop(pid, None)
+        if cores is not None:
+            print(f"worker {pid} exited with status {status}, restarting it", flush=True)
+            spawn(cores)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import json
+import struct
+import warnings
+import torch
+
+# tensors travel as raw buffers after a small JSON header:
+# [8 byte little endian header length][header][padding][buffer 0][padding][buffer 1]...
+# the header holds the plain JSON fields and, for every tensor field, its dtype, shape, size and
+# offset from the first 64 byte aligned position after the header
+CONTENT_TYPE = "application/x-sagemode-tensors"
+ALIGNMENT = 64
+
+# decoded tensors are views over the immutable request body, pre_process must not modify them in place
+warnings.filterwarnings("ignore", message="The given buffer is not writable")
+
+def is_binary(content_type:str) -> bool:
+    return content_type is not None and CONTENT_TYPE in content_type
+
+def data_start(header_length:int) -> int:
+    start = 8 + header_length
+    return start + (-start % ALIGNMENT)
+
+def decode(body:bytes) -> dict:
+    (header_length,) = struct.unpack_from("<Q", body, 0)
+    header = json.loads(body[8:8 + header_length])
+    start = data_start(header_length)
+    data = header["fields"]
+    for name, spec in header["tensors"].items():
+        dtype = getattr(torch, spec["dtype"])
+        if spec["nbytes"] == 0:
+            data[name] = torch.empty(spec["shape"], dtype=dtype)
+            continue
+        count = spec["nbytes"] // torch.empty((), dtype=dtype).element_size()
+        data[name] = torch.frombuffer(body, dtype=dtype, count=count, offset=start + spec["offset"]).reshape(spec["shape"])
+    return data
+
+def array_buffer(array) -> memoryview:
+    # a flat byte view, memoryview.cast refuses arrays with a zero in their shape
+    return memoryview(array.reshape(-1).view("uint8"))
+
+def tensor_buffer(tensor:torch.Tensor) -> memoryview:
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    return array_buffer(tensor.numpy())
+
+def encode(data:dict) -> bytes:
+    fields, tensors, buffers = {}, {}, []
+    for name, value in data.items():
+        if isinstance(value, torch.Tensor):
+            tensors[name] = {"dtype": str(value.dtype).replace("torch.", ""), "shape": list(value.shape)}
+            buffers.append((name, tensor_buffer(value)))
+        elif type(value).__module__ == "numpy" and hasattr(value, "dtype"):
+            tensors[name] = {"dtype": str(value.dtype), "shape": list(value.shape)}
+            buffers.append((name, array_buffer(value if value.flags.c_contiguous else value.copy())))
+        else:
+            fields[name] = value
+
+    # offsets are relative to the first aligned byte after the header
+    offset = 0
+    for name, buffer in buffers:
+        offset += -offset % ALIGNMENT
+        tensors[name]["offset"] = offset
+        tensors[name]["nbytes"] = buffer.nbytes
+        offset += buffer.nbytes
+    header = json.dumps({"fields": fields, "tensors": tensors}).encode()
+
+    parts = [struct.pack("<Q", len(header)), header, b"\0" * (data_start(len(header)) - 8 - len(header))]
+    position = 0
+    for name, buffer in buffers:
+        parts.append(b"\0" * (tensors[name]["offset"] - position))
+        parts.append(buffer)
+        position = tensors[name]["offset"] + buffer.nbytes
+    return b"".join(parts)
+
+def to_json(value):
+    # tensors and numpy arrays returned by post_process become nested lists in JSON responses
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
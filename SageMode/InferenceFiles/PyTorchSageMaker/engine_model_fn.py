@@ -0,0 +1,23 @@
+import os
+import torch
+from onnx_model import OnnxModel
+
+def model_fn(model_dir):
+    # used in place of a user supplied model_fn when the model was deployed with a compiled engine
+    torchscript_path = os.path.join(model_dir, "model.ts")
+    onnx_path = os.path.join(model_dir, "model.onnx")
+    if os.path.exists(torchscript_path):
+        model = torch.jit.load(torchscript_path, map_location="cpu")
+    elif os.path.exists(onnx_path):
+        model = OnnxModel(onnx_path)
+    else:
+        raise FileNotFoundError(f"Neither model.ts nor model.onnx was found in {model_dir}.")
+
+    # run a few passes before the endpoint reports healthy so the first request does not pay for JIT and allocator setup
+    sample_input_path = os.path.join(model_dir, "sample_input.pt")
+    if os.path.exists(sample_input_path):
+        sample_input = torch.load(sample_input_path)
+        with torch.no_grad():
+            for _ in range(3):
+                model(sample_input)
+    return model
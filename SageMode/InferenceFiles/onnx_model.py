@@ -0,0 +1,25 @@
+import os
+import torch
+
+# the ONNX Runtime wrapper used by the EC2 server and the SageMaker engine model_fn, copied next to them when they are deployed
+
+class OnnxModel:
+
+    def __init__(self, path:str):
+        self.path = path
+        self.session = None
+        self.pid = None
+
+    def __call__(self, model_input:torch.Tensor):
+        # onnxruntime starts its thread pools with the session, and threads do not survive a fork,
+        # so every worker process builds its own session the first time it runs the model
+        if self.pid != os.getpid():
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            self.session = onnxruntime.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+            self.input_name = self.session.get_inputs()[0].name
+            self.pid = os.getpid()
+        outputs = self.session.run(None, {self.input_name: model_input.detach().cpu().numpy()})
+        outputs = [torch.from_numpy(output) for output in outputs]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
@@ -0,0 +1,84 @@
+import os
+import json
+import uuid
+import boto3
+
+# server side of the S3 claim check implemented in Helpers/PayloadOffload.py. large JSON fields cross the Lambda and
+# Step Functions hops as {"$sagemode_s3": "s3://bucket/key", "bytes": n} references, the client adds its offload settings
+# under "_sagemode_offload" and they travel with every output so each stage of a chain offloads the same way
+reference_key = "$sagemode_s3"
+settings_key = "_sagemode_offload"
+
+s3_client = None
+
+def client():
+    # created on first use, servers that never see a reference do not need S3 access
+    global s3_client
+    if s3_client is None:
+        s3_client = boto3.client("s3")
+    return s3_client
+
+def is_reference(value) -> bool:
+    return isinstance(value, dict) and reference_key in value
+
+class InvalidReference(ValueError):
+    pass
+
+def allowed_location(settings:dict) -> tuple[str, str]:
+    # references are only read from, and outputs only written to, the bucket and prefix of the offload settings.
+    # the settings come with the request, so PAYLOAD_BUCKET on the server pins the bucket callers may name
+    if not settings:
+        raise InvalidReference("The request holds an S3 reference but no offload settings.")
+    server_bucket = os.environ.get("PAYLOAD_BUCKET")
+    if server_bucket and settings["bucket"] != server_bucket:
+        raise InvalidReference(f"Offloaded payloads must be in the bucket '{server_bucket}', not '{settings['bucket']}'.")
+    return settings["bucket"], settings["prefix"]
+
+def fetch(reference:dict, settings:dict):
+    bucket, key = reference[reference_key][len("s3://"):].split("/", 1)
+    allowed_bucket, prefix = allowed_location(settings)
+    if bucket != allowed_bucket or not key.startswith(f"{prefix}/"):
+        raise InvalidReference(f"The reference {reference[reference_key]} is outside s3://{allowed_bucket}/{prefix}/.")
+    return json.loads(client().get_object(Bucket=bucket, Key=key)["Body"].read())
+
+class LazyPayload(dict):
+    # a referenced field is downloaded the first time it is read and kept. serializing the payload or iterating over
+    # items() sees the references themselves, so a field that is only forwarded is never downloaded
+
+    def __init__(self, data:dict):
+        super().__init__(data)
+        self.settings = super().pop(settings_key, None)
+
+    def __getitem__(self, name):
+        value = super().__getitem__(name)
+        if is_reference(value):
+            value = fetch(value, self.settings)
+            super().__setitem__(name, value)
+        return value
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def pop(self, name, *default):
+        if name not in self:
+            return super().pop(name, *default)
+        value = self[name]
+        del self[name]
+        return value
+
+def offload(output, settings:dict, default=None):
+    # output fields that serialize to at least settings["threshold"] bytes are written to S3 and replaced by references
+    if not settings or not isinstance(output, dict):
+        return output
+    bucket, prefix = allowed_location(settings)
+    offloaded = {}
+    for name, value in output.items():
+        if not is_reference(value):
+            body = json.dumps(value, separators=(",", ":"), default=default).encode()
+            if len(body) >= settings["threshold"]:
+                key = f"{prefix}/{uuid.uuid4().hex}/{name}.json"
+                client().put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/json")
+                value = {reference_key: f"s3://{bucket}/{key}", "bytes": len(body)}
+        offloaded[name] = value
+    offloaded[settings_key] = settings
+    return offloaded
@@ -1,14 +1,44 @@
 import os
+import gzip
 import json
+import base64
 import requests
+from requests.adapters import HTTPAdapter
 
 DNS = os.environ["DNS_NAME"]
 PORT = os.environ["PORT"]
+# JSON bodies above this size are gzipped before they are posted, the server decodes them in its request middleware
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", 256 * 1024))
+# keeps a little of the invocation's time to turn a timeout into an error response instead of a killed invocation
+TIMEOUT_MARGIN_SECONDS = 0.25
+CONNECT_TIMEOUT_SECONDS = 3.0
+
+server_url = f"http://{DNS}:{PORT}/predict"
+# created once per execution environment, so warm invocations reuse the open keep-alive connection to the server
+session = requests.Session()
+# only failed connection attempts are retried, a request that reached the server may already have run the model
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=2))
+
+def timeouts(context) -> tuple:
+    if context is None:
+        return (CONNECT_TIMEOUT_SECONDS, None)
+    remaining = max(context.get_remaining_time_in_millis() / 1000 - TIMEOUT_MARGIN_SECONDS, 0.1)
+    return (min(CONNECT_TIMEOUT_SECONDS, remaining), remaining)
 
 def lambda_handler(event, context):
-    payload = json.dumps(event, indent=2).encode('utf-8')
-    payload = json.loads(payload)
-    server_url = f"http://{DNS}:{PORT}/predict"
-    response = requests.post(server_url, json=payload)
-    json_response = response.json()
-    return json_response
+    if "body_base64" in event:
+        # binary tensor payloads are posted as raw bytes and the binary response is handed back base64 encoded
+        content_type = event["content_type"]
+        body = base64.b64decode(event["body_base64"])
+        response = session.post(server_url, data=body, headers={"Content-Type": content_type, "Accept": content_type}, timeout=timeouts(context))
+        if response.headers.get("Content-Type", "").startswith(content_type):
+            return {"body_base64": base64.b64encode(response.content).decode(), "content_type": content_type}
+        return response.json()
+    # the event is serialized once, compactly, and posted as is
+    body = json.dumps(event, separators=(",", ":")).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+    response = session.post(server_url, data=body, headers=headers, timeout=timeouts(context))
+    return response.json()
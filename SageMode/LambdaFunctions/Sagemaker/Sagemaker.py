@@ -1,12 +1,28 @@
 import json
 import os
 import boto3
+from botocore.config import Config
 
 ENDPOINT_NAME = os.environ["ENDPOINT_NAME"]
-runtime = boto3.client("runtime.sagemaker")
+# SageMaker real-time endpoints answer within 60 seconds or fail
+ENDPOINT_TIMEOUT_SECONDS = 60
+# the function's own timeout, set by deploy. functions deployed before it was passed wait as long as the endpoint can take
+LAMBDA_TIMEOUT_SECONDS = float(os.environ.get("LAMBDA_TIMEOUT", ENDPOINT_TIMEOUT_SECONDS))
+# keeps a little of the invocation's time to turn a timeout into an error response instead of a killed invocation
+TIMEOUT_MARGIN_SECONDS = 0.25
+CONNECT_TIMEOUT_SECONDS = 3.0
+
+# botocore fixes the timeouts when the client is built, so they are sized from the function's timeout once per execution environment.
+# a retry would not fit in the time left after a read timeout, so the endpoint's answer or error is returned as is.
+# bodies are sent as the JSON the endpoint expects: the HF inference toolkit picks its decoder by content type and has no
+# content encoding, a PyTorch endpoint hands the raw body to the user's input_fn, and the event is already under the 6 MB that
+# InvokeEndpoint takes, so fields too large for it go through S3 (enable_payload_offload) instead of gzip or a binary body
+read_timeout = max(min(ENDPOINT_TIMEOUT_SECONDS, LAMBDA_TIMEOUT_SECONDS - TIMEOUT_MARGIN_SECONDS), 0.1)
+runtime = boto3.client("runtime.sagemaker", config=Config(connect_timeout=min(CONNECT_TIMEOUT_SECONDS, read_timeout), read_timeout=read_timeout,
+                                                            tcp_keepalive=True, retries={"total_max_attempts": 1, "mode": "standard"}))
 
 def lambda_handler(event, context):
-    payload = json.dumps(event, indent=2).encode('utf-8')
+    payload = json.dumps(event, separators=(",", ":")).encode('utf-8')
     response = runtime.invoke_endpoint(EndpointName=ENDPOINT_NAME, ContentType="application/json", Body=payload)
-    result = json.loads(response["Body"].read().decode())
-    return result
\ No newline at end of file
+    result = json.loads(response["Body"].read())
+    return result
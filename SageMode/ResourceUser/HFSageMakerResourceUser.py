@@ -1,88 +1,95 @@
 from pathlib import Path
 import os
+import json
 import time
-import tarfile
-import sagemaker
-from sagemaker.s3 import S3Uploader
-from dotenv import load_dotenv
 from shutil import rmtree, copytree
-from huggingface_hub import snapshot_download
-from sagemaker.huggingface.model import HuggingFaceModel
-from sagemode.Types.HFModels import model_types
-from sagemode.ResourceUser.ResourceUser import ResourceUser
-from sagemode.ResourceUser.LambdaResourceUser.SageMakerLambdaResourceUser import SageMakerLambdaResourceUser 
+from sagemode.Types.HFModels import inference_files
+from sagemode.ResourceUser.SageMakerResourceUser import SageMakerResourceUser
 from sagemode.Types.Arn import *
 from sagemode.Helpers.FileCopy import *
+from sagemode.Helpers.EventStream import stream_from_endpoint
+from sagemode.Helpers.Requirements import add_requirement
+from sagemode.Helpers.HFDownload import download_model
 
-class HFSageMakerResourceUser(ResourceUser):
+# sagemaker, huggingface_hub and torch are imported by the methods that need them, so calling use() on an
+# existing deployment does not pay for importing them
 
-    def __init__(self, instance_type:str, previous:dict[str, type] = None, next:dict[str, type] = None, lambda_arn:LambdaArn = None):
-        load_dotenv()
-        role_arn = RoleArn(os.environ["SAGEMAKER_ROLE_ARN"])
-        super().__init__(role_arn, previous, next)
-        self.instance_type = instance_type
-        self.lambda_user = SageMakerLambdaResourceUser(lambda_arn)  
-    
-    def create_bucket(self) -> None:
-        print("Creating bucket...")
-        sess = sagemaker.Session(self.boto3_session)
-        try:
-            self.bucket = sess.default_bucket()
-        except:
-            raise Exception("Unable to create bucket for session. Double check to make sure that your session is not 'None.'")
+class HFSageMakerResourceUser(SageMakerResourceUser):
 
-    def copy_from_huggingface(self, model_id:str) -> None:
+    def copy_from_huggingface(self, model_id:str, model_type:str = None) -> None:
+        if model_type is not None and model_type not in inference_files:
+            raise ValueError(f"'model_type' must be one of {list(inference_files)}.")
         os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
         model_tar_dir = os.path.join(os.getcwd(), model_id.split("/")[-1])
+        if os.path.exists(model_tar_dir):
+            # staged again from scratch, the weights are hardlinked from the HF cache so this costs nothing
+            print(f"Replacing the model directory staged earlier at {model_tar_dir}...")
+            rmtree(model_tar_dir)
         os.mkdir(model_tar_dir)
-        t_start = time.time()
         local_inference_file_directory = os.path.join(os.getcwd(), "code")
-        try:
-            snapshot_download(model_id, local_dir=str(model_tar_dir), local_dir_use_symlinks=False)
-            print(f"Huggingface model copied successfully. Time taken: {time.time() - t_start:.2f} seconds")
-        except:
-            raise ValueError("the model_id you have specified does not exist.")
-
-        for model_type in model_types:
-            try:
-                model_type.from_pretrained(model_id)
-                inference_file_name = model_type.__name__
-                inference_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', 'HFSageMaker', f"{inference_file_name}.py")
-                copy_file_to_directory(inference_file_path, local_inference_file_directory, "inference.py")    
-                break
-            except:
-                continue
+        # only the files the inference file loads are downloaded, into the shared HF cache, and hardlinked into model_tar_dir.
+        # model_type overrides the detection from config.json, e.g. for architectures that it does not describe
+        model_type, model_files = download_model(model_id, model_tar_dir, model_type)
+        self.model_type = model_type
+        inference_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', 'HFSageMaker', inference_files[model_type])
+        copy_file_to_directory(inference_file_path, local_inference_file_directory, "inference.py")
+        # the inference files read fields that the client offloaded to S3 through this module
+        payload_offload_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', "payload_offload.py")
+        copy_file_to_directory(payload_offload_path, local_inference_file_directory, "payload_offload.py")
+        if model_type == "AutoModelForCausalLM":
+            # token selection shared with the continuous batching engine
+            decoding_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', 'HFSageMaker', "decoding.py")
+            copy_file_to_directory(decoding_path, local_inference_file_directory, "decoding.py")
+        print(f"Serving the model with the {model_type} inference file.")
 
         self.model_dir = str(model_tar_dir)
         # copy code/ to model dir
         copytree(str(local_inference_file_directory), str(os.path.join(model_tar_dir, "code")))
+        if any(model_file.endswith(".safetensors") for model_file in model_files):
+            # the inference toolkit installs code/requirements.txt before loading the model, so the container can read safetensors
+            add_requirement(os.path.join(model_tar_dir, "code", "requirements.txt"), "safetensors==0.4.1")
 
-    def compress(self, output_file="model.tar.gz", skip=False) -> None:
-        self.output_file = str(os.path.join(os.getcwd(), output_file))
-        if skip:
-            print("You have selected to skip compressing your model. Skipping this step...")
-        else:
-            print("compressing directory...")
-            t_start = time.time()
-            parent_dir=os.getcwd()
-            os.chdir(self.model_dir)
-            with tarfile.open(self.output_file, "w:gz") as tar:
-                for item in os.listdir('.'):
-                    tar.add(item, arcname=item)
-            print(f"compression finished successfully. Time taken: {time.time() - t_start:.2f} seconds")
-            os.chdir(parent_dir)
+    def convert_weights_to_safetensors(self) -> None:
+        bin_path = os.path.join(self.model_dir, "pytorch_model.bin")
+        safetensors_path = os.path.join(self.model_dir, "model.safetensors")
+        if os.path.exists(safetensors_path):
+            print("The model already has safetensors weights. Skipping conversion...")
+            return
+        if not os.path.exists(bin_path):
+            print("Only single file pytorch_model.bin checkpoints are converted to safetensors. Skipping conversion...")
+            return
+        from sagemode.Helpers.ConvertWeights import convert_to_safetensors
+        convert_to_safetensors(bin_path, safetensors_path)
+        os.remove(bin_path)
+        # the inference toolkit installs code/requirements.txt before loading the model, so the container can always read safetensors
+        add_requirement(os.path.join(self.model_dir, "code", "requirements.txt"), "safetensors==0.4.1")
 
-    def upload_to_s3(self, skip=False) -> None:
-        s3_model_dir = os.path.basename(self.model_dir)
-        s3_output_file = os.path.basename(self.output_file)
-        if skip:
-            print("You have chosen to skip uploading to s3. Skipping this step...")
-            self.model_uri = f"s3://{self.bucket}/{s3_model_dir}/{s3_output_file}"
-        else:
-            t_start = time.time()
-            compressed_model_path = self.output_file
-            self.model_uri = S3Uploader.upload(local_path=compressed_model_path, desired_s3_uri=f"s3://{self.bucket}/{s3_model_dir}")
-            print(f"upload to s3 finished successfully. Time taken: {time.time() - t_start:.2f} seconds")
+    def quantize(self, method:str, samples:list[str]) -> None:
+        if method != "dynamic":
+            raise ValueError("Huggingface models only support quantize='dynamic'.")
+        if getattr(self, "model_type", None) not in ["AutoModelForCausalLM", "AutoModelForSeq2SeqLM"]:
+            raise ValueError("Quantization is only supported for causal and seq2seq language models.")
+        if not samples:
+            raise ValueError("Pass a few prompts as 'quantize_samples' so that the quantized model can be compared against the original.")
+        from sagemode.Helpers.Quantize import quantize_hf_model
+        quantize_hf_model(self.model_dir, self.model_type, samples)
+
+    def enable_continuous_batching(self, engine_config:dict) -> None:
+        if getattr(self, "model_type", None) != "AutoModelForCausalLM":
+            raise ValueError("Continuous batching is only supported for causal language models.")
+        engine_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', 'HFSageMaker', "continuous_batching.py")
+        copy_file_to_directory(engine_file_path, os.path.join(self.model_dir, "code"), "continuous_batching.py")
+        # model_fn starts the engine when it finds this file, the keys are ContinuousBatchingEngine's keyword arguments
+        with open(os.path.join(self.model_dir, "sagemode_continuous_batching.json"), "w") as engine_config_file:
+            json.dump(engine_config, engine_config_file)
+
+    def enable_prefix_cache(self, max_mb:float) -> None:
+        if getattr(self, "model_type", None) != "AutoModelForCausalLM":
+            raise ValueError("The prefix cache is only supported for causal language models.")
+        prefix_cache_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', 'HFSageMaker', "prefix_cache.py")
+        copy_file_to_directory(prefix_cache_file_path, os.path.join(self.model_dir, "code"), "prefix_cache.py")
+        with open(os.path.join(self.model_dir, "sagemode_prefix_cache.json"), "w") as prefix_cache_config_file:
+            json.dump({"max_mb": max_mb}, prefix_cache_config_file)
 
     def deploy(self, model_id:str, 
                     function_name:str,  
@@ -92,24 +99,52 @@ class HFSageMakerResourceUser(ResourceUser):
                     timeout:int=3, 
                     deployment_config:dict={"transformers_version":"4.26", 
                                             "pytorch_version":"1.13", 
-                                            "python_version":"py39"}) -> LambdaArn:
+                                            "python_version":"py39"},
+                    use_safetensors:bool=False,
+                    quantize:str=None,
+                    quantize_samples:list[str]=None,
+                    continuous_batching:dict=None,
+                    prefix_cache_mb:float=None,
+                    model_type:str=None,
+                    compression_level:int=6,
+                    stream_upload:bool=False,
+                    cache_artifacts:bool=True) -> LambdaArn:
         if self.lambda_user.function_arn:
             raise ValueError("We cannot call 'deploy' if the lambda_user already has a function_arn - set 'self.lambda_user.function_arn = None' and try again.")
         
         self.create_bucket()
-        self.copy_from_huggingface(model_id)
-        self.compress("model.tar.gz", skip_compression)
-        self.upload_to_s3(skip_upload)
+        self.copy_from_huggingface(model_id, model_type)
+        if use_safetensors:
+            self.convert_weights_to_safetensors()
+        if quantize is not None:
+            self.quantize(quantize, quantize_samples)
+        if continuous_batching is not None:
+            # e.g. {"max_batch_size": 16, "block_size": 16, "max_cache_tokens": 8192}, {} uses the defaults
+            self.enable_continuous_batching(continuous_batching)
+        if prefix_cache_mb is not None:
+            # keeps the KV cache of shared prompt prefixes under this many MB so later requests only prefill their own suffix
+            self.enable_prefix_cache(prefix_cache_mb)
+        # cache_artifacts reuses an archive of the same directory contents that is already in the bucket, and stream_upload pipes
+        # the archive into a multipart upload instead of writing model.tar.gz to the working directory first
+        if cache_artifacts and not skip_compression and not skip_upload:
+            self.cached_upload_to_s3("model.tar.gz", compression_level, stream_upload)
+        elif stream_upload and not skip_compression and not skip_upload:
+            self.stream_to_s3("model.tar.gz", compression_level)
+        else:
+            self.compress("model.tar.gz", skip_compression, compression_level)
+            self.upload_to_s3(skip_upload)
 
         transformers_version, pytorch_version, python_version = \
         deployment_config["transformers_version"], deployment_config["pytorch_version"], deployment_config["python_version"]
 
+        from sagemaker.huggingface.model import HuggingFaceModel
         huggingface_model = HuggingFaceModel(
         model_data=self.model_uri,      # path to your model and script
         role=self.role_arn.raw_str,   # iam role with permissions to create an Endpoint
         transformers_version=transformers_version,  # transformers version used
         pytorch_version=pytorch_version,       # pytorch version used
         py_version=python_version,            # python version used
+        env=self.payload_environment(),
         )
 
         t_start = time.time()
@@ -125,6 +160,16 @@ class HFSageMakerResourceUser(ResourceUser):
         if not self.lambda_user.function_arn:
             raise AttributeError("You did not deploy a huggingface model as a lambda function on AWS. Please run .deploy() and try again.")
         self.check_input(data)
-        response = self.lambda_user.use(data)
+        response = self.transport.send(data)
         self.check_output(response)
-        return response
\ No newline at end of file
+        return response
+    
+    def use_stream(self, data:dict):
+        # lambda functions on python runtimes cannot stream their response, so streaming goes to the endpoint directly.
+        # the HF inference toolkit sends output_fn's result in one piece, so the events arrive together when generation is done,
+        # deploy_llm on PyTorchEC2ResourceUser serves a model that streams each token as it is generated
+        if not self.lambda_user.function_arn:
+            raise AttributeError("You did not deploy a huggingface model as a lambda function on AWS. Please run .deploy() and try again.")
+        self.check_input(data)
+        runtime_client = self.boto3_session.client("sagemaker-runtime")
+        return stream_from_endpoint(runtime_client, self.lambda_user.get_endpoint_name(), data)
\ No newline at end of file
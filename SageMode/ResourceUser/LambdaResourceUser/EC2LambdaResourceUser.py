@@ -1,12 +1,11 @@
 import os
-import subprocess
 import time
-import zipfile
 import json
 from botocore.exceptions import ClientError
 from sagemode.ResourceUser.ResourceUser import ResourceUser
 from sagemode.Types.Arn import *
-from sagemode.Helpers.FileCopy import copy_file_to_directory
+from sagemode.Helpers.LambdaDeploy import build_dependencies, build_zip, deploy_function
+from sagemode.Helpers.TensorTransport import to_lambda_payload, from_lambda_payload
 
 class EC2LambdaResourceUser(ResourceUser):
 
@@ -16,24 +15,12 @@ class EC2LambdaResourceUser(ResourceUser):
         self.function_arn = function_arn
         self.lambda_client = self.boto3_session.client("lambda")
     
-    def zip_lambda_file(self, lambda_function_file_name:str, python_pip_prefix:list[str], requests_version:str="2.31.0"):
-        local_zipped_lambda_dir = f"{os.getcwd()}/lambda_zipped"
-        os.mkdir(local_zipped_lambda_dir)
-
-        copy_file_to_directory(lambda_function_file_name, local_zipped_lambda_dir, "lambda_function.py")
-        requirement_installation_suffix = ["install", f"requests=={requests_version}", "-t", local_zipped_lambda_dir]
-        full_requirement_installation_command = python_pip_prefix + requirement_installation_suffix
-        
-        subprocess.run(full_requirement_installation_command, check=True)
-
-        with zipfile.ZipFile(f"{local_zipped_lambda_dir}.zip", 'w') as zipped:
-            for root, dirs, files in os.walk(local_zipped_lambda_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, local_zipped_lambda_dir)
-                    zipped.write(file_path, arcname)
-
-        print("Successfully zipped all files necessary for Lambda function. Now deploying...")
+    def zip_lambda_file(self, lambda_function_file_name:str, python_pip_prefix:list[str], requests_version:str="2.31.0", python_version:str="3.9") -> bytes:
+        # requests is installed once per version and Python version and reused from ~/.sagemode, the zip is built in memory
+        dependency_dir = build_dependencies([f"requests=={requests_version}"], python_version, python_pip_prefix)
+        zip_bytes = build_zip({"lambda_function.py": lambda_function_file_name}, dependency_dir)
+        print(f"Successfully zipped all files necessary for Lambda function ({len(zip_bytes) / 1024 ** 2:.1f} MB). Now deploying...")
+        return zip_bytes
 
     def deploy(self, function_name:str,  
                     dns_name:str,
@@ -46,38 +33,48 @@ class EC2LambdaResourceUser(ResourceUser):
             raise ValueError("This object cannot call 'deploy' if it already has a function_arn - set 'self.function_arn = None' and try again.")
         
         lambda_function_file_path =  os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'LambdaFunctions', "EC2", "EC2.py")
-        self.zip_lambda_file(lambda_function_file_path, python_pip_prefix, requests_version)
-
-        local_zipped_lambda_dir = f"{os.getcwd()}/lambda_zipped.zip"
+        zip_bytes = self.zip_lambda_file(lambda_function_file_path, python_pip_prefix, requests_version, python_version)
 
-        response = self.lambda_client.create_function(
-            FunctionName=function_name,
-            Runtime=f'python{python_version}',
-            Role=self.role_arn.raw_str,  # Replace with your Lambda execution role ARN
-            Handler='lambda_function.lambda_handler',  # Specify the module and function name
-            Timeout=timeout,
-            Code={
-                'ZipFile': open(local_zipped_lambda_dir, "rb").read()  # Read the content of the file
-            },
-            Environment={
+        # a function with this name that already exists is updated in place instead of failing in create_function
+        function_arn = deploy_function(self.lambda_client, function_name, zip_bytes, {
+            "Runtime": f'python{python_version}',
+            "Role": self.role_arn.raw_str,
+            "Handler": 'lambda_function.lambda_handler',  # Specify the module and function name
+            "Timeout": timeout,
+            "Environment": {
                 'Variables': {"DNS_NAME": dns_name, "PORT": str(port)}
             }
-        )
-        self.function_arn = LambdaArn(response["FunctionArn"])
-        self.wait_until_function_is_active(timeout)                
+        })
+        self.function_arn = LambdaArn(function_arn)
         print("You have successfully deployed your Lambda function.")
-        os.remove(local_zipped_lambda_dir)
         return self.function_arn
     
-    def use(self, data:dict):
+    def use(self, data:dict, binary:bool=False):
+        # with binary=True array values are sent as raw buffers and arrays in the response come back as numpy arrays
+        if binary:
+            data = to_lambda_payload(data)
+        elif self.payload_offloader:
+            # large fields go through S3, the binary body is kept inline because the lambda function has to decode it
+            data = self.payload_offloader.offload(data)
         response = self.lambda_client.invoke(
         FunctionName=self.function_arn.resource,
         InvocationType='RequestResponse',  # Can be 'Event' for asynchronous invocation
         Payload=json.dumps(data).encode('utf-8')
         )
         output_dict = json.loads(response['Payload'].read().decode('utf-8'))
+        if binary:
+            output_dict = from_lambda_payload(output_dict)
+        elif self.payload_offloader:
+            output_dict = self.payload_offloader.resolve(output_dict)
         return output_dict       
     
+    def get_server_url(self) -> str:
+        if not self.function_arn:
+            raise AttributeError("your EC2LambdaResourceUser does not have a function_arn yet. Make sure that you have deployed your lambda function first.")
+        # the lambda function already knows which server it fronts, so this also works for users created from an existing function_arn
+        variables = self.lambda_client.get_function_configuration(FunctionName=self.function_arn.resource)["Environment"]["Variables"]
+        return f"http://{variables['DNS_NAME']}:{variables['PORT']}/predict"
+
     def wait_until_function_is_active(self, timeout:int=3):
         if not self.function_arn:
             raise AttributeError("your EC2LambdaResourceUser does not have a function_arn yet. Make sure that you have deployed your lambda function first.")
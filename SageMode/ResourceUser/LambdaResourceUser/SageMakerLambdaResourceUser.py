@@ -1,11 +1,10 @@
 import os
 import time
-import zipfile
 import json
 from dotenv import load_dotenv
 from sagemode.ResourceUser.ResourceUser import ResourceUser
 from sagemode.Types.Arn import *
-from sagemode.Helpers.FileCopy import copy_file_to_directory
+from sagemode.Helpers.LambdaDeploy import build_zip, deploy_function
 from botocore.exceptions import ClientError
 
 class SageMakerLambdaResourceUser(ResourceUser):
@@ -17,53 +16,54 @@ class SageMakerLambdaResourceUser(ResourceUser):
         self.function_arn = function_arn
         self.lambda_client = self.boto3_session.client("lambda")
     
-    def zip_lambda_file(self, file_name:str):
-        local_zipped_lambda_dir = "lambda_zipped"
-        lambda_function_file_name = "lambda"
-        copy_file_to_directory(file_name, os.getcwd(), f"{lambda_function_file_name}.py")
-        with zipfile.ZipFile(f"{local_zipped_lambda_dir}.zip", 'w') as zipped:
-            zipped.write(f"{lambda_function_file_name}.py")
-            zipped.close()
-        os.remove(f"{lambda_function_file_name}.py")
+    def zip_lambda_file(self, file_name:str) -> bytes:
+        # the handler only needs boto3, which the Lambda runtime provides, so the zip holds the one file and is built in memory
+        return build_zip({"lambda.py": file_name})
 
     def deploy(self, function_name:str, endpoint_name:str=None, python_version:str="3.8", timeout:int=3) -> LambdaArn:
         if self.function_arn:
             raise ValueError("This object cannot call 'deploy' if it already has a function_arn - set 'self.function_arn = None' and try again.")
         
-        local_zipped_lambda_dir = f"{os.getcwd()}/lambda_zipped.zip"
-        lambda_function_file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'LambdaFunctions', "SageMaker", "SageMaker.py")
-        self.zip_lambda_file(lambda_function_file_path)
+        lambda_function_file_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'LambdaFunctions', "Sagemaker", "Sagemaker.py")
+        zip_bytes = self.zip_lambda_file(lambda_function_file_path)
         if endpoint_name is None:
             endpoint_name = os.environ["ENDPOINT_NAME"]
 
-        response = self.lambda_client.create_function(
-            FunctionName=function_name,
-            Runtime=f'python{python_version}',
-            Role=self.role_arn.raw_str,  # Replace with your Lambda execution role ARN
-            Handler='lambda.lambda_handler',  # Specify the module and function name
-            Timeout=timeout,
-            Code={
-                'ZipFile': open(local_zipped_lambda_dir, "rb").read()  # Read the content of the file
-            },
-            Environment={
-                'Variables': {"ENDPOINT_NAME": endpoint_name}
+        # a function with this name that already exists is pointed at the new endpoint instead of failing in create_function
+        function_arn = deploy_function(self.lambda_client, function_name, zip_bytes, {
+            "Runtime": f'python{python_version}',
+            "Role": self.role_arn.raw_str,
+            "Handler": 'lambda.lambda_handler',  # Specify the module and function name
+            "Timeout": timeout,
+            "Environment": {
+                # the handler sizes its read timeout from the function's timeout
+                'Variables': {"ENDPOINT_NAME": endpoint_name, "LAMBDA_TIMEOUT": str(timeout)}
             }
-        )
-        self.function_arn = LambdaArn(response["FunctionArn"])
-        self.wait_until_function_is_active()                
-        print("You have successfully created your lambda function. Lambda Function arn:", response['FunctionArn'])
-        os.remove(local_zipped_lambda_dir)
+        })
+        self.function_arn = LambdaArn(function_arn)
+        print("You have successfully created your lambda function. Lambda Function arn:", function_arn)
         return self.function_arn
     
     def use(self, data:dict):
+        if self.payload_offloader:
+            data = self.payload_offloader.offload(data)
         response = self.lambda_client.invoke(
         FunctionName=self.function_arn.resource,
         InvocationType='RequestResponse',  # Can be 'Event' for asynchronous invocation
         Payload=json.dumps(data).encode('utf-8')
         )
         output_dict = json.loads(response['Payload'].read().decode('utf-8'))
+        if self.payload_offloader:
+            output_dict = self.payload_offloader.resolve(output_dict)
         return output_dict       
     
+    def get_endpoint_name(self) -> str:
+        if not self.function_arn:
+            raise AttributeError("your SagemakerLambdaResourceUser does not have a function_arn yet. Make sure that you have deployed your lambda function first.")
+        # the lambda function already knows which endpoint it fronts, so this also works for users created from an existing function_arn
+        configuration = self.lambda_client.get_function_configuration(FunctionName=self.function_arn.resource)
+        return configuration["Environment"]["Variables"]["ENDPOINT_NAME"]
+
     def wait_until_function_is_active(self):
         if not self.function_arn:
             raise AttributeError("your SagemakerLambdaResourceUser does not have a function_arn yet. Make sure that you have deployed your lambda function first.")
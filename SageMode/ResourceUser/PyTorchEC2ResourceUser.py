@@ -1,16 +1,25 @@
+from __future__ import annotations
 import os
 import time
+import json
+import shlex
+from shutil import copytree, rmtree
 from dotenv import load_dotenv
-from typing import Callable
-import torch
-import paramiko
+from typing import Callable, TYPE_CHECKING
 from sagemode.Types.Arn import *
 from sagemode.ResourceUser.ResourceUser import ResourceUser
 from sagemode.ResourceUser.LambdaResourceUser.EC2LambdaResourceUser import EC2LambdaResourceUser
 from sagemode.Helpers.WriteFunctionToFile import write_function_to_file
 from sagemode.Helpers.FileCopy import copy_file_to_directory
-from sagemode.Helpers.UploadToRemote import upload_directory
+from sagemode.Helpers.Requirements import add_requirement
+from sagemode.Helpers.UploadToRemote import sync_directory
 from sagemode.Helpers.SSHConnect import wait_for_ssh_connection
+from sagemode.Helpers.Transports import LambdaTransport, HTTPTransport
+
+# torch and paramiko are only imported by the methods that build or upload the server, so calling use() on an
+# existing deployment stays fast
+if TYPE_CHECKING:
+    import torch
 
 class PyTorchEC2ResourceUser(ResourceUser):
 
@@ -21,19 +30,56 @@ class PyTorchEC2ResourceUser(ResourceUser):
         self.instance_type = instance_type
         self.ec2_client = self.boto3_session.client("ec2", region_name=os.environ["AWS_REGION"])
         self.lambda_user = EC2LambdaResourceUser(lambda_function_arn)
+        self.lambda_user.payload_offloader = self.payload_offloader
+        self.transport = LambdaTransport(self.lambda_user)
+
+    def make_local_directory(self) -> str:
+        ec2_inference_path = os.path.join(os.getcwd(), "EC2InferenceLocal")
+        if os.path.exists(ec2_inference_path):
+            # files of an earlier deploy must not be synced to the instance again, e.g. weights.pth after switching to safetensors
+            print(f"Replacing the directory staged earlier at {ec2_inference_path}...")
+            rmtree(ec2_inference_path)
+        os.mkdir(ec2_inference_path)
+        return ec2_inference_path
 
     def create_local_ec2_directory(self, model_path:str, 
                             weight_path:str, 
                             pre_process:Callable[[dict], torch.Tensor], 
                             post_process:Callable[[torch.Tensor], dict], 
-                            requirements_path:str = "requirements.txt") -> None:
-
-        ec2_inference_path = os.path.join(os.getcwd(), "EC2InferenceLocal")
-        os.mkdir(ec2_inference_path)
-
-        server_code_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "InferenceFiles", "PyTorchEC2", "server", "main.py")
-        ec2_server_file_name = "main.py"
-        copy_file_to_directory(server_code_path, ec2_inference_path, ec2_server_file_name)
+                            requirements_path:str = "requirements.txt",
+                            server_config:dict = None,
+                            weights_format:str = "safetensors",
+                            engine:str = "eager",
+                            sample_input:torch.Tensor = None,
+                            engine_tolerance:float = 1e-4,
+                            quantize:str = None,
+                            calibrate:Callable[[torch.nn.Module], None] = None,
+                            quantize_samples:list[torch.Tensor] = None) -> None:
+        import torch
+        from sagemode.Helpers.ConvertWeights import convert_to_safetensors
+        from sagemode.Helpers.CompileModel import load_local_model, export_model, engine_files
+        from sagemode.Helpers.Quantize import quantize_model, compare_models
+
+        if weights_format not in ["safetensors", "pth"]:
+            raise ValueError("'weights_format' must be either 'safetensors' or 'pth'.")
+        if quantize is not None:
+            # int8 models are shipped as TorchScript, which keeps the packed weights and needs no quantization code on the server
+            if engine == "onnx":
+                raise ValueError("Quantized models are shipped as TorchScript, 'engine' must be 'eager' or 'torchscript'.")
+            engine = "torchscript"
+        if engine != "eager" and sample_input is None:
+            raise ValueError(f"The '{engine}' engine traces your model, so you need to pass a 'sample_input' tensor.")
+
+        ec2_inference_path = self.make_local_directory()
+        server_config = {**(server_config or {}), "engine": engine}
+
+        server_code_directory = os.path.join(os.path.dirname(os.path.dirname(__file__)), "InferenceFiles", "PyTorchEC2", "server")
+        for ec2_server_file_name in ["main.py", "batching.py", "serve.py", "transport.py", "cache.py", "loading.py", "metrics.py", "encoding.py"]:
+            server_code_path = os.path.join(server_code_directory, ec2_server_file_name)
+            copy_file_to_directory(server_code_path, ec2_inference_path, ec2_server_file_name)
+        for shared_file_name in ["payload_offload.py", "onnx_model.py"]:
+            shared_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "InferenceFiles", shared_file_name)
+            copy_file_to_directory(shared_file_path, ec2_inference_path, shared_file_name)
 
         pre_process_input_path = "pre_process.py"
         absolute_pre_process_input_path = f"{os.getcwd()}/pre_process.py"
@@ -45,26 +91,79 @@ class PyTorchEC2ResourceUser(ResourceUser):
         write_function_to_file(post_process, absolute_post_process_output_path)
         copy_file_to_directory(absolute_post_process_output_path, ec2_inference_path, post_process_output_path)
 
-        ec2_weight_path = "weights.pth"
-        absolute_weight_path = f"{os.getcwd()}/{weight_path}"
-        copy_file_to_directory(absolute_weight_path, ec2_inference_path, ec2_weight_path)
-
         ec2_model_path = "model.py"
         absolute_model_path = f"{os.getcwd()}/{model_path}"
         copy_file_to_directory(absolute_model_path, ec2_inference_path, ec2_model_path)
 
+        absolute_weight_path = f"{os.getcwd()}/{weight_path}"
+        if engine != "eager":
+            # the traced or exported artifact replaces the weights file, the server does not need model.py to run it
+            model = load_local_model(absolute_model_path, absolute_weight_path)
+            if quantize is not None:
+                quantized_model = quantize_model(model, quantize, sample_input, calibrate)
+                compare_models(model, quantized_model, quantize_samples or [sample_input])
+                model = quantized_model
+            export_model(model, sample_input, engine, ec2_inference_path, engine_tolerance)
+            server_config["weights"] = engine_files[engine]
+        elif weights_format == "safetensors":
+            # safetensors checkpoints are memory-mapped by the server, so it starts faster and never holds two copies of the weights
+            server_config["weights"] = "weights.safetensors"
+            convert_to_safetensors(absolute_weight_path, os.path.join(ec2_inference_path, server_config["weights"]))
+        else:
+            server_config["weights"] = "weights.pth"
+            copy_file_to_directory(absolute_weight_path, ec2_inference_path, server_config["weights"])
+
+        if sample_input is not None:
+            server_config["sample_input"] = "sample_input.pt"
+            torch.save(sample_input, os.path.join(ec2_inference_path, server_config["sample_input"]))
+
+        with open(os.path.join(ec2_inference_path, "server_config.json"), "w") as server_config_file:
+            json.dump(server_config, server_config_file)
+
         ec2_requirements_path = "requirements.txt"
         absolute_requirements_path = f"{os.getcwd()}/{requirements_path}"
         copy_file_to_directory(absolute_requirements_path, ec2_inference_path, ec2_requirements_path)
+        # payload_offload.py reads and writes the S3 references of large request and response fields
+        add_requirement(os.path.join(ec2_inference_path, ec2_requirements_path), "boto3")
+        if engine == "onnx":
+            add_requirement(os.path.join(ec2_inference_path, ec2_requirements_path), "onnxruntime")
+        elif engine == "eager" and weights_format == "safetensors":
+            add_requirement(os.path.join(ec2_inference_path, ec2_requirements_path), "safetensors")
         
+    def create_local_llm_directory(self, model_dir:str, requirements_path:str = "requirements.txt", server_config:dict = None) -> None:
+        ec2_inference_path = self.make_local_directory()
+        server_config = {**(server_config or {}), "app": "llm", "model_dir": "hf_model"}
+
+        server_code_directory = os.path.join(os.path.dirname(os.path.dirname(__file__)), "InferenceFiles", "PyTorchEC2", "server")
+        for ec2_server_file_name in ["serve.py", "llm.py", "encoding.py"]:
+            copy_file_to_directory(os.path.join(server_code_directory, ec2_server_file_name), ec2_inference_path, ec2_server_file_name)
+        for engine_file_name in ["continuous_batching.py", "prefix_cache.py", "decoding.py"]:
+            engine_file_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "InferenceFiles", "HFSageMaker", engine_file_name)
+            copy_file_to_directory(engine_file_path, ec2_inference_path, engine_file_name)
+        payload_offload_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "InferenceFiles", "payload_offload.py")
+        copy_file_to_directory(payload_offload_path, ec2_inference_path, "payload_offload.py")
+
+        copytree(os.path.join(os.getcwd(), model_dir), os.path.join(ec2_inference_path, server_config["model_dir"]))
+
+        with open(os.path.join(ec2_inference_path, "server_config.json"), "w") as server_config_file:
+            json.dump(server_config, server_config_file)
+
+        ec2_requirements_path = "requirements.txt"
+        copy_file_to_directory(os.path.join(os.getcwd(), requirements_path), ec2_inference_path, ec2_requirements_path)
+        add_requirement(os.path.join(ec2_inference_path, ec2_requirements_path), "transformers")
+        add_requirement(os.path.join(ec2_inference_path, ec2_requirements_path), "boto3")
+
     def create_container_and_get_dns(self, ami_id:str) -> str:
+        # the server reads and writes payloads that are offloaded to S3 with the instance profile's credentials
+        instance_profile = {"IamInstanceProfile": {"Arn": os.environ["EC2_INSTANCE_PROFILE_ARN"]}} if os.environ.get("EC2_INSTANCE_PROFILE_ARN") else {}
         instance_id = self.ec2_client.run_instances(
         ImageId=ami_id,  # Specify the AMI ID
         MinCount=1,
         MaxCount=1,
         InstanceType=self.instance_type,  # Specify the instance type
         KeyName=os.environ["EC2_KEY_PAIR_NAME"],  # Specify your key pair
-        SecurityGroupIds=[os.environ["SECURITY_GROUP_ID"]]
+        SecurityGroupIds=[os.environ["SECURITY_GROUP_ID"]],
+        **instance_profile
         )["Instances"][0]["InstanceId"]
 
         ec2_resource = self.boto3_session.resource("ec2")
@@ -80,7 +179,8 @@ class PyTorchEC2ResourceUser(ResourceUser):
 
         return public_dns
 
-    def upload_directory_to_ec2(self, public_dns:str):
+    def upload_directory_to_ec2(self, public_dns:str, sftp_channels:int = 4):
+        import paramiko
         ssh_client = paramiko.SSHClient()
         ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
@@ -94,12 +194,8 @@ class PyTorchEC2ResourceUser(ResourceUser):
         local_directory = f'{os.getcwd()}/EC2InferenceLocal'
         remote_directory = 'EC2Inference'        
 
-        sftp = ssh_client.open_sftp()
-
-        upload_directory(local_directory, remote_directory, sftp)
-
-        # Close the SFTP connection
-        sftp.close()
+        # only files that differ from the copy on the instance are sent, over several SFTP channels at once
+        sync_directory(local_directory, remote_directory, ssh_client.get_transport(), sftp_channels)
 
         # Close the SSH connection
         ssh_client.close()
@@ -107,6 +203,7 @@ class PyTorchEC2ResourceUser(ResourceUser):
         print("Directory upload completed.")
 
     def run_server(self, public_dns:str, port:int=8000):
+        import paramiko
         ssh_client = paramiko.SSHClient()
         ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
@@ -117,11 +214,14 @@ class PyTorchEC2ResourceUser(ResourceUser):
 
         print("Connection between local machine and ec2 instance established. Executing commands...")
 
+        environment = "".join(f"{name}={shlex.quote(value)} " for name, value in self.payload_environment().items())
         commands = [
             'sudo yum update',
             'sudo yum install -y python3 python3-pip',
             'python3 --version',
-            f'cd EC2Inference && pip install -r requirements.txt && (nohup uvicorn main:app --host 0.0.0.0 --port {port} > output.log 2>&1 & disown)',  # Start FastAPI server
+            # a redeploy onto the same instance stops the server started before, the port is free once every worker has exited
+            'pkill -f "[s]erve.py"; for attempt in $(seq 60); do pgrep -f "[s]erve.py" > /dev/null || break; sleep 0.5; done',
+            f'cd EC2Inference && pip install -r requirements.txt && ({environment}nohup python3 serve.py --host 0.0.0.0 --port {port} > output.log 2>&1 & disown)',  # Start FastAPI server
         ]
 
         for command in commands:
@@ -142,16 +242,91 @@ class PyTorchEC2ResourceUser(ResourceUser):
                     lambda_function_name:str,
                     lambda_python_pip_prefix:list[str] = ["pip"],
                     ec2_requirements_path:str = "requirements.txt", 
+                    max_batch_size:int = 1,
+                    max_wait_ms:float = 5,
+                    workers:int = 1,
+                    threads_per_worker:int = 0,
+                    cache_size:int = 0,
+                    cache_ttl:float = 300,
+                    weights_format:str = "safetensors",
+                    engine:str = "eager",
+                    sample_input:torch.Tensor = None,
+                    engine_tolerance:float = 1e-4,
+                    warmup_iterations:int = 3,
+                    quantize:str = None,
+                    calibrate:Callable[[torch.nn.Module], None] = None,
+                    quantize_samples:list[torch.Tensor] = None,
+                    public_dns:str = None,
                     ) -> LambdaArn:
-                
-        if self.lambda_user.function_arn:
-            raise ValueError("We cannot call 'deploy' if the lambda_user already has a function_arn - set 'self.lambda_user.function_arn = None' and try again.")
+        # public_dns redeploys onto an instance that is already running, only the files that changed are uploaded
+        # and the server is restarted, the lambda function in front of it is kept
+        self.check_redeploy("deploy", public_dns)
+        if max_batch_size < 1:
+            raise ValueError("'max_batch_size' must be at least 1. Use 1 to turn off dynamic batching.")
         
-        self.create_local_ec2_directory(model_path, weight_path, pre_process, post_process, ec2_requirements_path)
-        public_dns = self.create_container_and_get_dns(ami_id)
+        # with max_batch_size > 1 the server merges concurrent requests into one forward pass
+        # workers=0 lets the server size the worker pool from the instance's core count, threads_per_worker=0 splits the cores evenly
+        # cache_size > 0 turns on the result cache, only do that for deterministic models since a cached answer is returned as is.
+        # cache_ttl=0 keeps entries until they are evicted
+        server_config = {"max_batch_size": max_batch_size, 
+                         "max_wait_ms": max_wait_ms, 
+                         "workers": workers, 
+                         "threads_per_worker": threads_per_worker,
+                         "cache_size": cache_size,
+                         "cache_ttl": cache_ttl,
+                         "warmup_iterations": warmup_iterations}
+        self.create_local_ec2_directory(model_path, weight_path, pre_process, post_process, ec2_requirements_path, server_config, 
+                                        weights_format, engine, sample_input, engine_tolerance, 
+                                        quantize, calibrate, quantize_samples)
+        return self.start_server(ami_id, public_dns, lambda_function_name, lambda_python_pip_prefix)
+    
+    def deploy_llm(self, ami_id:str, 
+                        model_dir:str, 
+                        lambda_function_name:str,
+                        lambda_python_pip_prefix:list[str] = ["pip"],
+                        ec2_requirements_path:str = "requirements.txt", 
+                        max_batch_size:int = 16,
+                        block_size:int = 16,
+                        max_cache_tokens:int = None,
+                        prefix_cache_mb:float = 0,
+                        public_dns:str = None,
+                        ) -> LambdaArn:
+        # serves a huggingface causal LM saved in model_dir with the continuous batching engine instead of model.py.
+        # public_dns redeploys onto a running instance like deploy does
+        self.check_redeploy("deploy_llm", public_dns)
+        if max_batch_size < 1:
+            raise ValueError("'max_batch_size' must be at least 1.")
+
+        server_config = {"max_batch_size": max_batch_size, 
+                         "block_size": block_size, 
+                         "max_cache_tokens": max_cache_tokens,
+                         "prefix_cache_mb": prefix_cache_mb}
+        self.create_local_llm_directory(model_dir, ec2_requirements_path, server_config)
+        return self.start_server(ami_id, public_dns, lambda_function_name, lambda_python_pip_prefix)
+
+    def check_redeploy(self, method:str, public_dns:str) -> None:
+        if not self.lambda_user.function_arn:
+            return
+        if public_dns is None:
+            raise ValueError(f"We cannot call '{method}' if the lambda_user already has a function_arn - pass the 'public_dns' of its instance to redeploy onto it, "
+                             f"or set 'self.lambda_user.function_arn = None' and try again.")
+        server_url = self.lambda_user.get_server_url()
+        if not server_url.startswith(f"http://{public_dns}:"):
+            raise ValueError(f"The lambda function of this user sends requests to {server_url}, not to the instance at {public_dns}.")
+
+    def start_server(self, ami_id:str, public_dns:str, lambda_function_name:str, lambda_python_pip_prefix:list[str]) -> LambdaArn:
+        # the staged directory goes to a new instance, or to the instance at public_dns when there is one already
+        if public_dns is None:
+            public_dns = self.create_container_and_get_dns(ami_id)
+        else:
+            print(f"Redeploying onto the instance at {public_dns}...")
         self.upload_directory_to_ec2(public_dns)
         self.run_server(public_dns)
 
+        if self.lambda_user.function_arn:
+            print("Server restarted on EC2 instance, the lambda function already points at it. Redeployment to ec2 complete.")
+            return self.lambda_user.function_arn
+
         print("Server started on EC2 instance. Creating Lambda function...")
 
         function_arn:LambdaArn = self.lambda_user.deploy(lambda_function_name, 
@@ -161,11 +336,30 @@ class PyTorchEC2ResourceUser(ResourceUser):
                                                          )
         print("Lambda function created. Deployment to ec2 complete.")
         return function_arn
-    
-    def use(self, data:dict):
+
+    def set_transport(self, transport:str = "lambda", timeout:float = 60) -> None:
+        # "direct" posts to the server from this process instead of invoking the lambda function, for trusted callers that the
+        # instance's security group lets reach the server port. the server address is read from the lambda function's configuration
+        if transport == "lambda":
+            self.transport = LambdaTransport(self.lambda_user)
+        elif transport == "direct":
+            self.transport = HTTPTransport(self.lambda_user.get_server_url(), timeout)
+        else:
+            raise ValueError("'transport' must be 'lambda' or 'direct'.")
+
+    def use(self, data:dict, binary:bool=False):
         if not self.lambda_user.function_arn:
             raise AttributeError("You did not deploy a PyTorch model as a lambda function on AWS. Please run .deploy() and try again.")
         self.check_input(data)
-        response = self.lambda_user.use(data)
+        response = self.transport.send(data, binary=binary)
         self.check_output(response)
-        return response
\ No newline at end of file
+        return response
+
+    def use_stream(self, data:dict, timeout:float = 60):
+        # yields text pieces as a deploy_llm server generates them. lambda functions on python runtimes cannot stream their
+        # response, so this posts to the server directly and needs the server port open to this machine, like the direct transport
+        if not self.lambda_user.function_arn:
+            raise AttributeError("You did not deploy a PyTorch model as a lambda function on AWS. Please run .deploy_llm() and try again.")
+        self.check_input(data)
+        from sagemode.Helpers.EventStream import stream_from_server
+        return stream_from_server(self.lambda_user.get_server_url(), data, timeout)
\ No newline at end of file
@@ -1,41 +1,48 @@
+from __future__ import annotations
 import os
 import time
-import tarfile
-from typing import Callable
-import sagemaker
-from sagemaker.s3 import S3Uploader
-from dotenv import load_dotenv
-from sagemaker.pytorch import PyTorchModel
-from sagemode.ResourceUser.ResourceUser import ResourceUser
-from sagemode.ResourceUser.LambdaResourceUser.SageMakerLambdaResourceUser import SageMakerLambdaResourceUser 
+import shutil
+from typing import Callable, TYPE_CHECKING
+from sagemode.ResourceUser.SageMakerResourceUser import SageMakerResourceUser
 from sagemode.Types.Arn import *
 from sagemode.Helpers.FileCopy import *
 from sagemode.Helpers.WriteFunctionToFile import write_function_to_file
+from sagemode.Helpers.Requirements import add_requirement
 
-class PyTorchSageMakerResourceUser(ResourceUser):
+# torch and sagemaker take seconds to import, so they are only imported by the methods that deploy a model,
+# and calling use() on an existing deployment stays fast
+if TYPE_CHECKING:
+    import torch
 
-    def __init__(self, 
-                 instance_type:str, 
-                 previous:dict[str, type] = None, 
-                 next:dict[str, type] = None, 
-                 lambda_arn:LambdaArn = None):
-        load_dotenv()
-        role_arn = RoleArn(os.environ["SAGEMAKER_ROLE_ARN"])
-        super().__init__(role_arn, previous, next)
-        self.instance_type = instance_type
-        self.lambda_user = SageMakerLambdaResourceUser(lambda_arn)  
-    
-    def create_bucket(self) -> None:
-        print("Creating bucket...")
-        sess = sagemaker.Session(self.boto3_session)
-        try:
-            self.bucket = sess.default_bucket()
-        except:
-            raise Exception("Unable to create bucket for session. Double check to make sure that your session is not 'None.'")
+class PyTorchSageMakerResourceUser(SageMakerResourceUser):
+
+    # the user's input_fn gets the raw request body, so references to S3 would reach it unresolved
+    resolves_payloads = False
+
+    def make_inference_local_directory(self, functions_dict:dict[str, Callable], 
+                                       model_path:str, 
+                                       weight_path:str, 
+                                       requirements_path:str = "requirements.txt",
+                                       engine:str = "eager",
+                                       sample_input:torch.Tensor = None,
+                                       engine_tolerance:float = 1e-4,
+                                       quantize:str = None,
+                                       calibrate:Callable[[torch.nn.Module], None] = None,
+                                       quantize_samples:list[torch.Tensor] = None) -> None:
+        if quantize is not None:
+            # int8 models are shipped as TorchScript, which keeps the packed weights and needs no quantization code in model_fn
+            if engine == "onnx":
+                raise ValueError("Quantized models are shipped as TorchScript, 'engine' must be 'eager' or 'torchscript'.")
+            engine = "torchscript"
+        if engine != "eager" and sample_input is None:
+            raise ValueError(f"The '{engine}' engine traces your model, so you need to pass a 'sample_input' tensor.")
 
-    def make_inference_local_directory(self, functions_dict:dict[str, Callable], model_path:str, weight_path:str, requirements_path:str = "requirements.txt") -> None:
         local_pytorch_directory_path = os.path.join(os.getcwd(), "PyTorchSageMaker")
         self.model_dir = str(local_pytorch_directory_path)
+        if os.path.exists(local_pytorch_directory_path):
+            # files of an earlier deploy (e.g. model.onnx after switching back to eager) must not end up in the archive
+            print(f"Replacing the directory staged earlier at {local_pytorch_directory_path}...")
+            shutil.rmtree(local_pytorch_directory_path)
         os.mkdir(local_pytorch_directory_path)
 
         for file_name in functions_dict:
@@ -54,41 +61,36 @@ class PyTorchSageMakerResourceUser(ResourceUser):
         
         sagemaker_weight_path = "weights.pth"
         absolute_weight_path = f"{os.getcwd()}/{weight_path}"
-        copy_file_to_directory(absolute_weight_path, local_pytorch_directory_path, sagemaker_weight_path)
+        if engine == "eager":
+            copy_file_to_directory(absolute_weight_path, local_pytorch_directory_path, sagemaker_weight_path)
+        else:
+            import torch
+            from sagemode.Helpers.CompileModel import load_local_model, export_model, engine_files
+            from sagemode.Helpers.Quantize import quantize_model, compare_models
+            # the traced or exported artifact is shipped in place of weights.pth
+            model = load_local_model(absolute_model_path, absolute_weight_path)
+            if quantize is not None:
+                quantized_model = quantize_model(model, quantize, sample_input, calibrate)
+                compare_models(model, quantized_model, quantize_samples or [sample_input])
+                model = quantized_model
+            export_model(model, sample_input, engine, local_pytorch_directory_path, engine_tolerance)
+            torch.save(sample_input, os.path.join(local_pytorch_directory_path, "sample_input.pt"))
+            # weights.pth is not shipped, so a model_fn that loads it would fail when the endpoint starts
+            if "model_fn" in functions_dict:
+                print(f"The '{engine}' engine ships the model as {engine_files[engine]} instead of weights.pth, "
+                      f"your model_fn is replaced by one that loads {engine_files[engine]}.")
+            engine_model_fn_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', "PyTorchSageMaker", "engine_model_fn.py")
+            copy_file_to_directory(engine_model_fn_path, local_pytorch_directory_path, "model_fn.py")
+            onnx_model_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'InferenceFiles', "onnx_model.py")
+            copy_file_to_directory(onnx_model_path, local_pytorch_directory_path, "onnx_model.py")
 
         absolute_requirements_path = f"{os.getcwd()}/{requirements_path}"
         copy_file_to_directory(absolute_requirements_path, local_pytorch_directory_path, requirements_path)
+        if engine == "onnx":
+            add_requirement(os.path.join(local_pytorch_directory_path, requirements_path), "onnxruntime")
         
         print(f"all necessary files copied into directory {local_pytorch_directory_path}/")
 
-    def compress(self, output_file="model.tar.gz", skip=False) -> None:
-        self.output_file = str(os.path.join(os.getcwd(), output_file))
-        if skip:
-            print("You have selected to skip compressing your model. Skipping this step...")
-        else:
-            print("compressing directory...")
-            t_start = time.time()
-            parent_dir=os.getcwd()
-            os.chdir(self.model_dir)
-            with tarfile.open(self.output_file, "w:gz") as tar:
-                for item in os.listdir('.'):
-                    tar.add(item, arcname=item)
-            print(f"compression finished successfully. Time taken: {time.time() - t_start:.2f} seconds")
-            os.chdir(parent_dir)
-
-    def upload_to_s3(self, skip=False) -> None:
-        s3_model_dir = os.path.basename(self.model_dir)
-        s3_output_file = os.path.basename(self.output_file)
-
-        if skip:
-            print("You have chosen to skip uploading to s3. Skipping this step...")
-            self.model_uri = f"s3://{self.bucket}/{s3_model_dir}/{s3_output_file}"
-        else:
-            t_start = time.time()
-            compressed_model_path = self.output_file
-            self.model_uri = S3Uploader.upload(local_path=compressed_model_path, desired_s3_uri=f"s3://{self.bucket}/{s3_model_dir}")
-            print(f"upload to s3 finished successfully. Time taken: {time.time() - t_start:.2f} seconds")
-
     def deploy(self,function_name:str,
                     functions_dict:dict[str, Callable],
                     model_path:str = "model.py",
@@ -99,6 +101,15 @@ class PyTorchSageMakerResourceUser(ResourceUser):
                     deployment_config:dict = {"python_version":"py38", "pytorch_version": "1.10"},
                     requirements_path:str = "requirements.txt",
                     timeout:int=3, 
+                    engine:str = "eager",
+                    sample_input:torch.Tensor = None,
+                    engine_tolerance:float = 1e-4,
+                    quantize:str = None,
+                    calibrate:Callable[[torch.nn.Module], None] = None,
+                    quantize_samples:list[torch.Tensor] = None,
+                    compression_level:int = 6,
+                    stream_upload:bool = False,
+                    cache_artifacts:bool = True,
                     ) -> LambdaArn:
         if self.lambda_user.function_arn:
             raise ValueError("We cannot call 'deploy' if the lambda_user already has a function_arn - set 'self.lambda_user.function_arn = None' and try again.")
@@ -106,15 +117,25 @@ class PyTorchSageMakerResourceUser(ResourceUser):
         t_start = time.time()
 
         self.create_bucket()
-        self.make_inference_local_directory(functions_dict, model_path, weight_path, requirements_path)
-        self.compress("model.tar.gz", skip_compression)
-        self.upload_to_s3(skip_upload)
+        self.make_inference_local_directory(functions_dict, model_path, weight_path, requirements_path, engine, sample_input, engine_tolerance, 
+                                            quantize, calibrate, quantize_samples)
+        # cache_artifacts reuses an archive of the same directory contents that is already in the bucket, and stream_upload pipes
+        # the archive into a multipart upload instead of writing model.tar.gz to the working directory first
+        if cache_artifacts and not skip_compression and not skip_upload:
+            self.cached_upload_to_s3("model.tar.gz", compression_level, stream_upload)
+        elif stream_upload and not skip_compression and not skip_upload:
+            self.stream_to_s3("model.tar.gz", compression_level)
+        else:
+            self.compress("model.tar.gz", skip_compression, compression_level)
+            self.upload_to_s3(skip_upload)
 
         entry_file_in_directory = "entry.py"
         local_pytorch_directory_path = "PyTorchSageMaker"
 
         pytorch_version, python_version = deployment_config["pytorch_version"], deployment_config["python_version"]
 
+        from sagemaker.pytorch import PyTorchModel
+
         pytorch_model = PyTorchModel(
             model_data=self.model_uri,
             role=self.role_arn.raw_str,
@@ -137,6 +158,6 @@ class PyTorchSageMakerResourceUser(ResourceUser):
         if not self.lambda_user.function_arn:
             raise AttributeError("You did not deploy a huggingface model as a lambda function on AWS. Please run .deploy() and try again.")
         self.check_input(data)
-        response = self.lambda_user.use(data)
+        response = self.transport.send(data)
         self.check_output(response)
         return response
\ No newline at end of file
@@ -7,6 +7,9 @@ from sagemode.Helpers.TypeChecking import *
 
 class ResourceUser(ABC):
 
+    # whether the handler this user deploys reads offloaded payloads. a user whose handler does not sends every request inline
+    resolves_payloads = True
+
     def __init__(self, role_arn:RoleArn, previous:dict[str, type]=None, next:dict[str, type]=None):
         load_dotenv()
         self.role_arn = role_arn
@@ -18,6 +21,11 @@ class ResourceUser(ABC):
         if next != None:
             self.next = next
         self.login()
+        # users that invoke lambda functions or state machines pass large fields through S3 once this is set,
+        # setting PAYLOAD_BUCKET turns it on for every such user
+        self.payload_offloader = None
+        if os.environ.get("PAYLOAD_BUCKET"):
+            self.enable_payload_offload(os.environ["PAYLOAD_BUCKET"])
 
     def __set_boto3_credentials(self, credentials:dict):
         try:
@@ -41,6 +49,19 @@ class ResourceUser(ABC):
         credentials = response["Credentials"]
         self.__set_boto3_credentials(credentials)
     
+    def enable_payload_offload(self, bucket:str, threshold:int = 64 * 1024, prefix:str = "sagemode-payloads", expiry_days:int = 1) -> None:
+        from sagemode.Helpers.PayloadOffload import PayloadOffloader
+        self.payload_offloader = PayloadOffloader(self.boto3_session.client("s3"), bucket, threshold, prefix, expiry_days)
+        # users that deploy a model call it through their lambda_user, which is the one that offloads
+        if hasattr(self, "lambda_user") and self.resolves_payloads:
+            self.lambda_user.payload_offloader = self.payload_offloader
+
+    def payload_environment(self) -> dict:
+        # deployed handlers only read and write offloaded payloads in this bucket, whatever bucket a request names
+        if self.payload_offloader is None or not self.resolves_payloads:
+            return {}
+        return {"PAYLOAD_BUCKET": self.payload_offloader.bucket}
+
     def check_input(self, input_data:dict):
         if not hasattr(self, "previous"):
             return
@@ -0,0 +1,92 @@
+import os
+import time
+from dotenv import load_dotenv
+from sagemode.ResourceUser.ResourceUser import ResourceUser
+from sagemode.ResourceUser.LambdaResourceUser.SageMakerLambdaResourceUser import SageMakerLambdaResourceUser
+from sagemode.Types.Arn import *
+from sagemode.Helpers.ParallelGzip import compress_directory
+from sagemode.Helpers.S3Stream import stream_directory_to_s3
+from sagemode.Helpers.ArtifactCache import cached_artifact_key, find_artifact, find_data_layer, record_artifact, digest_metadata_key
+from sagemode.Helpers.Transports import LambdaTransport, SageMakerRuntimeTransport
+
+# what HFSageMakerResourceUser and PyTorchSageMakerResourceUser share: the lambda user in front of the endpoint, the transports,
+# and packaging the staged model directory (self.model_dir) into a model.tar.gz in S3. sagemaker is imported by the methods that need it
+
+class SageMakerResourceUser(ResourceUser):
+
+    def __init__(self, instance_type:str, previous:dict[str, type] = None, next:dict[str, type] = None, lambda_arn:LambdaArn = None):
+        load_dotenv()
+        role_arn = RoleArn(os.environ["SAGEMAKER_ROLE_ARN"])
+        super().__init__(role_arn, previous, next)
+        self.instance_type = instance_type
+        self.lambda_user = SageMakerLambdaResourceUser(lambda_arn)
+        # the lambda_user builds its own offloader from PAYLOAD_BUCKET, it is replaced by this user's, or by none
+        self.lambda_user.payload_offloader = self.payload_offloader if self.resolves_payloads else None
+        self.transport = LambdaTransport(self.lambda_user)
+
+    def create_bucket(self) -> None:
+        import sagemaker
+        print("Creating bucket...")
+        sess = sagemaker.Session(self.boto3_session)
+        try:
+            self.bucket = sess.default_bucket()
+        except:
+            raise Exception("Unable to create bucket for session. Double check to make sure that your session is not 'None.'")
+
+    def compress(self, output_file="model.tar.gz", skip=False, level:int = 6, workers:int = None) -> int:
+        # returns the size of the archive's data layer, 0 when compression is skipped
+        self.output_file = str(os.path.join(os.getcwd(), output_file))
+        if skip:
+            print("You have selected to skip compressing your model. Skipping this step...")
+            return 0
+        # level 0 only stores the files, which is as small as it gets for safetensors and other dense weights
+        print("compressing directory...")
+        return compress_directory(self.model_dir, self.output_file, level, workers)
+
+    def upload_to_s3(self, skip=False) -> None:
+        s3_model_dir = os.path.basename(self.model_dir)
+        s3_output_file = os.path.basename(self.output_file)
+        if skip:
+            print("You have chosen to skip uploading to s3. Skipping this step...")
+            self.model_uri = f"s3://{self.bucket}/{s3_model_dir}/{s3_output_file}"
+        else:
+            from sagemaker.s3 import S3Uploader
+            t_start = time.time()
+            compressed_model_path = self.output_file
+            self.model_uri = S3Uploader.upload(local_path=compressed_model_path, desired_s3_uri=f"s3://{self.bucket}/{s3_model_dir}")
+            print(f"upload to s3 finished successfully. Time taken: {time.time() - t_start:.2f} seconds")
+
+    def stream_to_s3(self, output_file="model.tar.gz", level:int = 6, workers:int = None) -> None:
+        # compresses straight into a multipart upload, so the archive never lands on disk and the upload overlaps compression
+        s3_model_dir = os.path.basename(self.model_dir)
+        self.model_uri, _ = stream_directory_to_s3(self.model_dir, self.boto3_session.client("s3"), self.bucket, f"{s3_model_dir}/{output_file}", level, workers)
+
+    def cached_upload_to_s3(self, output_file="model.tar.gz", level:int = 6, stream:bool = False) -> None:
+        # the archive is stored under the digest of the staged directory, so an unchanged model is neither compressed nor uploaded again.
+        # when only code changed, the data layer of the earlier archive is copied inside S3 and only the code layer is built
+        s3_client = self.boto3_session.client("s3")
+        digest, data_digest, key = cached_artifact_key(self.model_dir, output_file)
+        self.model_uri = f"s3://{self.bucket}/{key}"
+        if find_artifact(s3_client, self.bucket, key, digest):
+            print(f"{self.model_uri} is already uploaded. Skipping compression and upload...")
+            return
+        metadata = {digest_metadata_key: digest}
+        data_layer = find_data_layer(s3_client, data_digest)
+        if stream or data_layer is not None:
+            _, data_bytes = stream_directory_to_s3(self.model_dir, s3_client, self.bucket, key, level, metadata=metadata, data_layer=data_layer)
+        else:
+            data_bytes = self.compress(output_file, False, level)
+            t_start = time.time()
+            s3_client.upload_file(self.output_file, self.bucket, key, ExtraArgs={"Metadata": metadata})
+            print(f"upload to s3 finished successfully. Time taken: {time.time() - t_start:.2f} seconds")
+        record_artifact(digest, self.model_uri, data_digest, data_bytes)
+
+    def set_transport(self, transport:str = "lambda", timeout:float = 60) -> None:
+        # "direct" calls the endpoint from this process instead of invoking the lambda function, for trusted callers with
+        # sagemaker:InvokeEndpoint permission. the endpoint name is read from the lambda function's configuration
+        if transport == "lambda":
+            self.transport = LambdaTransport(self.lambda_user)
+        elif transport == "direct":
+            self.transport = SageMakerRuntimeTransport(self.boto3_session, self.lambda_user.get_endpoint_name(), timeout)
+        else:
+            raise ValueError("'transport' must be 'lambda' or 'direct'.")
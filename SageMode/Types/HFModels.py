@@ -1,4 +1,46 @@
-from transformers import AutoModelForCausalLM, AutoModelForSeq2SeqLM
-from diffusers import StableDiffusionPipeline
+import os
+import json
 
-model_types = [AutoModelForSeq2SeqLM, AutoModelForCausalLM, StableDiffusionPipeline]
\ No newline at end of file
+# the inference file in InferenceFiles/HFSageMaker that serves each model type
+inference_files = {"AutoModelForSeq2SeqLM": "AutoModelForSeq2SeqLM.py",
+                   "AutoModelForCausalLM": "AutoModelForCausalLM.py",
+                   "StableDiffusionPipeline": "StableDiffusionPipeline.py"}
+
+# diffusers pipelines, matched against "_class_name" in model_index.json
+diffusers_pipelines = {"StableDiffusionPipeline": "StableDiffusionPipeline"}
+
+def transformers_registry() -> list[tuple[str, dict]]:
+    # transformers' own model_type -> architecture tables, seq2seq first because some model types (bart, mbart...) appear in both
+    from transformers.models.auto.modeling_auto import MODEL_FOR_SEQ_TO_SEQ_CAUSAL_LM_MAPPING_NAMES, MODEL_FOR_CAUSAL_LM_MAPPING_NAMES
+    return [("AutoModelForSeq2SeqLM", MODEL_FOR_SEQ_TO_SEQ_CAUSAL_LM_MAPPING_NAMES),
+            ("AutoModelForCausalLM", MODEL_FOR_CAUSAL_LM_MAPPING_NAMES)]
+
+def resolve_model_type(model_dir:str) -> str:
+    # reads only the json files that describe the model, so no weights are loaded to pick an inference file
+    model_index_path = os.path.join(model_dir, "model_index.json")
+    if os.path.exists(model_index_path):
+        with open(model_index_path) as model_index_file:
+            class_name = json.load(model_index_file).get("_class_name")
+        if class_name in diffusers_pipelines:
+            return diffusers_pipelines[class_name]
+        raise ValueError(f"The diffusers pipeline '{class_name}' is not supported. Supported pipelines: {list(diffusers_pipelines)}.")
+
+    config_path = os.path.join(model_dir, "config.json")
+    if not os.path.exists(config_path):
+        raise ValueError(f"Neither config.json nor model_index.json was found in {model_dir}, pass 'model_type' to choose the inference file.")
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+
+    registry = transformers_registry()
+    architectures = config.get("architectures") or []
+    for architecture in architectures:
+        for model_type, mapping in registry:
+            if architecture in mapping.values():
+                return model_type
+    # only configs that name no architecture fall back to the model family, a BertForMaskedLM checkpoint is not a causal LM
+    if not architectures:
+        for model_type, mapping in registry:
+            if config.get("model_type") in mapping:
+                return model_type
+    raise ValueError(f"Could not tell which inference file serves the architecture {config.get('architectures')} "
+                     f"(model_type '{config.get('model_type')}'). Pass 'model_type' as one of {list(inference_files)}.")
@@ -3,4 +3,5 @@ from typing import Union
 class IOTypes:
     LanguageModeling = {"text":str, "parameters":Union[dict, None]}
     ImageModeling = {"base64":str, "parameters":Union[dict, None]}
+    ImageBatchModeling = {"base64":list, "parameters":Union[dict, None]}
     Logits = {"logits": list[float], "parameters":Union[dict, None]}